@@ -0,0 +1,5 @@
+"""
+Codec benchmarks.
+
+Run with C{python -m waffle.benchmark --help}.
+"""
@@ -0,0 +1,7 @@
+import sys
+
+from waffle.benchmark.runner import main
+
+
+
+sys.exit(main())
@@ -0,0 +1,299 @@
+"""
+Deterministic corpus of synthetic Quassel frames.
+
+Every generator takes a C{random.Random} instance, the same seed always
+produces the same frames.
+"""
+from waffle.qt import adapters
+from waffle.qt.quassel import messageFlags
+from waffle.quassel.protocol import RequestType
+
+
+
+_words = (
+    u'the quick brown fox jumps over lazy dog quassel core client buffer '
+    u'network channel topic away nick server hello world ping pong latency '
+    u'backlog message sync init data').split()
+
+
+
+class Case(object):
+    """
+    A benchmark case.
+
+    @type name: C{str}
+    @ivar name: Case name.
+
+    @type values: C{list}
+    @ivar values: L{waffle.qt.adapters} values, one per frame.
+    """
+    def __init__(self, name, values):
+        self.name = name
+        self.values = values
+
+
+    def __repr__(self):
+        return '<%s %s frames=%d>' % (
+            type(self).__name__, self.name, len(self.values))
+
+
+
+def _sentence(rnd, minWords=3, maxWords=15):
+    return u' '.join(
+        rnd.choice(_words) for i in xrange(rnd.randint(minWords, maxWords)))
+
+
+
+def _nickname(rnd):
+    return u'%s%s%d' % (
+        rnd.choice(_words), rnd.choice(_words).title(), rnd.randint(0, 99))
+
+
+
+def _hostmask(rnd, nickname):
+    return u'%s!~%s@%s.example.net' % (
+        nickname, nickname[:8].lower(), rnd.choice(_words))
+
+
+
+def _bufferInfo(rnd, id, networkId, name=None):
+    if name is None:
+        name = u'#' + rnd.choice(_words) + unicode(id)
+    return adapters.BufferInfoRecord(
+        id, networkId, 'channel', 0, name.encode('utf-8'))
+
+
+
+def _bufferInfoValue(bufferInfo):
+    return adapters.UserType(
+        'BufferInfo', adapters.BufferInfo(bufferInfo.toJSON()))
+
+
+
+def _message(rnd, id, bufferInfo, timestamp):
+    nickname = _nickname(rnd)
+    return adapters.MessageRecord(
+        id,
+        timestamp,
+        rnd.choice(['plain'] * 8 + ['action', 'join', 'part', 'quit']),
+        rnd.choice([0, 0, 0, messageFlags['self'],
+                    messageFlags['highlight']]),
+        bufferInfo,
+        _hostmask(rnd, nickname).encode('utf-8'),
+        _sentence(rnd).encode('utf-8'))
+
+
+
+def _request(requestType, *args):
+    return adapters.QVariantList(
+        [adapters.Int(requestType.value)] + list(args))
+
+
+
+def clientInitAck(rnd):
+    """
+    Create a C{ClientInitAck} handshake message.
+    """
+    backend = adapters.QVariantMap({
+        u'DisplayName': adapters.QString(u'SQLite'),
+        u'Description': adapters.QString(_sentence(rnd)),
+        u'ConnectionProperties': adapters.QStringList([]),
+        u'Properties': adapters.QVariantMap({})})
+    return adapters.QVariantMap({
+        u'MsgType': adapters.QString(u'ClientInitAck'),
+        u'CoreFeatures': adapters.UInt(0x3f),
+        u'SupportSsl': adapters.Bool(True),
+        u'SupportsCompression': adapters.Bool(True),
+        u'Configured': adapters.Bool(True),
+        u'LoginEnabled': adapters.Bool(True),
+        u'ProtocolVersion': adapters.UInt(10),
+        u'StorageBackends': adapters.QVariantList([backend])})
+
+
+
+def sessionInit(rnd, buffers):
+    """
+    Create a C{SessionInit} handshake message with C{buffers} buffers across
+    a handful of networks.
+    """
+    networkIds = range(1, min(buffers, 5) + 1)
+    bufferInfos = [
+        _bufferInfo(rnd, id, networkIds[id % len(networkIds)])
+        for id in xrange(1, buffers + 1)]
+    identity = adapters.QVariantMap({
+        u'identityId': adapters.UserType('IdentityId', adapters.Int(1)),
+        u'identityName': adapters.QString(u'default'),
+        u'nicks': adapters.QStringList([_nickname(rnd), _nickname(rnd)]),
+        u'realName': adapters.QString(_sentence(rnd, 2, 3)),
+        u'awayReason': adapters.QString(_sentence(rnd)),
+        u'autoAwayEnabled': adapters.Bool(False)})
+    return adapters.QVariantMap({
+        u'MsgType': adapters.QString(u'SessionInit'),
+        u'SessionState': adapters.QVariantMap({
+            u'BufferInfos': adapters.QVariantList(
+                [_bufferInfoValue(b) for b in bufferInfos]),
+            u'NetworkIds': adapters.QVariantList(
+                [adapters.UserType('NetworkId', adapters.Int(id))
+                 for id in networkIds]),
+            u'Identities': adapters.QVariantList(
+                [adapters.UserType('Identity', identity)])})})
+
+
+
+def networkInitData(rnd, users, channels):
+    """
+    Create C{InitData} for a network with C{users} users spread across
+    C{channels} channels.
+    """
+    nicknames = [_nickname(rnd) + unicode(i) for i in xrange(users)]
+    channelNames = [
+        u'#%s%d' % (rnd.choice(_words), i) for i in xrange(channels)]
+    channelUsers = dict((name, []) for name in channelNames)
+    userValues = {}
+    for nickname in nicknames:
+        joined = rnd.sample(channelNames, min(channels, rnd.randint(1, 4)))
+        for name in joined:
+            channelUsers[name].append(nickname)
+        userValues[_hostmask(rnd, nickname)] = adapters.QVariantMap({
+            u'nick': adapters.QString(nickname),
+            u'user': adapters.QString(u'~' + nickname[:8].lower()),
+            u'host': adapters.QString(u'example.net'),
+            u'realName': adapters.QString(_sentence(rnd, 1, 3)),
+            u'away': adapters.Bool(rnd.random() < 0.1),
+            u'awayMessage': adapters.QString(u''),
+            u'server': adapters.QString(u'irc.example.net'),
+            u'ircOperator': adapters.QString(u''),
+            u'channels': adapters.QStringList(joined)})
+    channelValues = {}
+    modes = [u'', u'', u'v', u'o']
+    for name in channelNames:
+        channelValues[name] = adapters.QVariantMap({
+            u'name': adapters.QString(name),
+            u'topic': adapters.QString(_sentence(rnd)),
+            u'password': adapters.QString(u''),
+            u'UserModes': adapters.QVariantMap(dict(
+                (nickname, adapters.QString(rnd.choice(modes)))
+                for nickname in channelUsers[name])),
+            u'ChanModes': adapters.QVariantMap({})})
+    return _request(
+        RequestType.InitData,
+        adapters.QString(u'Network'),
+        adapters.QString(u'1'),
+        adapters.QVariantMap({
+            u'networkName': adapters.QString(u'ExampleNet'),
+            u'currentServer': adapters.QString(u'irc.example.net'),
+            u'myNick': adapters.QString(nicknames[0]),
+            u'latency': adapters.Int(rnd.randint(10, 500)),
+            u'IrcUsersAndChannels': adapters.QVariantMap({
+                u'users': adapters.QVariantMap(userValues),
+                u'channels': adapters.QVariantMap(channelValues)})}))
+
+
+
+def backlog(rnd, messages):
+    """
+    Create a C{BacklogManager.receiveBacklog} sync call carrying C{messages}
+    messages for a single buffer.
+    """
+    bufferInfo = _bufferInfo(rnd, 1, 1)
+    first = rnd.randint(1, 10 ** 6)
+    timestamp = 1331600000 + rnd.randint(0, 10 ** 6)
+    records = [
+        _message(rnd, first + i, bufferInfo, timestamp + i * 7)
+        for i in xrange(messages)]
+    return _request(
+        RequestType.Sync,
+        adapters.QString(u'BacklogManager'),
+        adapters.QString(u''),
+        adapters.QString(u'receiveBacklog'),
+        adapters.UserType('BufferId', adapters.Int(bufferInfo.id)),
+        adapters.UserType('MsgId', adapters.Int(-1)),
+        adapters.UserType('MsgId', adapters.Int(-1)),
+        adapters.Int(messages),
+        adapters.Int(0),
+        adapters.QVariantList([
+            adapters.UserType('Message', adapters.MessageInfo(record))
+            for record in reversed(records)]))
+
+
+
+def syncStream(rnd, count):
+    """
+    Create C{count} small sync calls and messages, in the mix seen on a busy
+    core.
+    """
+    bufferInfos = [_bufferInfo(rnd, id, 1) for id in xrange(1, 21)]
+    nicknames = [_nickname(rnd) for i in xrange(200)]
+
+    def _displayMsg(i):
+        message = _message(
+            rnd, 10 ** 6 + i, rnd.choice(bufferInfos), 1331600000 + i)
+        return _request(
+            RequestType.RpcCall,
+            adapters.QString(u'2displayMsg(Message)'),
+            adapters.UserType('Message', adapters.MessageInfo(message)))
+
+    def _setAway(i):
+        return _request(
+            RequestType.Sync,
+            adapters.QString(u'IrcUser'),
+            adapters.QString(u'1/' + rnd.choice(nicknames)),
+            adapters.QString(u'setAway'),
+            adapters.Bool(rnd.random() < 0.5))
+
+    def _setLatency(i):
+        return _request(
+            RequestType.Sync,
+            adapters.QString(u'Network'),
+            adapters.QString(u'1'),
+            adapters.QString(u'setLatency'),
+            adapters.Int(rnd.randint(10, 500)))
+
+    def _setLastSeenMsg(i):
+        return _request(
+            RequestType.Sync,
+            adapters.QString(u'BufferSyncer'),
+            adapters.QString(u''),
+            adapters.QString(u'setLastSeenMsg'),
+            adapters.UserType(
+                'BufferId', adapters.Int(rnd.choice(bufferInfos).id)),
+            adapters.UserType('MsgId', adapters.Int(10 ** 6 + i)))
+
+    def _heartbeat(i):
+        return _request(
+            RequestType.Heartbeat,
+            adapters.QTime(adapters.QTime.parse(i * 1000)))
+
+    kinds = (
+        [_displayMsg] * 10 + [_setAway] * 4 + [_setLatency] * 2 +
+        [_setLastSeenMsg] * 3 + [_heartbeat])
+    return [rnd.choice(kinds)(i) for i in xrange(count)]
+
+
+
+def generate(rnd, scale=1.0):
+    """
+    Generate the benchmark corpus.
+
+    @type  rnd: C{random.Random}
+
+    @param scale: Multiplier for the number of buffers, users, channels and
+        messages.
+
+    @rtype: C{list} of L{Case}
+    """
+    def _n(count):
+        return max(1, int(count * scale))
+
+    return [
+        Case('ClientInitAck', [clientInitAck(rnd)]),
+        Case('SessionInit', [sessionInit(rnd, _n(200))]),
+        Case('NetworkInitData', [networkInitData(rnd, _n(2000), _n(100))]),
+        Case('Backlog', [backlog(rnd, _n(500))]),
+        Case('SyncStream', syncStream(rnd, _n(2000)))]
+
+
+
+__all__ = [
+    'Case', 'clientInitAck', 'sessionInit', 'networkInitData', 'backlog',
+    'syncStream', 'generate']
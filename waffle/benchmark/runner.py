@@ -0,0 +1,395 @@
+"""
+Measure decode and encode throughput of the C{QVariant} codecs over the
+synthetic corpus, and how long the client blocks the reactor initializing a
+large network.
+"""
+import gc
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+from twisted.internet import task
+from twisted.python import usage
+from twisted.test.proto_helpers import StringTransport
+
+from waffle.benchmark import corpus
+from waffle.qt import codec
+from waffle.quassel import protocol
+
+
+
+codecs = [
+    ('native', codec.QVariantDecoder, codec.QVariantEncoder),
+    ('construct', codec.ConstructDecoder, codec.ConstructEncoder)]
+
+
+
+class Options(usage.Options):
+    synopsis = '[options]'
+
+    optParameters = [
+        ['seed', None, 0, 'Corpus random seed.', int],
+        ['scale', None, 1.0, 'Corpus size multiplier.', float],
+        ['min-time', None, 1.0,
+         'Minimum time, in seconds, to run each benchmark for.', float],
+        ['output', 'o', None, 'Write the results, as JSON, to this file.'],
+        ['compare', 'c', None,
+         'Compare the results with those previously written to this file.'],
+        ['threshold', None, 0.1,
+         'Relative loss of throughput reported as a regression.', float]]
+
+    optFlags = [
+        ['native-only', None, 'Only benchmark the native codec.']]
+
+
+
+def _revision():
+    """
+    Get the current git revision of the source tree, if there is one.
+    """
+    path = os.path.dirname(os.path.abspath(__file__))
+    try:
+        process = subprocess.Popen(
+            ['git', 'rev-parse', 'HEAD'], cwd=path,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        return None
+    out, err = process.communicate()
+    if process.returncode != 0:
+        return None
+    return out.strip()
+
+
+
+def _timePasses(func, minTime):
+    """
+    Call C{func} repeatedly for at least C{minTime} seconds.
+
+    @return: C{(passes, elapsed)}.
+    """
+    passes = 1
+    while True:
+        start = time.time()
+        for i in xrange(passes):
+            func()
+        elapsed = time.time() - start
+        if elapsed >= minTime:
+            return passes, elapsed
+        passes *= 2
+
+
+
+def _countObjects(func):
+    """
+    Count the garbage-collected objects that C{func} allocates and keeps alive
+    through its result.
+    """
+    gc.collect()
+    gc.disable()
+    try:
+        before = len(gc.get_objects())
+        result = func()
+        after = len(gc.get_objects())
+    finally:
+        gc.enable()
+    del result
+    return after - before
+
+
+
+def _residentMemory():
+    """
+    Get the resident memory of this process, in KiB, or C{None} if it cannot
+    be determined.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (IOError, IndexError, ValueError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+
+def _peakMemory(func):
+    """
+    Measure the growth in peak resident memory, in KiB, of calling C{func} in
+    a child process.
+
+    @return: Peak memory growth, or C{None} if it cannot be measured on this
+        platform.
+    """
+    if not hasattr(os, 'fork') or _residentMemory() is None:
+        return None
+    import resource
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(r)
+            gc.collect()
+            before = _residentMemory()
+            func()
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            os.write(w, str(max(0, peak - before)))
+        finally:
+            os._exit(0)
+    os.close(w)
+    with os.fdopen(r) as f:
+        output = f.read()
+    os.waitpid(pid, 0)
+    return int(output) if output else None
+
+
+
+def _measure(case, codecName, operation, func, frames, size, minTime):
+    """
+    Benchmark a single operation over every frame in a case.
+
+    @param func: Callable performing one pass over the case, and returning
+        what it produced.
+    """
+    result = dict(
+        case=case.name,
+        codec=codecName,
+        operation=operation,
+        frames=frames,
+        bytes=size)
+    try:
+        func()
+    except Exception, e:
+        result['error'] = type(e).__name__
+        if str(e):
+            result['error'] += ': %s' % (e,)
+        return result
+    passes, elapsed = _timePasses(func, minTime)
+    result.update(
+        framesPerSecond=passes * frames / elapsed,
+        megabytesPerSecond=passes * size / elapsed / 1e6,
+        objectsPerFrame=_countObjects(func) / float(frames),
+        peakMemory=_peakMemory(func))
+    return result
+
+
+
+class _Turn(object):
+    """
+    A call scheduled by a cooperator, run when the benchmark asks for it, so
+    that each reactor turn it would take can be timed.
+    """
+    def __init__(self, turns, f):
+        self._turns = turns
+        self.f = f
+        turns.append(self)
+
+
+    def cancel(self):
+        self._turns.remove(self)
+
+
+
+class _NullWeb(object):
+    """
+    Web client discarding every event.
+    """
+    def sendJSON(self, messageType, data):
+        pass
+
+
+
+def _initializeNetwork(frame):
+    """
+    Deliver a Network InitData frame to a client, and time each reactor turn
+    spent handling it, including sending the network to a web client.
+
+    @rtype: C{list} of C{float}
+    @return: Duration, in seconds, of each reactor turn.
+    """
+    turns = []
+    cooperator = task.Cooperator(scheduler=lambda f: _Turn(turns, f))
+    cooperate, task.cooperate = task.cooperate, cooperator.cooperate
+    try:
+        client = protocol.QuasselClient('user', 'password', probe=False)
+        client.heartbeatInterval = None
+        client.makeConnection(StringTransport())
+        client.state = 'message'
+        client._messageHandler = protocol.QuasselMessage(client)
+        client.web = _NullWeb()
+        start = time.time()
+        client.stringReceived(frame)
+        durations = [time.time() - start]
+        while turns:
+            start = time.time()
+            turns.pop(0).f()
+            durations.append(time.time() - start)
+    finally:
+        task.cooperate = cooperate
+    return durations
+
+
+
+def _measureLatency(case, frame, minTime):
+    """
+    Benchmark the client initializing the network in a case, recording the
+    longest reactor turn, the least of those of every pass, as well as the
+    throughput.
+    """
+    result = dict(
+        case=case.name,
+        codec='client',
+        operation='init',
+        frames=1,
+        bytes=len(frame))
+    maxTurns = []
+    start = time.time()
+    while True:
+        maxTurns.append(max(_initializeNetwork(frame)))
+        elapsed = time.time() - start
+        if elapsed >= minTime:
+            break
+    result.update(
+        framesPerSecond=len(maxTurns) / elapsed,
+        megabytesPerSecond=len(maxTurns) * len(frame) / elapsed / 1e6,
+        maxTurn=min(maxTurns))
+    return result
+
+
+
+def run(cases, codecs, minTime):
+    """
+    Benchmark decoding and encoding every case with every codec.
+
+    @type  cases: C{list} of L{corpus.Case}
+
+    @type  codecs: C{list} of C{(name, decoderFactory, encoderFactory)}
+
+    @rtype: C{list} of C{dict}
+    """
+    frameEncoder = codec.QVariantEncoder()
+    results = []
+    for case in cases:
+        frames = [frameEncoder.encode(value) for value in case.values]
+        size = sum(len(frame) for frame in frames)
+        for name, decoderFactory, encoderFactory in codecs:
+            decoder = decoderFactory()
+            encoder = encoderFactory()
+            results.append(_measure(
+                case, name, 'decode',
+                lambda: [decoder.decode(frame) for frame in frames],
+                len(frames), size, minTime))
+            results.append(_measure(
+                case, name, 'encode',
+                lambda: [encoder.encode(value) for value in case.values],
+                len(frames), size, minTime))
+            print >>sys.stderr, formatResult(results[-2])
+            print >>sys.stderr, formatResult(results[-1])
+        if case.name == 'NetworkInitData':
+            results.append(_measureLatency(case, frames[0], minTime))
+            print >>sys.stderr, formatResult(results[-1])
+    return results
+
+
+
+def formatResult(result):
+    """
+    Format a benchmark result as a line of text.
+    """
+    prefix = '%-16s %-10s %-7s' % (
+        result['case'], result['codec'], result['operation'])
+    if 'error' in result:
+        return '%s %s' % (prefix, result['error'])
+    if 'maxTurn' in result:
+        return '%s %10.1f frames/s %8.2f MB/s %10.1f ms/turn' % (
+            prefix,
+            result['framesPerSecond'],
+            result['megabytesPerSecond'],
+            result['maxTurn'] * 1000)
+    peakMemory = result['peakMemory']
+    return '%s %10.1f frames/s %8.2f MB/s %10.1f objects/frame %8s KiB' % (
+        prefix,
+        result['framesPerSecond'],
+        result['megabytesPerSecond'],
+        result['objectsPerFrame'],
+        '-' if peakMemory is None else peakMemory)
+
+
+
+def compare(old, new, threshold):
+    """
+    Compare two sets of benchmark results.
+
+    @param threshold: Relative loss of throughput, or growth of the longest
+        reactor turn, considered a regression.
+
+    @return: C{(lines, regressions)}, lines of text describing each change and
+        the number of regressions.
+    """
+    def _key(result):
+        return result['case'], result['codec'], result['operation']
+
+    oldResults = dict(
+        (_key(result), result) for result in old['results']
+        if 'error' not in result)
+    lines = []
+    regressions = 0
+    for result in new['results']:
+        before = oldResults.get(_key(result))
+        if before is None or 'error' in result:
+            continue
+        ratio = result['framesPerSecond'] / before['framesPerSecond']
+        isRegression = ratio < 1 - threshold
+        line = '%-16s %-10s %-7s %6.2fx' % (_key(result) + (ratio,))
+        if 'maxTurn' in result and 'maxTurn' in before:
+            turnRatio = result['maxTurn'] / before['maxTurn']
+            isRegression = isRegression or turnRatio > 1 + threshold
+            line += ' %6.2fx turn' % (turnRatio,)
+        regressions += isRegression
+        lines.append(line + (' REGRESSION' if isRegression else ''))
+    return lines, regressions
+
+
+
+def main(argv=None):
+    """
+    Run the benchmarks.
+
+    @return: Exit status, non-zero if C{--compare} found regressions.
+    """
+    options = Options()
+    try:
+        options.parseOptions(argv)
+    except usage.UsageError, e:
+        print >>sys.stderr, '%s\n%s' % (options, e)
+        return 2
+
+    cases = corpus.generate(
+        random.Random(options['seed']), options['scale'])
+    selected = codecs[:1] if options['native-only'] else codecs
+    results = dict(
+        revision=_revision(),
+        python=sys.version,
+        timestamp=time.time(),
+        seed=options['seed'],
+        scale=options['scale'],
+        results=run(cases, selected, options['min-time']))
+
+    if options['output'] is not None:
+        with open(options['output'], 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if options['compare'] is not None:
+        with open(options['compare']) as f:
+            old = json.load(f)
+        lines, regressions = compare(old, results, options['threshold'])
+        for line in lines:
+            print line
+        if regressions:
+            return 1
+    return 0
+
+
+
+__all__ = ['Options', 'run', 'formatResult', 'compare', 'main']
@@ -0,0 +1,379 @@
+"""
+The permessage-deflate WebSocket extension, for txWS.
+
+@see: U{https://tools.ietf.org/html/rfc7692}
+"""
+import struct
+import zlib
+
+from twisted.protocols.policies import ProtocolWrapper
+from twisted.python import log
+from txws import (
+    WebSocketFactory, WebSocketProtocol, WSException, FRAMES, decoders,
+    encoders, make_accept, make_hybi07_frame, mask)
+
+from waffle.metrics import metrics
+
+
+
+_framesCompressed = metrics.counter(
+    'waffle_web_deflate_frames_compressed_total',
+    'Frames sent to web clients compressed with permessage-deflate.')
+_framesUncompressed = metrics.counter(
+    'waffle_web_deflate_frames_uncompressed_total',
+    'Frames sent to web clients uncompressed, despite permessage-deflate, '
+    'because they were too small.')
+_bytesIn = metrics.counter(
+    'waffle_web_deflate_input_bytes_total',
+    'Bytes of the frames compressed with permessage-deflate, before '
+    'compression.')
+_bytesOut = metrics.counter(
+    'waffle_web_deflate_output_bytes_total',
+    'Bytes of the frames compressed with permessage-deflate, after '
+    'compression.')
+
+
+
+EXTENSION = 'permessage-deflate'
+
+# Every compressed message ends with an empty stored block, which is left out
+# of the frame.
+_TAIL = '\x00\x00\xff\xff'
+
+_CONTINUATION, _TEXT, _BINARY, _CLOSE, _PING, _PONG = (
+    0x0, 0x1, 0x2, 0x8, 0x9, 0xa)
+
+
+
+def parseExtensions(header):
+    """
+    Parse a C{Sec-WebSocket-Extensions} header.
+
+    @type  header: C{str}
+
+    @rtype: C{list} of C{(str, dict)}
+    @return: Extension offers, in order of preference, as the extension name
+        and a mapping of parameter names to values, C{None} for parameters
+        without a value.
+    """
+    offers = []
+    for offer in header.split(','):
+        parts = [part.strip() for part in offer.split(';')]
+        if not parts[0]:
+            continue
+        params = {}
+        for param in parts[1:]:
+            name, sep, value = param.partition('=')
+            params[name.strip()] = value.strip().strip('"') if sep else None
+        offers.append((parts[0], params))
+    return offers
+
+
+
+def parseFrames(buf):
+    """
+    Parse RFC 6455 frames, like C{txws.parse_hybi07_frames}, but permitting
+    the RSV1 bit that marks compressed messages.
+
+    @raise WSException: If a frame has an unknown opcode or a reserved bit
+        other than RSV1 set.
+
+    @rtype: C{(list, str)}
+    @return: Complete frames, as C{(fin, compressed, opcode, data)}, and the
+        remaining data.
+    """
+    start = 0
+    frames = []
+    while len(buf) - start >= 2:
+        header, length = struct.unpack_from('>BB', buf, start)
+        if header & 0x30:
+            raise WSException('Reserved flag in frame (%d)' % (header,))
+        opcode = header & 0xf
+        if opcode not in (_CONTINUATION, _TEXT, _BINARY, _CLOSE, _PING,
+                          _PONG):
+            raise WSException('Unknown opcode %d in frame' % (opcode,))
+        masked = length & 0x80
+        length &= 0x7f
+        offset = start + 2
+        if length == 0x7e:
+            if len(buf) < offset + 2:
+                break
+            length, = struct.unpack_from('>H', buf, offset)
+            offset += 2
+        elif length == 0x7f:
+            if len(buf) < offset + 8:
+                break
+            length, = struct.unpack_from('>Q', buf, offset)
+            offset += 8
+        key = None
+        if masked:
+            if len(buf) < offset + 4:
+                break
+            key = buf[offset:offset + 4]
+            offset += 4
+        if len(buf) < offset + length:
+            break
+        data = buf[offset:offset + length]
+        if key is not None:
+            data = mask(data, key)
+        frames.append(
+            (bool(header & 0x80), bool(header & 0x40), opcode, data))
+        start = offset + length
+    return frames, buf[start:]
+
+
+
+class PerMessageDeflate(object):
+    """
+    Negotiated permessage-deflate parameters, and compression contexts, of a
+    connection.
+
+    @type serverContextTakeover: C{bool}
+    @ivar serverContextTakeover: Keep the compression context between
+        messages sent.
+
+    @type clientContextTakeover: C{bool}
+    @ivar clientContextTakeover: Keep the decompression context between
+        messages received.
+
+    @type serverWindowBits: C{int}
+    @ivar serverWindowBits: Base two logarithm of the compression window.
+    """
+    def __init__(self, serverContextTakeover=True, clientContextTakeover=True,
+                 serverWindowBits=15, level=6):
+        self.serverContextTakeover = serverContextTakeover
+        self.clientContextTakeover = clientContextTakeover
+        self.serverWindowBits = serverWindowBits
+        self.level = level
+        self._compressor = None
+        self._decompressor = None
+
+
+    @classmethod
+    def accept(cls, offers, contextTakeover=True, level=6):
+        """
+        Accept the first permessage-deflate offer that can be satisfied.
+
+        @type  offers: C{list}
+        @param offers: Extension offers, as returned by L{parseExtensions}.
+
+        @type  contextTakeover: C{bool}
+        @param contextTakeover: Keep the compression context between messages
+            sent, unless the client asks otherwise.
+
+        @rtype: C{(PerMessageDeflate, str)}
+        @return: The negotiated parameters, and the extension's response, or
+            C{None} if no offer can be satisfied.
+        """
+        for name, params in offers:
+            if name != EXTENSION:
+                continue
+            response = [EXTENSION]
+            serverWindowBits = 15
+            if 'server_max_window_bits' in params:
+                try:
+                    serverWindowBits = int(params['server_max_window_bits'])
+                except (TypeError, ValueError):
+                    continue
+                # zlib cannot produce raw deflate streams with a window of 8
+                # bits.
+                if not 9 <= serverWindowBits <= 15:
+                    continue
+                response.append('server_max_window_bits=%d' % (
+                    serverWindowBits,))
+            serverContextTakeover = (
+                contextTakeover and 'server_no_context_takeover' not in params)
+            if not serverContextTakeover:
+                response.append('server_no_context_takeover')
+            clientContextTakeover = 'client_no_context_takeover' not in params
+            if not clientContextTakeover:
+                response.append('client_no_context_takeover')
+            deflate = cls(
+                serverContextTakeover, clientContextTakeover,
+                serverWindowBits, level)
+            return deflate, '; '.join(response)
+        return None
+
+
+    def compress(self, data):
+        """
+        Compress a message.
+        """
+        compressor = self._compressor
+        if compressor is None:
+            compressor = zlib.compressobj(
+                self.level, zlib.DEFLATED, -self.serverWindowBits)
+            if self.serverContextTakeover:
+                self._compressor = compressor
+        data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data.endswith(_TAIL):
+            data = data[:-len(_TAIL)]
+        return data
+
+
+    def decompress(self, data, maxLength):
+        """
+        Decompress a message.
+
+        @param maxLength: Maximum permitted decompressed length.
+
+        @raise WSException: If the message is invalid, or decompresses to more
+            than C{maxLength} bytes.
+        """
+        decompressor = self._decompressor
+        if decompressor is None:
+            decompressor = zlib.decompressobj(-15)
+            if self.clientContextTakeover:
+                self._decompressor = decompressor
+        try:
+            result = decompressor.decompress(data + _TAIL, maxLength)
+        except zlib.error, e:
+            raise WSException('Invalid compressed message: %s' % (e,))
+        if decompressor.unconsumed_tail:
+            raise WSException(
+                'Compressed message exceeds %d bytes' % (maxLength,))
+        return result
+
+
+
+class DeflateWebSocketProtocol(WebSocketProtocol):
+    """
+    WebSocket protocol wrapper supporting the permessage-deflate extension.
+
+    @type deflate: L{PerMessageDeflate}
+    @ivar deflate: Negotiated compression, or C{None}.
+
+    @type maxMessageSize: C{int}
+    @ivar maxMessageSize: Maximum decompressed size of messages received.
+    """
+    deflate = None
+    maxMessageSize = 1024 * 1024
+
+    def __init__(self, *a, **kw):
+        WebSocketProtocol.__init__(self, *a, **kw)
+        self._message = []
+        self._messageCompressed = False
+
+
+    def sendHyBi07Preamble(self):
+        response = None
+        offers = self.headers.get('Sec-WebSocket-Extensions')
+        if offers and self.factory.deflate:
+            accepted = PerMessageDeflate.accept(
+                parseExtensions(offers), self.factory.contextTakeover,
+                self.factory.compressionLevel)
+            if accepted is not None:
+                self.deflate, response = accepted
+
+        self.sendCommonPreamble()
+        if self.codec:
+            self.writeEncoded('Sec-WebSocket-Protocol: %s\r\n' % self.codec)
+        if response is not None:
+            self.writeEncoded('Sec-WebSocket-Extensions: %s\r\n' % response)
+        self.writeEncoded('Sec-WebSocket-Accept: %s\r\n\r\n' % (
+            make_accept(self.headers['Sec-WebSocket-Key']),))
+
+
+    def _makeFrame(self, data):
+        if isinstance(data, unicode):
+            opcode, data = _TEXT, data.encode('utf-8')
+        elif getattr(self, 'do_binary_frames', False):
+            opcode = _BINARY
+        else:
+            opcode = _TEXT
+        if len(data) < self.factory.minCompressSize:
+            _framesUncompressed.inc()
+            return make_hybi07_frame(data, opcode)
+        compressed = self.deflate.compress(data)
+        _framesCompressed.inc()
+        _bytesIn.inc(len(data))
+        _bytesOut.inc(len(compressed))
+        frame = make_hybi07_frame(compressed, opcode)
+        # Set RSV1 to mark the message as compressed.
+        return chr(ord(frame[0]) | 0x40) + frame[1:]
+
+
+    def sendFrames(self):
+        if self.deflate is None:
+            return WebSocketProtocol.sendFrames(self)
+        if self.state != FRAMES:
+            return
+        for frame in self.pending_frames:
+            if self.codec:
+                frame = encoders[self.codec](frame)
+            self.writeEncoded(self._makeFrame(frame))
+        self.pending_frames = []
+
+
+    def parseFrames(self):
+        if self.deflate is None:
+            return WebSocketProtocol.parseFrames(self)
+        try:
+            frames, self.buf = parseFrames(self.buf)
+            for fin, compressed, opcode, data in frames:
+                if opcode == _CLOSE:
+                    if len(data) >= 2:
+                        reason, = struct.unpack('>H', data[:2])
+                        log.msg('Closing connection: %r (%d)' % (
+                            data[2:], reason))
+                    self.close()
+                    return
+                elif opcode in (_PING, _PONG):
+                    continue
+                elif opcode != _CONTINUATION:
+                    self._message = []
+                    self._messageCompressed = compressed
+                self._message.append(data)
+                if not fin:
+                    continue
+                data = ''.join(self._message)
+                self._message = []
+                if self._messageCompressed:
+                    data = self.deflate.decompress(data, self.maxMessageSize)
+                if self.codec:
+                    data = decoders[self.codec](data)
+                ProtocolWrapper.dataReceived(self, data)
+        except WSException, e:
+            self.close(e.args[0])
+
+
+
+class DeflateWebSocketFactory(WebSocketFactory):
+    """
+    WebSocket factory accepting the permessage-deflate extension.
+
+    @type deflate: C{bool}
+    @ivar deflate: Accept permessage-deflate when the client offers it.
+
+    @type compressionLevel: C{int}
+    @ivar compressionLevel: zlib compression level.
+
+    @type minCompressSize: C{int}
+    @ivar minCompressSize: Messages shorter than this many bytes are sent
+        uncompressed.
+
+    @type contextTakeover: C{bool}
+    @ivar contextTakeover: Keep the compression context between messages,
+        which compresses better at the cost of memory for each connection.
+    """
+    protocol = DeflateWebSocketProtocol
+    deflate = True
+    compressionLevel = 6
+    minCompressSize = 128
+    contextTakeover = True
+
+    def __init__(self, wrappedFactory, minCompressSize=None,
+                 contextTakeover=None, compressionLevel=None):
+        WebSocketFactory.__init__(self, wrappedFactory)
+        if minCompressSize is not None:
+            self.minCompressSize = minCompressSize
+        if contextTakeover is not None:
+            self.contextTakeover = contextTakeover
+        if compressionLevel is not None:
+            self.compressionLevel = compressionLevel
+
+
+
+__all__ = [
+    'parseExtensions', 'parseFrames', 'PerMessageDeflate',
+    'DeflateWebSocketProtocol', 'DeflateWebSocketFactory']
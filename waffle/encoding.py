@@ -0,0 +1,222 @@
+"""
+Encodings of the events sent to web clients.
+
+L{JSONEncoding} is the default, a web client can negotiate
+L{CompactEncoding} when it authenticates.
+"""
+import json
+import struct
+
+from waffle.qt.quassel import bufferTypes, messageFlags, messageTypes
+
+
+
+def _jsonDefault(obj):
+    """
+    Serialize values that know how to convert themselves to JSON, such as
+    message records and lazily decoded values.
+    """
+    toJSON = getattr(obj, 'toJSON', None)
+    if toJSON is None:
+        raise TypeError('%r is not JSON serializable' % (obj,))
+    return toJSON()
+
+
+
+class JSONEncoding(object):
+    """
+    Encode events as JSON text, C{{"type": ..., "data": ...}}.
+    """
+    name = u'json'
+    binary = False
+
+    def encode(self, messageType, data):
+        """
+        Encode an event.
+
+        @rtype: C{str}
+        """
+        return json.dumps(
+            {u'type': messageType, u'data': data}, default=_jsonDefault)
+
+
+    def encodeBatch(self, messages):
+        """
+        Combine encoded events into a single C{batch} event.
+
+        @type  messages: C{list} of C{str}
+        @param messages: Events encoded with L{encode}.
+
+        @rtype: C{str}
+        """
+        return '{"type": "batch", "data": [%s]}' % (', '.join(messages),)
+
+
+
+# Strings that are encoded as a reference into a table, rather than spelled
+# out, by CompactEncoding: event types, the keys of their data and common
+# values.
+wellKnownStrings = [
+    # Event types.
+    u'auth', u'batch', u'snapshot', u'message', u'backlog',
+    u'initializeBuffer', u'initializeNetwork', u'initializeBufferView',
+    u'initializeBufferSyncer', u'userModeAdded', u'userModeRemoved',
+    u'topicChanged', u'latencyUpdated', u'objectRenamed', u'userSetMetadata',
+    u'userConnected', u'userQuit', u'userParted', u'usersJoined',
+    u'channelJoined', u'bufferAdded', u'bufferRemoved', u'markerUpdated',
+    u'streamBegin', u'streamChunk', u'streamEnd', u'channelMembers',
+    u'networkUsers',
+    # Keys.
+    u'type', u'data', u'networkId', u'bufferName', u'nickname', u'bufferId',
+    u'bufferViewId', u'messageId', u'index', u'permanent', u'latency',
+    u'topic', u'mode', u'key', u'value', u'host', u'userModes', u'stream',
+    u'count', u'items', u'markerLines', u'lastSeenMessages', u'buffers',
+    u'networks', u'bufferViews', u'bufferSyncer', u'IrcUsersAndChannels',
+    u'users', u'channels', u'UserModes', u'nick', u'networkName', u'myNick',
+    u'Supports', u'id', u'groupId', u'name', u'timestamp', u'flags',
+    u'bufferInfo', u'sender', u'content', u'BufferList',
+    u'TemporarilyRemovedBuffers', u'RemovedBuffers', u'authToken',
+    u'encoding', u'strings']
+wellKnownStrings.extend(sorted(bufferTypes))
+wellKnownStrings.extend(sorted(messageTypes))
+wellKnownStrings.extend(sorted(messageFlags))
+
+
+
+class CompactEncoding(object):
+    """
+    Encode events in a compact binary form.
+
+    Every value starts with a tag byte:
+
+        - C{0x00}, C{0x01} and C{0x02} are C{null}, C{false} and C{true};
+
+        - C{0x03} is followed by a zigzag-encoded base 128 varint integer;
+
+        - C{0x04} is followed by a big-endian IEEE 754 double;
+
+        - C{0x05} is followed by a varint length and that many bytes of UTF-8
+          text;
+
+        - C{0x06} is followed by a varint count and that many values, forming
+          an array;
+
+        - C{0x07} is followed by a varint count and that many key and value
+          pairs, forming an object;
+
+        - C{0x08} is followed by a varint index into the table of well-known
+          strings;
+
+        - C{0x80} to C{0xff} are the integers C{0} to C{127}.
+
+    An event is an array of its type and data, a batch is a C{batch} event
+    whose data is an array of events.
+
+    @type strings: C{list} of C{unicode}
+    @ivar strings: Table of well-known strings; the web client must be given
+        the same table.
+    """
+    name = u'compact'
+    binary = True
+
+    NULL, FALSE, TRUE, INT, FLOAT, STRING, ARRAY, MAP, REF = range(9)
+    SMALL_INT = 0x80
+
+    def __init__(self, strings=None):
+        if strings is None:
+            strings = wellKnownStrings
+        self.strings = list(strings)
+        self._refs = dict(
+            (string, self._ref(index)) for index, string in enumerate(strings))
+
+
+    def _ref(self, index):
+        return chr(self.REF) + self._varint(index)
+
+
+    @staticmethod
+    def _varint(n):
+        result = []
+        while n > 0x7f:
+            result.append(chr(0x80 | (n & 0x7f)))
+            n >>= 7
+        result.append(chr(n))
+        return ''.join(result)
+
+
+    def _encodeValue(self, value, out):
+        if value is None:
+            out.append(chr(self.NULL))
+        elif value is True:
+            out.append(chr(self.TRUE))
+        elif value is False:
+            out.append(chr(self.FALSE))
+        elif isinstance(value, (int, long)):
+            if 0 <= value < 0x80:
+                out.append(chr(self.SMALL_INT | value))
+            else:
+                zigzag = value << 1 if value >= 0 else (~value << 1) | 1
+                out.append(chr(self.INT) + self._varint(zigzag))
+        elif isinstance(value, float):
+            out.append(chr(self.FLOAT) + struct.pack('>d', value))
+        elif isinstance(value, basestring):
+            ref = self._refs.get(value)
+            if ref is not None:
+                out.append(ref)
+                return
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            out.append(chr(self.STRING) + self._varint(len(value)) + value)
+        elif isinstance(value, (list, tuple)):
+            out.append(chr(self.ARRAY) + self._varint(len(value)))
+            for item in value:
+                self._encodeValue(item, out)
+        elif isinstance(value, dict):
+            out.append(chr(self.MAP) + self._varint(len(value)))
+            for key, item in value.iteritems():
+                if not isinstance(key, basestring):
+                    # JSON object keys are always strings.
+                    key = unicode(key)
+                self._encodeValue(key, out)
+                self._encodeValue(item, out)
+        else:
+            self._encodeValue(_jsonDefault(value), out)
+
+
+    def encode(self, messageType, data):
+        """
+        Encode an event.
+
+        @rtype: C{str}
+        """
+        out = [chr(self.ARRAY) + self._varint(2)]
+        self._encodeValue(messageType, out)
+        self._encodeValue(data, out)
+        return ''.join(out)
+
+
+    def encodeBatch(self, messages):
+        """
+        Combine encoded events into a single C{batch} event.
+
+        @type  messages: C{list} of C{str}
+        @param messages: Events encoded with L{encode}.
+
+        @rtype: C{str}
+        """
+        out = [chr(self.ARRAY) + self._varint(2)]
+        self._encodeValue(u'batch', out)
+        out.append(chr(self.ARRAY) + self._varint(len(messages)))
+        out.extend(messages)
+        return ''.join(out)
+
+
+
+encodings = {
+    JSONEncoding.name: JSONEncoding,
+    CompactEncoding.name: CompactEncoding}
+
+
+
+__all__ = [
+    'JSONEncoding', 'CompactEncoding', 'wellKnownStrings', 'encodings']
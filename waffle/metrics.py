@@ -0,0 +1,196 @@
+"""
+Gateway metrics, rendered in the Prometheus text exposition format.
+
+Process-wide counters and histograms are registered with L{metrics}, values
+that belong to live objects, such as sessions, are reported by collectors
+called whenever the metrics are rendered.
+
+@see: U{https://prometheus.io/docs/instrumenting/exposition_formats/}
+"""
+import bisect
+
+
+
+def _escape(value):
+    return unicode(value).replace(
+        u'\\', u'\\\\').replace(u'"', u'\\"').replace(u'\n', u'\\n')
+
+
+
+def _formatLabels(labels):
+    if not labels:
+        return u''
+    return u'{%s}' % (u','.join(
+        u'%s="%s"' % (name, _escape(value))
+        for name, value in sorted(labels.iteritems())),)
+
+
+
+def _formatValue(value):
+    if value == float('inf'):
+        return u'+Inf'
+    return repr(float(value)) if isinstance(value, float) else unicode(value)
+
+
+
+class Sample(object):
+    """
+    A metric family, as reported by a collector.
+
+    @type samples: C{list} of C{(suffix, labels, value)}
+    @ivar samples: Values, C{suffix} is appended to the family's name.
+    """
+    def __init__(self, name, metricType, help, samples=None):
+        self.name = name
+        self.type = metricType
+        self.help = help
+        self.samples = samples or []
+
+
+    def add(self, value, suffix='', **labels):
+        self.samples.append((suffix, labels, value))
+        return self
+
+
+
+class Counter(object):
+    """
+    A monotonically increasing count.
+    """
+    metricType = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+    def collect(self):
+        return Sample(self.name, self.metricType, self.help).add(self.value)
+
+
+
+class Histogram(object):
+    """
+    A distribution of observed values.
+
+    @type buckets: C{list} of C{float}
+    @ivar buckets: Ascending bucket upper bounds.
+    """
+    metricType = 'histogram'
+    defaultBuckets = [
+        0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10]
+
+    def __init__(self, name, help, buckets=None):
+        self.name = name
+        self.help = help
+        if buckets is None:
+            buckets = self.defaultBuckets
+        self.buckets = list(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+    def observe(self, value):
+        self._counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+    def collect(self):
+        sample = Sample(self.name, self.metricType, self.help)
+        cumulative = 0
+        for bound, count in zip(self.buckets + [float('inf')], self._counts):
+            cumulative += count
+            sample.add(cumulative, '_bucket', le=_formatValue(bound))
+        sample.add(self.sum, '_sum')
+        sample.add(self.count, '_count')
+        return sample
+
+
+
+class MetricsRegistry(object):
+    """
+    Metrics reported by the gateway.
+    """
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+
+    def counter(self, name, help):
+        """
+        Create and register a L{Counter}.
+        """
+        return self._register(Counter(name, help))
+
+
+    def histogram(self, name, help, buckets=None):
+        """
+        Create and register a L{Histogram}.
+        """
+        return self._register(Histogram(name, help, buckets))
+
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+
+    def addCollector(self, collector):
+        """
+        Register a collector.
+
+        @type  collector: C{callable}
+        @param collector: Called with no arguments and returning an iterable
+            of L{Sample}s.
+        """
+        self._collectors.append(collector)
+
+
+    def removeCollector(self, collector):
+        self._collectors.remove(collector)
+
+
+    def collect(self):
+        """
+        Collect every metric.
+
+        @rtype: C{list} of L{Sample}
+        """
+        samples = [metric.collect() for metric in self._metrics]
+        for collector in self._collectors:
+            samples.extend(collector())
+        return samples
+
+
+    def render(self):
+        """
+        Render every metric in the Prometheus text exposition format.
+
+        @rtype: C{str}
+        """
+        lines = []
+        for sample in self.collect():
+            lines.append(u'# HELP %s %s' % (sample.name, sample.help))
+            lines.append(u'# TYPE %s %s' % (sample.name, sample.type))
+            for suffix, labels, value in sample.samples:
+                lines.append(u'%s%s%s %s' % (
+                    sample.name, suffix, _formatLabels(labels),
+                    _formatValue(value)))
+        lines.append(u'')
+        return u'\n'.join(lines).encode('utf-8')
+
+
+
+metrics = MetricsRegistry()
+
+
+
+__all__ = [
+    'Sample', 'Counter', 'Histogram', 'MetricsRegistry', 'metrics']
@@ -0,0 +1,110 @@
+"""
+Outbound message queueing for web clients.
+"""
+import collections
+import itertools
+
+from twisted.internet.interfaces import IPushProducer
+from zope.interface import implementer
+
+
+
+@implementer(IPushProducer)
+class OutboundQueue(object):
+    """
+    Queue messages for a transport while it cannot keep up.
+
+    The queue registers itself as a streaming producer with the transport;
+    messages are written straight through until the transport pauses it, and
+    are then queued until it resumes. Queued messages with the same key are
+    coalesced: only the most recent one is kept, and it is sent after
+    everything queued before it.
+
+    Once more than L{maxBytes} are queued the client is considered to have
+    fallen too far behind: the queue is discarded and C{overflowed} is
+    called, which is expected to disconnect the client so that it can
+    reconnect and start again from a snapshot.
+
+    @type maxBytes: C{int}
+    @ivar maxBytes: Maximum number of bytes to queue.
+
+    @type bytes: C{int}
+    @ivar bytes: Number of bytes queued.
+
+    @type coalesced: C{int}
+    @ivar coalesced: Number of queued messages superseded by newer ones.
+    """
+    maxBytes = 4 * 1024 * 1024
+
+    def __init__(self, transport, overflowed):
+        """
+        @param transport: C{ITransport} provider messages are written to.
+
+        @type  overflowed: C{callable}
+        @param overflowed: Called with no arguments when the queue exceeds
+            L{maxBytes}.
+        """
+        self._transport = transport
+        self._overflowed = overflowed
+        self._items = collections.OrderedDict()
+        self._serial = itertools.count()
+        self._paused = False
+        self._stopped = False
+        self.bytes = 0
+        self.coalesced = 0
+        transport.registerProducer(self, True)
+
+
+    def __len__(self):
+        return len(self._items)
+
+
+    def put(self, data, key=None):
+        """
+        Write a message, or queue it if the transport is paused.
+
+        @type  data: C{str}
+
+        @param key: Hashable key that identifies messages superseded by this
+            one, or C{None} if the message should never be coalesced.
+        """
+        if self._stopped:
+            return
+        if not self._paused and not self._items:
+            self._transport.write(data)
+            return
+        if key is None:
+            key = next(self._serial)
+        else:
+            superseded = self._items.pop(key, None)
+            if superseded is not None:
+                self.bytes -= len(superseded)
+                self.coalesced += 1
+        self._items[key] = data
+        self.bytes += len(data)
+        if self.bytes > self.maxBytes:
+            self.stopProducing()
+            self._overflowed()
+
+
+    def pauseProducing(self):
+        self._paused = True
+
+
+    def resumeProducing(self):
+        self._paused = False
+        # Writing may pause us again.
+        while self._items and not self._paused:
+            key, data = self._items.popitem(last=False)
+            self.bytes -= len(data)
+            self._transport.write(data)
+
+
+    def stopProducing(self):
+        self._stopped = True
+        self._items.clear()
+        self.bytes = 0
+
+
+
+__all__ = ['OutboundQueue']
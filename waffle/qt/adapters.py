@@ -2,11 +2,15 @@
 Adapt parsed Construct values to more useful Python values.
 """
 import time
-from collections import namedtuple
+from array import array
+from collections import namedtuple, Sequence
 from datetime import date, datetime, timedelta
+from itertools import izip
 
 from construct import Container
 
+from waffle.qt.quassel import messageFlags, messageTypes
+
 
 
 class _WrappedValue(object):
@@ -25,6 +29,10 @@ class _WrappedValue(object):
             return NotImplemented
 
 
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, self._value)
+
+
     @property
     def value(self):
         return self._value
@@ -111,6 +119,15 @@ class QChar(_WrappedValue):
 
 
 
+class Short(_WrappedValue):
+    typeName = 'Short'
+
+    @classmethod
+    def parse(cls, v):
+        return v
+
+
+
 class UShort(_WrappedValue):
     typeName = 'UShort'
 
@@ -252,6 +269,16 @@ def getDateFromJulianDay(julianDay):
 
 
 
+def getJulianDayFromDate(d):
+    """
+    Get the Julian day of a (proleptic Gregorian) date.
+
+    @type  d: C{datetime.date}
+    """
+    return d.toordinal() + 1721425
+
+
+
 class QDate(_WrappedValue):
     typeName = 'QDate'
 
@@ -264,7 +291,69 @@ class QDate(_WrappedValue):
 
 
 
+_JULIAN_DAY_UNIX_EPOCH = 2440588
+_MSECS_PER_HOUR = 60 * 60 * 1000
+_MSECS_PER_DAY = 24 * _MSECS_PER_HOUR
+_localHourCache = {}
+_localHourCacheSize = 24 * 64
+
+
+
+def _getLocalHourTimestamp(julianDay, hour):
+    """
+    Get the POSIX timestamp, in milliseconds, of the start of an hour in local
+    time.
+
+    Results are cached, a burst of timestamps from the same few days only
+    calls C{mktime} once per hour involved.
+    """
+    key = julianDay, hour
+    result = _localHourCache.get(key)
+    if result is None:
+        info = getDateFromJulianDay(julianDay)
+        if info is None:
+            return None
+        if len(_localHourCache) >= _localHourCacheSize:
+            _localHourCache.clear()
+        y, m, d = info
+        result = _localHourCache[key] = int(
+            time.mktime((y, m, d, hour, 0, 0, 0, 0, -1))) * 1000
+    return result
+
+
+
+def getTimestampFromDateTime(julianDay, msecs, isUTC):
+    """
+    Convert a C{QDateTime} to a POSIX timestamp in milliseconds.
+
+    @param julianDay: Julian day of the date.
+
+    @param msecs: Milliseconds since midnight.
+
+    @param isUTC: Is the date and time in UTC, as opposed to local time?
+
+    @rtype: C{float}
+    @return: Milliseconds since the epoch, or C{None} if the date is invalid.
+    """
+    # Null and invalid times wrap in the same way as QTime.parse.
+    msecs %= _MSECS_PER_DAY
+    if isUTC:
+        # Only Julian calendar dates can be invalid.
+        if julianDay < 2299161 and getDateFromJulianDay(julianDay) is None:
+            return None
+        return float(
+            (julianDay - _JULIAN_DAY_UNIX_EPOCH) * _MSECS_PER_DAY + msecs)
+    hour, msecs = divmod(msecs, _MSECS_PER_HOUR)
+    result = _getLocalHourTimestamp(julianDay, hour)
+    if result is None:
+        return None
+    return float(result + msecs)
+
+
+
 class QDateTime(_WrappedValue):
+    typeName = 'QDateTime'
+
     _QDateTime = namedtuple(
         '_QDateTime', ['date', 'time', 'isUTC'])
 
@@ -282,61 +371,395 @@ class QDateTime(_WrappedValue):
 
     @classmethod
     def parse(cls, value):
-        #value = cls._QDateTime(
-        #    time=QTime.parse(value['time']),
-        #    date=QDate.parse(value['date']),
-        #    isUTC=Bool.parse(value['isUTC']))
-        #return cls(value)
-        t = QTime.parse(value['time'])
-        d = QDate.parse(value['date'])
-        # XXX: what the hell does this mean?
-        if d is None:
+        result = getTimestampFromDateTime(
+            value['date'], value['time'], value['isUTC'])
+        if result is None:
+            # XXX: what the hell does this mean?
             d = datetime.now().date()
-        return time.mktime(
-            # XXX: utctimetuple?
-            datetime.combine(d, t).timetuple()) * 1000
+            t = QTime.parse(value['time'])
+            result = time.mktime(datetime.combine(d, t).timetuple()) * 1000
+        return result
 
 
+    @classmethod
+    def fromDateTime(cls, dt, isUTC=False):
+        """
+        Create a L{QDateTime} from a C{datetime.datetime}.
+        """
+        msecs = (
+            (dt.hour * 60 + dt.minute) * 60 + dt.second) * 1000 + (
+                dt.microsecond // 1000)
+        return cls(cls._QDateTime(
+            getJulianDayFromDate(dt.date()), msecs, isUTC))
+
 
     def serialize(self):
-        raise NotImplementedError()
+        return Container(
+            date=self._value.date,
+            time=self._value.time,
+            isUTC=self._value.isUTC)
 
 
 
-class BufferInfo(_WrappedValue):
-    _fields = [
-        'id', 'networkId', 'type', 'groupId', 'name']
+class BufferInfoRecord(object):
+    """
+    Information about a buffer.
+
+    Records are immutable, messages in the same buffer may share a single
+    record.
+    """
+    __slots__ = ['id', 'networkId', 'type', 'groupId', 'name']
+
+    def __init__(self, id, networkId, type, groupId, name):
+        self.id = id
+        self.networkId = networkId
+        self.type = type
+        self.groupId = groupId
+        self.name = name
+
+
+    def __repr__(self):
+        return '<%s id=%r networkId=%r type=%r name=%r>' % (
+            type(self).__name__, self.id, self.networkId, self.type,
+            self.name)
+
+
+    def _key(self):
+        return self.id, self.networkId, self.type, self.groupId, self.name
+
+
+    def __hash__(self):
+        return hash(self._key())
+
+
+    def __eq__(self, other):
+        if not isinstance(other, BufferInfoRecord):
+            return NotImplemented
+        return self._key() == other._key()
+
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+
+    def toJSON(self):
+        """
+        Convert this record to a JSON-ready C{dict}.
+        """
+        return {
+            u'id': self.id,
+            u'networkId': self.networkId,
+            u'type': self.type,
+            u'groupId': self.groupId,
+            u'name': self.name}
+
+
+
+class MessageRecord(object):
+    """
+    A message.
+
+    @type flags: C{int}
+    @ivar flags: Bitmask of message flags, see
+        L{waffle.qt.quassel.messageFlags}.
+
+    @type bufferInfo: L{BufferInfoRecord}
+    """
+    __slots__ = [
+        'id', 'timestamp', 'type', 'flags', 'bufferInfo', 'sender', 'content']
+
+    def __init__(self, id, timestamp, type, flags, bufferInfo, sender,
+                 content):
+        self.id = id
+        self.timestamp = timestamp
+        self.type = type
+        self.flags = flags
+        self.bufferInfo = bufferInfo
+        self.sender = sender
+        self.content = content
+
+
+    def __repr__(self):
+        return '<%s id=%r type=%r flags=%#x bufferInfo=%r sender=%r>' % (
+            type(self).__name__, self.id, self.type, self.flags,
+            self.bufferInfo, self.sender)
+
+
+    def _key(self):
+        return (
+            self.id, self.timestamp, self.type, self.flags, self.bufferInfo,
+            self.sender, self.content)
+
+
+    def __eq__(self, other):
+        if not isinstance(other, MessageRecord):
+            return NotImplemented
+        return self._key() == other._key()
+
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+
+    def hasFlag(self, name):
+        """
+        Is the named message flag set?
+        """
+        return bool(self.flags & messageFlags[name])
+
+
+    def toJSON(self):
+        """
+        Convert this record to a JSON-ready C{dict}, with its flags expanded to
+        a C{dict} of flag names to C{bool}s.
+        """
+        flags = self.flags
+        return {
+            u'id': self.id,
+            u'timestamp': self.timestamp,
+            u'type': self.type,
+            u'flags': dict(
+                (name, bool(flags & value))
+                for name, value in _messageFlagItems),
+            u'bufferInfo': self.bufferInfo.toJSON(),
+            u'sender': self.sender,
+            u'content': self.content}
+
+
+
+_messageFlagItems = messageFlags.items()
+_messageTypeNames = dict((v, k) for k, v in messageTypes.iteritems())
+
+
+
+class MessageBatch(Sequence):
+    """
+    Column-oriented sequence of messages.
+
+    Message ids, timestamps, types and flags are stored in arrays; buffer
+    infos and senders in tables indexed by arrays, and contents in a list.
+    Indexing a batch produces L{MessageRecord}s.
+
+    @type bufferInfos: C{list} of L{BufferInfoRecord}
+    @ivar bufferInfos: Distinct buffer infos, indexed by C{buffers}.
+
+    @type senderTable: C{list} of C{str}
+    @ivar senderTable: Distinct senders, indexed by C{senders}.
+    """
+    _columns = [
+        'ids', 'timestamps', 'types', 'flags', 'buffers', 'senders',
+        'contents']
+
+    def __init__(self):
+        self.ids = array('i')
+        self.timestamps = array('I')
+        self.types = array('I')
+        self.flags = array('B')
+        self.buffers = array('I')
+        self.senders = array('I')
+        self.contents = []
+        self.bufferInfos = []
+        self.senderTable = []
+        self._bufferIndex = {}
+        self._senderIndex = {}
+
+
+    def __repr__(self):
+        return '<%s messages=%d buffers=%d>' % (
+            type(self).__name__, len(self), len(self.bufferInfos))
 
 
     @classmethod
-    def parse(cls, value):
-        return dict((key, value[key]) for key in cls._fields)
+    def fromRecords(cls, records):
+        """
+        Create a batch from L{MessageRecord}s.
+        """
+        batch = cls()
+        batch.extend(records)
+        return batch
+
+
+    def extend(self, records):
+        """
+        Append L{MessageRecord}s.
+        """
+        for record in records:
+            self.append(
+                record.id, record.timestamp, messageTypes[record.type],
+                record.flags, record.bufferInfo, record.sender,
+                record.content)
+
+
+    def append(self, id, timestamp, type, flags, bufferInfo, sender,
+               content):
+        """
+        Append a message.
+
+        @param type: Message type, as an C{int}.
+        """
+        bufferIndex = self._bufferIndex.get(bufferInfo)
+        if bufferIndex is None:
+            bufferIndex = self._bufferIndex[bufferInfo] = len(
+                self.bufferInfos)
+            self.bufferInfos.append(bufferInfo)
+        senderIndex = self._senderIndex.get(sender)
+        if senderIndex is None:
+            senderIndex = self._senderIndex[sender] = len(self.senderTable)
+            self.senderTable.append(sender)
+        self.ids.append(id)
+        self.timestamps.append(timestamp)
+        self.types.append(type)
+        self.flags.append(flags)
+        self.buffers.append(bufferIndex)
+        self.senders.append(senderIndex)
+        self.contents.append(content)
+
+
+    def __len__(self):
+        return len(self.ids)
+
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.take(xrange(*i.indices(len(self))))
+        return MessageRecord(
+            self.ids[i],
+            self.timestamps[i],
+            _messageTypeNames[self.types[i]],
+            self.flags[i],
+            self.bufferInfos[self.buffers[i]],
+            self.senderTable[self.senders[i]],
+            self.contents[i])
+
+
+    def __eq__(self, other):
+        if not isinstance(other, Sequence):
+            return NotImplemented
+        return len(self) == len(other) and list(self) == list(other)
 
 
-    def serialize(self):
-        return Container(**self._value)
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+
+    def take(self, indices):
+        """
+        Create a new batch from the messages at C{indices}, in that order.
+        """
+        batch = type(self)()
+        batch.bufferInfos = list(self.bufferInfos)
+        batch.senderTable = list(self.senderTable)
+        batch._bufferIndex = dict(self._bufferIndex)
+        batch._senderIndex = dict(self._senderIndex)
+        for name in self._columns:
+            column = getattr(self, name)
+            getattr(batch, name).extend(column[i] for i in indices)
+        return batch
+
+
+    def _reorder(self, indices):
+        """
+        Rearrange the messages in place to those at C{indices}.
+        """
+        batch = self.take(indices)
+        for name in self._columns:
+            setattr(self, name, getattr(batch, name))
+
+
+    def reverse(self):
+        """
+        Reverse the messages in place.
+        """
+        for name in self._columns:
+            getattr(self, name).reverse()
+
+
+    def sort(self):
+        """
+        Sort the messages in place, by message id.
+        """
+        ids = self.ids
+        self._reorder(sorted(xrange(len(ids)), key=ids.__getitem__))
+
+
+    def dedupe(self):
+        """
+        Remove, in place, all but the first message with each message id.
+        """
+        seen = set()
+        indices = []
+        for i, id in enumerate(self.ids):
+            if id not in seen:
+                seen.add(id)
+                indices.append(i)
+        if len(indices) != len(self):
+            self._reorder(indices)
+
+
+    def toJSON(self):
+        """
+        Convert this batch to a JSON-ready C{list} of C{dict}s, in the same
+        form as L{MessageRecord.toJSON}.
+        """
+        bufferInfos = [bufferInfo.toJSON() for bufferInfo in self.bufferInfos]
+        senderTable = self.senderTable
+        flagsCache = {}
+        result = []
+        for id, timestamp, messageType, flags, buffer, sender, content in izip(
+                self.ids, self.timestamps, self.types, self.flags,
+                self.buffers, self.senders, self.contents):
+            flagsJSON = flagsCache.get(flags)
+            if flagsJSON is None:
+                flagsJSON = flagsCache[flags] = dict(
+                    (name, bool(flags & value))
+                    for name, value in _messageFlagItems)
+            result.append({
+                u'id': id,
+                u'timestamp': timestamp,
+                u'type': _messageTypeNames[messageType],
+                u'flags': flagsJSON,
+                u'bufferInfo': bufferInfos[buffer],
+                u'sender': senderTable[sender],
+                u'content': content})
+        return result
 
 
-class FlagsContainer(_WrappedValue):
+
+class BufferInfo(_WrappedValue):
     @classmethod
-    def parse(self, value):
-        value = dict(value)
-        value.pop('__recursion_lock__', None)
-        return value
+    def parse(cls, value):
+        return BufferInfoRecord(
+            value['id'], value['networkId'], value['type'], value['groupId'],
+            value['name'])
 
 
+    def serialize(self):
+        return Container(**self._value)
 
-class MessageInfo(_WrappedValue):
-    _fields = [
-        'id', 'timestamp', 'type', 'flags', 'bufferInfo', 'sender', 'content']
 
 
+class MessageInfo(_WrappedValue):
     @classmethod
     def parse(cls, value):
-        result = dict((key, value[key]) for key in cls._fields)
-        result['bufferInfo'] = BufferInfo.parse(result['bufferInfo'])
-        result['flags'] = FlagsContainer.parse(result['flags'])
-        return result
+        flags = value['flags']
+        return MessageRecord(
+            value['id'],
+            value['timestamp'],
+            value['type'],
+            sum(bit for name, bit in _messageFlagItems
+                if getattr(flags, name)),
+            BufferInfo.parse(value['bufferInfo']),
+            value['sender'],
+            value['content'])
 
 
     def serialize(self):
@@ -395,9 +818,9 @@ types = {
     'QDateTime': QDateTime,
     'UserType': UserType,
     #'Long': Long,
-    #'Short': Short,
     #'Char': Char,
     #'ULong': ULong,
+    'Short': Short,
     'UShort': UShort,
     #'UChar': UChar,
     #'Float': Float,
@@ -0,0 +1,1592 @@
+"""
+Direct Qt DataStream codec.
+
+Reads serialized C{QVariant}s straight into the Python values produced by
+L{waffle.qt.adapters}, and writes L{waffle.qt.adapters} values straight into
+serialized C{QVariant}s, without building an intermediate tree of Construct
+C{Container}s.
+
+@see: U{http://doc.qt.nokia.com/4.7/datastreamformat.html}
+"""
+import struct
+from array import array
+from collections import Mapping, Sequence
+from cStringIO import StringIO
+
+from construct import (
+    Adapter, Container, ConstructError, FormatField, LengthValueAdapter,
+    Reconfig, Sequence as SequenceSchema, StringAdapter, Struct)
+
+from waffle.qt import adapters, quassel, types
+from waffle.qt.quassel import bufferTypes, messageTypes
+
+
+
+class DecodeError(ValueError):
+    """
+    Serialized data could not be decoded.
+    """
+
+
+
+class EncodeError(ValueError):
+    """
+    A value could not be encoded.
+    """
+
+
+
+_NULL_LENGTH = 0xFFFFFFFF
+
+_uint8 = struct.Struct('>B')
+_int8 = struct.Struct('>b')
+_uint16 = struct.Struct('>H')
+_int16 = struct.Struct('>h')
+_uint32 = struct.Struct('>I')
+_int32 = struct.Struct('>i')
+_uint64 = struct.Struct('>Q')
+_int64 = struct.Struct('>q')
+_float32 = struct.Struct('>f')
+_float64 = struct.Struct('>d')
+_qvariantHeader = struct.Struct('>IB')
+_qvariantListHeader = struct.Struct('>IBI')
+_dateTime = struct.Struct('>IIB')
+_bufferInfoHeader = struct.Struct('>iihI')
+_messageInfoHeader = struct.Struct('>iIIB')
+
+_QVARIANTMAP = types.qvariantTypes['QVariantMap']
+_QVARIANTLIST = types.qvariantTypes['QVariantList']
+_USERTYPE = types.qvariantTypes['UserType']
+_QSTRING = types.qvariantTypes['QString']
+
+# Prefixes of a serialized Message UserType, either side of the isNull flag.
+_userTypeId = _uint32.pack(_USERTYPE)
+_messageTypeName = _uint32.pack(8) + 'Message\x00'
+
+
+_bufferTypeNames = dict((v, k) for k, v in bufferTypes.iteritems())
+_messageTypeNames = dict((v, k) for k, v in messageTypes.iteritems())
+
+
+
+def _readFixed(fmt, convert=None):
+    """
+    Create a reader for a fixed-size value.
+    """
+    unpack_from = fmt.unpack_from
+    size = fmt.size
+    if convert is None:
+        def _read(data, offset):
+            return unpack_from(data, offset)[0], offset + size
+    else:
+        def _read(data, offset):
+            return convert(unpack_from(data, offset)[0]), offset + size
+    return _read
+
+
+
+def _readBool(data, offset):
+    return _uint8.unpack_from(data, offset)[0] == 1, offset + 1
+
+
+
+def _readBytes(data, offset, nullable=True):
+    """
+    Read a length-prefixed byte string.
+
+    @param nullable: Treat a length of C{0xFFFFFFFF} as an empty value.
+    """
+    length, = _uint32.unpack_from(data, offset)
+    offset += 4
+    if nullable and length == _NULL_LENGTH:
+        return '', offset
+    end = offset + length
+    if end > len(data):
+        raise DecodeError(
+            'Expected %d bytes at offset %d, only %d available' % (
+                length, offset, len(data) - offset))
+    value = data[offset:end]
+    if type(value) is memoryview:
+        value = value.tobytes()
+    return value, end
+
+
+
+def _isMessage(data, offset):
+    """
+    Is the C{QVariant} at C{offset} a C{Message} UserType?
+    """
+    return (data[offset:offset + 4] == _userTypeId and
+            data[offset + 5:offset + 17] == _messageTypeName)
+
+
+
+def _skipFixed(size):
+    """
+    Create a skipper for a fixed-size value.
+    """
+    def _skip(data, offset):
+        return offset + size
+    return _skip
+
+
+
+def _skipBytes(data, offset):
+    """
+    Skip a length-prefixed byte string.
+    """
+    length, = _uint32.unpack_from(data, offset)
+    if length == _NULL_LENGTH:
+        return offset + 4
+    return offset + 4 + length
+
+
+
+class InternTable(object):
+    """
+    Bounded table of decoded values keyed on their serialized bytes.
+
+    Repeated values skip decoding and share a single object. The table holds
+    two generations of at most L{maxSize} entries each: when the current
+    generation fills up it replaces the previous one, and entries found in the
+    previous generation are promoted, which approximates LRU eviction.
+
+    @type maxSize: C{int}
+    @ivar maxSize: Maximum number of entries in a generation.
+
+    @type maxLength: C{int}
+    @ivar maxLength: Serialized values longer than this are never interned.
+
+    @type hits: C{int}
+    @ivar hits: Number of lookups that found an interned value.
+
+    @type misses: C{int}
+    @ivar misses: Number of lookups that had to decode the value.
+    """
+    def __init__(self, maxSize=4096, maxLength=128):
+        self.maxSize = maxSize
+        self.maxLength = maxLength
+        self.hits = 0
+        self.misses = 0
+        self._current = {}
+        self._previous = {}
+
+
+    def __len__(self):
+        return len(self._current) + len(self._previous)
+
+
+    def intern(self, raw, decode=None):
+        """
+        Find the interned value for C{raw}, decoding and interning it if there
+        is none.
+
+        @type  raw: C{str}
+        @param raw: Serialized value.
+
+        @param decode: Callable to decode C{raw} with, or C{None} to intern
+            C{raw} itself.
+        """
+        if len(raw) > self.maxLength:
+            if decode is None:
+                return raw
+            return decode(raw)
+
+        value = self._current.get(raw)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        value = self._previous.get(raw)
+        if value is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            value = raw if decode is None else decode(raw)
+
+        if len(self._current) >= self.maxSize:
+            self._previous = self._current
+            self._current = {}
+        self._current[raw] = value
+        return value
+
+
+    def stats(self):
+        """
+        Summarise the effectiveness of the table.
+
+        @rtype: C{dict}
+        """
+        lookups = self.hits + self.misses
+        return dict(
+            size=len(self),
+            hits=self.hits,
+            misses=self.misses,
+            hitRate=float(self.hits) / lookups if lookups else 0.0)
+
+
+
+def _decodeUTF16(raw):
+    return raw.decode('utf-16be')
+
+
+
+# Adapters whose parse is the identity, their compiled values need no
+# adapting.
+_identityAdapters = frozenset([
+    adapters.Int, adapters.UInt, adapters.UShort, adapters.Bool,
+    adapters.QString, adapters.QByteArray])
+
+
+
+def _unwrapSchema(schema):
+    """
+    Strip any renames from a Construct schema.
+    """
+    while isinstance(schema, Reconfig):
+        schema = schema.subcon
+    return schema
+
+
+
+def _isQVariantMapSchema(schema):
+    """
+    Is a Construct schema a L{waffle.qt.types.Map} of C{QString}s to
+    C{QVariant}s?
+    """
+    if schema is types.QVariantMap:
+        return True
+    try:
+        sequence = _unwrapSchema(schema.subcons[0]).subcon
+        item = sequence.subcons[1].subcon
+        key, value = [_unwrapSchema(sc) for sc in item.subcons]
+    except (AttributeError, IndexError, ValueError):
+        return False
+    return (
+        isinstance(schema, Struct) and schema.name == 'Map' and
+        key is types.String and value is types.QVariant)
+
+
+
+def _pascalStringSchema(schema):
+    """
+    Get the length field, and whether a length of C{0xFFFFFFFF} indicates a
+    null value, of a C{PascalString} Construct schema.
+
+    @return: C{(packer, nullable)}, or C{None} if C{schema} is not a
+        C{PascalString}.
+    """
+    if not (isinstance(schema, StringAdapter) and
+            isinstance(schema.subcon, LengthValueAdapter)):
+        return None
+    lengthField = schema.subcon.subcon.subcons[0]
+    nullable = isinstance(lengthField, types.NullLengthAdapter)
+    if nullable:
+        lengthField = lengthField.subcon
+    lengthField = _unwrapSchema(lengthField)
+    if not isinstance(lengthField, FormatField):
+        return None
+    return struct.Struct(lengthField.packer.format), nullable
+
+
+
+def _compileFixed(schema):
+    """
+    Compile a fixed-size field, optionally wrapped in an C{Adapter}, such as
+    C{Enum} or C{FlagsEnum}.
+
+    @return: C{(format, decode)}, or C{None} if C{schema} is not a fixed-size
+        field.
+    """
+    schema = _unwrapSchema(schema)
+    if isinstance(schema, FormatField):
+        # Drop the byte order, fields are coalesced into big-endian structs.
+        return schema.packer.format[1:], None
+    if isinstance(schema, Adapter):
+        inner = _compileFixed(schema.subcon)
+        if inner is not None and inner[1] is None:
+            return inner[0], lambda value: schema._decode(value, Container())
+    return None
+
+
+
+def _compileVariable(schema):
+    """
+    Compile a variable-size Construct schema.
+
+    @return: C{(build, adapted)}. C{build} is called with a L{QVariantDecoder}
+        and returns a C{(reader, skipper)} pair, C{adapted} is C{True} if the
+        reader produces L{waffle.qt.adapters} values rather than Construct
+        values.
+    """
+    schema = _unwrapSchema(schema)
+    if schema is types.String:
+        return lambda decoder: (decoder.readString, _skipBytes), True
+    elif schema is types.ByteArray:
+        return lambda decoder: (decoder.readByteArray, _skipBytes), True
+    elif schema is types.QVariant:
+        return lambda decoder: (
+            decoder.readQVariant, decoder.skipQVariant), True
+    elif _isQVariantMapSchema(schema):
+        return lambda decoder: (
+            decoder.readQVariantMap, decoder.skipQVariantMap), True
+    elif isinstance(schema, Struct) and not isinstance(schema, SequenceSchema):
+        return _compileStruct(schema), False
+
+    pascalString = _pascalStringSchema(schema)
+    if pascalString is not None:
+        return _compilePascalString(schema.encoding, *pascalString), False
+    return _compileConstruct(schema), False
+
+
+
+def _compilePascalString(encoding, length, nullable):
+    null = 2 ** (length.size * 8) - 1 if nullable else None
+
+    def _read(data, offset):
+        size, = length.unpack_from(data, offset)
+        offset += length.size
+        if size == null:
+            value = ''
+        else:
+            value = data[offset:offset + size]
+            if type(value) is memoryview:
+                value = value.tobytes()
+            offset += size
+        if encoding is not None:
+            value = value.decode(encoding)
+        return value, offset
+
+    def _skip(data, offset):
+        return _read(data, offset)[1]
+
+    return lambda decoder: (_read, _skip)
+
+
+
+def _compileStruct(schema):
+    """
+    Compile a C{Struct}, reading each run of fixed-size fields with a single
+    C{struct} call.
+    """
+    # Each step is either (struct, names, decoders) for a run of fixed-size
+    # fields, or (None, name, build) for a variable-size field.
+    steps = []
+    names, formats, decoders = [], [], []
+
+    def _flush():
+        if names:
+            steps.append((
+                struct.Struct('>' + ''.join(formats)), names[:], decoders[:]))
+            del names[:], formats[:], decoders[:]
+
+    for subcon in schema.subcons:
+        fixed = _compileFixed(subcon)
+        if fixed is not None:
+            names.append(subcon.name)
+            formats.append(fixed[0])
+            decoders.append(fixed[1])
+        else:
+            _flush()
+            steps.append((None, subcon.name, _compileVariable(subcon)[0]))
+    _flush()
+
+    def _build(decoder):
+        program = []
+        for fmt, name, step in steps:
+            if fmt is None:
+                # A variable-size field and the builder for it.
+                program.append((None, name, step(decoder)))
+            else:
+                # A run of fixed-size fields and their decoders.
+                program.append((fmt, None, zip(name, step)))
+
+        def _read(data, offset):
+            result = Container()
+            for fmt, name, step in program:
+                if fmt is None:
+                    value, offset = step[0](data, offset)
+                    setattr(result, name, value)
+                else:
+                    values = fmt.unpack_from(data, offset)
+                    offset += fmt.size
+                    for (fieldName, decode), value in zip(step, values):
+                        if decode is not None:
+                            value = decode(value)
+                        setattr(result, fieldName, value)
+            return result, offset
+
+        def _skip(data, offset):
+            for fmt, name, step in program:
+                if fmt is None:
+                    offset = step[1](data, offset)
+                else:
+                    offset += fmt.size
+            return offset
+
+        return _read, _skip
+    return _build
+
+
+
+def _compileConstruct(schema):
+    """
+    Fall back to parsing a schema, that cannot otherwise be compiled, with
+    Construct.
+    """
+    def _read(data, offset):
+        if type(data) is memoryview:
+            stream = StringIO(data[offset:].tobytes())
+        else:
+            stream = StringIO(buffer(data, offset))
+        try:
+            value = schema._parse(stream, Container())
+        except ConstructError, e:
+            raise DecodeError(str(e))
+        return value, offset + stream.tell()
+
+    def _skip(data, offset):
+        return _read(data, offset)[1]
+
+    return lambda decoder: (_read, _skip)
+
+
+
+def _compileUserType(name, schema):
+    """
+    Compile a UserType schema, adapting its values with the matching
+    L{waffle.qt.adapters.userTypes} adapter.
+
+    @return: Callable taking a L{QVariantDecoder} and returning a C{(reader,
+        skipper)} pair.
+    """
+    fixed = _compileFixed(schema)
+    if fixed is not None:
+        fmt, decode = fixed
+        fmt = struct.Struct('>' + fmt)
+        build = lambda decoder: (
+            _readFixed(fmt, decode), _skipFixed(fmt.size))
+        adapted = False
+    else:
+        build, adapted = _compileVariable(schema)
+
+    adapter = adapters.userTypes.get(name)
+    if adapted or adapter is None or adapter in _identityAdapters:
+        return build
+
+    def _build(decoder):
+        read, skip = build(decoder)
+        parse = adapter.parse
+        def _read(data, offset):
+            value, offset = read(data, offset)
+            return parse(value), offset
+        return _read, skip
+    return _build
+
+
+
+_compiledUserTypes = {}
+
+def compileUserTypes():
+    """
+    Compile every UserType registered with
+    L{waffle.qt.types.registerUserType}.
+
+    Schemas are compiled once, the first time they are seen.
+
+    @rtype: C{dict}
+    @return: Mapping of UserType names to callables taking a
+        L{QVariantDecoder} and returning a C{(reader, skipper)} pair.
+    """
+    result = {}
+    for name, schema in types.getUserTypes().iteritems():
+        compiled = _compiledUserTypes.get(name)
+        if compiled is None or compiled[0] is not schema:
+            compiled = _compiledUserTypes[name] = (
+                schema, _compileUserType(name, schema))
+        result[name] = compiled[1]
+    return result
+
+
+
+class QVariantDecoder(object):
+    """
+    Single-pass C{QVariant} decoder.
+
+    Produces the same values as L{ConstructDecoder} with a single walk over
+    the serialized data. Types that L{waffle.qt.adapters} has no adapter for
+    (C{LongLong}, C{Double}, C{Float}, etc.) are decoded to their natural
+    Python values.
+
+    Short strings and byte arrays, such as nicknames, map keys and sync
+    function names, are shared through per-decoder L{InternTable}s.
+
+    @type strings: L{InternTable}
+    @ivar strings: Interned C{QString}s.
+
+    @type byteArrays: L{InternTable}
+    @ivar byteArrays: Interned C{QByteArray}s, buffer names and message
+        senders.
+
+    @type maxBufferInfos: C{int}
+    @ivar maxBufferInfos: Maximum number of distinct
+        L{waffle.qt.adapters.BufferInfoRecord}s to share between decoded
+        messages.
+    """
+    maxBufferInfos = 4096
+
+    def __init__(self, strings=None, byteArrays=None):
+        if strings is None:
+            strings = InternTable()
+        if byteArrays is None:
+            byteArrays = InternTable()
+        self.strings = strings
+        self.byteArrays = byteArrays
+        self._bufferInfos = {}
+
+        self._readers = {
+            types.qvariantTypes['Bool']: _readBool,
+            types.qvariantTypes['Int']: _readFixed(_int32),
+            types.qvariantTypes['UInt']: _readFixed(_uint32),
+            types.qvariantTypes['LongLong']: _readFixed(_int64),
+            types.qvariantTypes['ULongLong']: _readFixed(_uint64),
+            types.qvariantTypes['Double']: _readFixed(_float64),
+            types.qvariantTypes['QChar']: _readFixed(_uint16, unichr),
+            types.qvariantTypes['QVariantMap']: self.readQVariantMap,
+            types.qvariantTypes['QVariantList']: self.readQVariantList,
+            types.qvariantTypes['QString']: self.readString,
+            types.qvariantTypes['QStringList']: self.readStringList,
+            types.qvariantTypes['QByteArray']: self.readByteArray,
+            types.qvariantTypes['QDate']: _readFixed(
+                _uint32, adapters.QDate.parse),
+            types.qvariantTypes['QTime']: _readFixed(
+                _uint32, adapters.QTime.parse),
+            types.qvariantTypes['QDateTime']: self.readDateTime,
+            types.qvariantTypes['UserType']: self.readUserType,
+            types.qvariantTypes['Long']: _readFixed(_int32),
+            types.qvariantTypes['Short']: _readFixed(_int16),
+            types.qvariantTypes['Char']: _readFixed(_int8),
+            types.qvariantTypes['ULong']: _readFixed(_uint32),
+            types.qvariantTypes['UShort']: _readFixed(_uint16),
+            types.qvariantTypes['UChar']: _readFixed(_uint8),
+            types.qvariantTypes['Float']: _readFixed(_float32),
+        }
+
+        self._userTypeReaders = {}
+        self._userTypeSkippers = {}
+        for name, build in compileUserTypes().iteritems():
+            reader, skipper = build(self)
+            self._userTypeReaders[name] = reader
+            self._userTypeSkippers[name] = skipper
+        # Buffer infos are shared between messages, and interned, by these
+        # rather than the compiled readers.
+        self._userTypeReaders['BufferInfo'] = self.readBufferInfo
+        self._userTypeReaders['Message'] = self.readMessageInfo
+
+        self._fixedSizes = {
+            types.qvariantTypes['Bool']: 1,
+            types.qvariantTypes['Int']: 4,
+            types.qvariantTypes['UInt']: 4,
+            types.qvariantTypes['LongLong']: 8,
+            types.qvariantTypes['ULongLong']: 8,
+            types.qvariantTypes['Double']: 8,
+            types.qvariantTypes['QChar']: 2,
+            types.qvariantTypes['QDate']: 4,
+            types.qvariantTypes['QTime']: 4,
+            types.qvariantTypes['QDateTime']: _dateTime.size,
+            types.qvariantTypes['Long']: 4,
+            types.qvariantTypes['Short']: 2,
+            types.qvariantTypes['Char']: 1,
+            types.qvariantTypes['ULong']: 4,
+            types.qvariantTypes['UShort']: 2,
+            types.qvariantTypes['UChar']: 1,
+            types.qvariantTypes['Float']: 4,
+        }
+
+        self._skippers = {
+            types.qvariantTypes['QVariantMap']: self.skipQVariantMap,
+            types.qvariantTypes['QVariantList']: self.skipQVariantList,
+            types.qvariantTypes['QString']: _skipBytes,
+            types.qvariantTypes['QStringList']: self.skipStringList,
+            types.qvariantTypes['QByteArray']: _skipBytes,
+            types.qvariantTypes['UserType']: self.skipUserType,
+        }
+
+
+    def decode(self, data):
+        """
+        Decode a serialized C{QVariant}.
+
+        @type  data: C{str}
+
+        @raise DecodeError: If C{data} is truncated or contains an unsupported
+            type.
+        """
+        try:
+            value, offset = self.readQVariant(data, 0)
+        except struct.error, e:
+            raise DecodeError(str(e))
+        return value
+
+
+    def readQVariant(self, data, offset):
+        """
+        Read a C{QVariant}.
+
+        @return: C{(value, offset)} where C{offset} is the offset of the first
+            byte after the C{QVariant}.
+        """
+        typeId, isNull = _qvariantHeader.unpack_from(data, offset)
+        reader = self._readers.get(typeId)
+        if reader is None:
+            raise DecodeError(
+                'Unsupported QVariant type %d at offset %d' % (typeId, offset))
+        return reader(data, offset + 5)
+
+
+    def readString(self, data, offset):
+        value, offset = _readBytes(data, offset)
+        return self.strings.intern(value, _decodeUTF16), offset
+
+
+    def readByteArray(self, data, offset):
+        value, offset = _readBytes(data, offset)
+        return self.byteArrays.intern(value), offset
+
+
+    def internStats(self):
+        """
+        Summarise the effectiveness of the intern tables.
+
+        @rtype: C{dict}
+        @return: Mapping of C{'strings'} and C{'byteArrays'} to
+            L{InternTable.stats}.
+        """
+        return dict(
+            strings=self.strings.stats(),
+            byteArrays=self.byteArrays.stats())
+
+
+    def readStringList(self, data, offset):
+        size, = _uint32.unpack_from(data, offset)
+        offset += 4
+        readString = self.readString
+        result = []
+        append = result.append
+        for i in xrange(size):
+            value, offset = readString(data, offset)
+            append(value)
+        return result, offset
+
+
+    def readQVariantMap(self, data, offset):
+        size, = _uint32.unpack_from(data, offset)
+        offset += 4
+        readString = self.readString
+        readQVariant = self.readQVariant
+        result = {}
+        for i in xrange(size):
+            key, offset = readString(data, offset)
+            result[key], offset = readQVariant(data, offset)
+        return result, offset
+
+
+    def readQVariantList(self, data, offset):
+        size, = _uint32.unpack_from(data, offset)
+        offset += 4
+        if size and _isMessage(data, offset):
+            batch, end = self.readMessageBatch(data, offset, size)
+            if batch is not None:
+                return batch, end
+        readQVariant = self.readQVariant
+        result = []
+        append = result.append
+        for i in xrange(size):
+            value, offset = readQVariant(data, offset)
+            append(value)
+        return result, offset
+
+
+    def readDateTime(self, data, offset):
+        date, time, isUTC = _dateTime.unpack_from(data, offset)
+        value = adapters.getTimestampFromDateTime(date, time, isUTC == 1)
+        if value is None:
+            value = adapters.QDateTime.parse(
+                dict(date=date, time=time, isUTC=isUTC == 1))
+        return value, offset + _dateTime.size
+
+
+    def readUserType(self, data, offset):
+        name, offset = _readBytes(data, offset, nullable=False)
+        # Strip the C string terminator.
+        name = name[:-1]
+        reader = self._userTypeReaders.get(name)
+        if reader is None:
+            raise DecodeError('Unknown UserType %r' % (name,))
+        return reader(data, offset)
+
+
+    def readBufferInfo(self, data, offset):
+        header = _bufferInfoHeader.unpack_from(data, offset)
+        name, offset = _readBytes(
+            data, offset + _bufferInfoHeader.size, nullable=False)
+        key = header + (name,)
+        bufferInfo = self._bufferInfos.get(key)
+        if bufferInfo is None:
+            id, networkId, bufferType, groupId = header
+            try:
+                bufferType = _bufferTypeNames[bufferType]
+            except KeyError:
+                raise DecodeError('Unknown buffer type %r' % (bufferType,))
+            if len(self._bufferInfos) >= self.maxBufferInfos:
+                self._bufferInfos.clear()
+            bufferInfo = self._bufferInfos[key] = adapters.BufferInfoRecord(
+                id, networkId, bufferType, groupId,
+                self.byteArrays.intern(name))
+        return bufferInfo, offset
+
+
+    def readMessageInfo(self, data, offset):
+        id, timestamp, messageType, flags = _messageInfoHeader.unpack_from(
+            data, offset)
+        bufferInfo, offset = self.readBufferInfo(
+            data, offset + _messageInfoHeader.size)
+        sender, offset = self.readByteArray(data, offset)
+        content, offset = _readBytes(data, offset)
+        try:
+            messageType = _messageTypeNames[messageType]
+        except KeyError:
+            raise DecodeError('Unknown message type %r' % (messageType,))
+        return adapters.MessageRecord(
+            id, timestamp, messageType, flags, bufferInfo, sender,
+            content), offset
+
+
+    def readMessageBatch(self, data, offset, size):
+        """
+        Read C{size} C{Message} UserTypes into a
+        L{waffle.qt.adapters.MessageBatch}.
+
+        @return: C{(batch, offset)}, C{batch} is C{None} if not every value is
+            a C{Message}.
+        """
+        batch = adapters.MessageBatch()
+        append = batch.append
+        readBufferInfo = self.readBufferInfo
+        readByteArray = self.readByteArray
+        unpack_from = _messageInfoHeader.unpack_from
+        headerSize = _messageInfoHeader.size
+        for i in xrange(size):
+            if not _isMessage(data, offset):
+                return None, offset
+            offset += 17
+            id, timestamp, messageType, flags = unpack_from(data, offset)
+            if messageType not in _messageTypeNames:
+                raise DecodeError('Unknown message type %r' % (messageType,))
+            bufferInfo, offset = readBufferInfo(data, offset + headerSize)
+            sender, offset = readByteArray(data, offset)
+            content, offset = _readBytes(data, offset)
+            append(
+                id, timestamp, messageType, flags, bufferInfo, sender, content)
+        return batch, offset
+
+
+    def decodeLazy(self, data, ends=None, indexes=None):
+        """
+        Decode a serialized C{QVariant}, deferring the decoding of maps and
+        lists until they are accessed.
+
+        The data is kept in a C{memoryview}, shared by every lazy value
+        decoded from it. If the top-level value is a C{QVariantList} then the
+        list itself is decoded, with lazy maps and lists as its elements.
+
+        @type  ends: C{dict}
+        @param ends: Mapping of container offsets to their end offsets,
+            already known, such as those found by L{IncrementalLazyDecoder}.
+
+        @type  indexes: C{dict}
+        @param indexes: Mapping of map offsets to the offsets of their values,
+            keyed by key, already known.
+
+        @see: L{LazyQVariantMap}, L{LazyQVariantList}
+        """
+        data = memoryview(data)
+        if ends is None:
+            ends = {}
+        try:
+            typeId, isNull = _qvariantHeader.unpack_from(data, 0)
+            if typeId != _QVARIANTLIST:
+                return self.readLazyQVariant(data, 0, ends, indexes)
+            return list(LazyQVariantList(self, data, 5, ends, indexes))
+        except struct.error, e:
+            raise DecodeError(str(e))
+
+
+    def readLazyQVariant(self, data, offset, ends, indexes=None):
+        """
+        Read a C{QVariant}, returning maps and lists as lazy values.
+
+        @type  ends: C{dict}
+        @param ends: Mapping of container offsets to their end offsets, shared
+            by all lazy values decoded from C{data}.
+
+        @type  indexes: C{dict}
+        @param indexes: Mapping of map offsets to their already known indexes,
+            or C{None}.
+        """
+        typeId, isNull = _qvariantHeader.unpack_from(data, offset)
+        contentOffset = offset + 5
+        if typeId == _QVARIANTMAP:
+            return LazyQVariantMap(self, data, contentOffset, ends, indexes)
+        elif typeId == _QVARIANTLIST:
+            return LazyQVariantList(self, data, contentOffset, ends, indexes)
+        elif typeId == _USERTYPE:
+            name, userOffset = _readBytes(data, contentOffset, nullable=False)
+            if self._userTypeReaders.get(name[:-1]) == self.readQVariantMap:
+                return LazyQVariantMap(self, data, userOffset, ends, indexes)
+        return self.readQVariant(data, offset)[0]
+
+
+    def skipQVariant(self, data, offset, ends=None):
+        """
+        Skip over a C{QVariant} without decoding it.
+
+        @type  ends: C{dict}
+        @param ends: Optional mapping of container offsets to their end
+            offsets, consulted before skipping a C{QVariantMap} or
+            C{QVariantList} and updated for each one skipped.
+
+        @return: Offset of the first byte after the C{QVariant}.
+        """
+        typeId, isNull = _qvariantHeader.unpack_from(data, offset)
+        offset += 5
+        size = self._fixedSizes.get(typeId)
+        if size is not None:
+            return offset + size
+        elif typeId == _QSTRING:
+            length, = _uint32.unpack_from(data, offset)
+            if length == _NULL_LENGTH:
+                return offset + 4
+            return offset + 4 + length
+        elif typeId == _QVARIANTMAP or typeId == _QVARIANTLIST:
+            if ends is None:
+                return self._skippers[typeId](data, offset)
+            end = ends.get(offset)
+            if end is None:
+                end = ends[offset] = self._skippers[typeId](data, offset, ends)
+            return end
+        skipper = self._skippers.get(typeId)
+        if skipper is None:
+            raise DecodeError(
+                'Unsupported QVariant type %d at offset %d' % (
+                    typeId, offset - 5))
+        return skipper(data, offset)
+
+
+    def skipStringList(self, data, offset):
+        size, = _uint32.unpack_from(data, offset)
+        offset += 4
+        for i in xrange(size):
+            offset = _skipBytes(data, offset)
+        return offset
+
+
+    def skipQVariantMap(self, data, offset, ends=None):
+        size, = _uint32.unpack_from(data, offset)
+        offset += 4
+        unpack_from = _uint32.unpack_from
+        skipQVariant = self.skipQVariant
+        for i in xrange(size):
+            length, = unpack_from(data, offset)
+            if length == _NULL_LENGTH:
+                offset += 4
+            else:
+                offset += 4 + length
+            offset = skipQVariant(data, offset, ends)
+        return offset
+
+
+    def skipQVariantList(self, data, offset, ends=None):
+        size, = _uint32.unpack_from(data, offset)
+        offset += 4
+        skipQVariant = self.skipQVariant
+        for i in xrange(size):
+            offset = skipQVariant(data, offset, ends)
+        return offset
+
+
+    def skipUserType(self, data, offset):
+        name, offset = _readBytes(data, offset, nullable=False)
+        skipper = self._userTypeSkippers.get(name[:-1])
+        if skipper is None:
+            raise DecodeError('Unknown UserType %r' % (name[:-1],))
+        return skipper(data, offset)
+
+
+
+class LazyQVariantMap(Mapping):
+    """
+    C{QVariantMap} whose values are decoded when they are first accessed.
+
+    The offsets of the map's values are recorded, and its keys decoded, the
+    first time the map is used, unless they are already known; nested maps
+    and lists are themselves lazy. Decoded values are cached, so repeated
+    access returns the same object.
+    """
+    def __init__(self, decoder, data, offset, ends, indexes=None):
+        self._decoder = decoder
+        self._data = data
+        self._offset = offset
+        self._ends = ends
+        self._indexes = indexes
+        self._index = None
+        self._values = {}
+
+
+    def __repr__(self):
+        if self._index is None:
+            return '<%s at offset %d>' % (type(self).__name__, self._offset)
+        return '<%s at offset %d keys=%d>' % (
+            type(self).__name__, self._offset, len(self._index))
+
+
+    def _getIndex(self):
+        if self._index is None and self._indexes is not None:
+            self._index = self._indexes.get(self._offset)
+        if self._index is None:
+            data = self._data
+            readString = self._decoder.readString
+            skipQVariant = self._decoder.skipQVariant
+            size, = _uint32.unpack_from(data, self._offset)
+            offset = self._offset + 4
+            index = {}
+            for i in xrange(size):
+                key, offset = readString(data, offset)
+                index[key] = offset
+                offset = skipQVariant(data, offset, self._ends)
+            self._index = index
+        return self._index
+
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        offset = self._getIndex()[key]
+        value = self._values[key] = self._decoder.readLazyQVariant(
+            self._data, offset, self._ends, self._indexes)
+        return value
+
+
+    def __iter__(self):
+        return iter(self._getIndex())
+
+
+    def __len__(self):
+        return len(self._getIndex())
+
+
+    def materialize(self):
+        """
+        Fully decode this map.
+
+        @rtype: C{dict}
+        """
+        return dict(
+            (key, materialize(value)) for key, value in self.iteritems())
+
+
+    def toJSON(self):
+        """
+        Convert this map to a JSON-ready C{dict}, nested lazy values are
+        decoded as they are serialized.
+        """
+        return dict(self)
+
+
+
+class LazyQVariantList(Sequence):
+    """
+    C{QVariantList} whose elements are decoded when they are first accessed.
+
+    @see: L{LazyQVariantMap}
+    """
+    def __init__(self, decoder, data, offset, ends, indexes=None):
+        self._decoder = decoder
+        self._data = data
+        self._offset = offset
+        self._ends = ends
+        self._indexes = indexes
+        self._index = None
+        self._values = {}
+
+
+    def __repr__(self):
+        return '<%s at offset %d>' % (type(self).__name__, self._offset)
+
+
+    def _getIndex(self):
+        if self._index is None:
+            data = self._data
+            skipQVariant = self._decoder.skipQVariant
+            size, = _uint32.unpack_from(data, self._offset)
+            offset = self._offset + 4
+            index = array('I')
+            for i in xrange(size):
+                index.append(offset)
+                offset = skipQVariant(data, offset, self._ends)
+            self._index = index
+        return self._index
+
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in xrange(*i.indices(len(self)))]
+        index = self._getIndex()
+        if i < 0:
+            i += len(index)
+        try:
+            return self._values[i]
+        except KeyError:
+            pass
+        value = self._values[i] = self._decoder.readLazyQVariant(
+            self._data, index[i], self._ends, self._indexes)
+        return value
+
+
+    def __len__(self):
+        return len(self._getIndex())
+
+
+    def __eq__(self, other):
+        if not isinstance(other, Sequence):
+            return NotImplemented
+        return len(self) == len(other) and list(self) == list(other)
+
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+
+    def materialize(self):
+        """
+        Fully decode this list.
+
+        @rtype: C{list}
+        """
+        return [materialize(value) for value in self]
+
+
+    def toJSON(self):
+        """
+        Convert this list to a JSON-ready C{list}.
+
+        @see: L{LazyQVariantMap.toJSON}
+        """
+        return list(self)
+
+
+
+def materialize(value):
+    """
+    Fully decode a value that may be, or contain, lazy values.
+    """
+    if isinstance(value, (LazyQVariantMap, LazyQVariantList)):
+        return value.materialize()
+    return value
+
+
+
+class IncrementalDecoder(object):
+    """
+    Resumable C{QVariant} decoder.
+
+    Decodes a single serialized C{QVariant} a bounded number of elements at a
+    time, stopping and resuming at element boundaries of C{QVariantMap}s and
+    C{QVariantList}s. Anything other than a map or list is decoded in one go by
+    the underlying L{QVariantDecoder}.
+
+    @ivar result: Decoded value, once L{resume} has returned C{True}.
+    """
+    _MAP = 0
+    _LIST = 1
+
+    def __init__(self, decoder, data):
+        """
+        @type  decoder: L{QVariantDecoder}
+        @param decoder: Decoder used to read keys and non-container values.
+
+        @type  data: C{str}
+        @param data: Serialized C{QVariant}.
+        """
+        self._decoder = decoder
+        self._data = data
+        self._offset = 0
+        # Each frame is [kind, container, remaining, pendingKey].
+        self._stack = []
+        self.done = False
+        self.result = None
+
+
+    def _readValue(self):
+        """
+        Read the C{QVariant} at the current offset.
+
+        Containers are pushed onto the stack, to be filled in by subsequent
+        calls to L{resume}.
+
+        @return: C{(isComplete, value)}.
+        """
+        data = self._data
+        offset = self._offset
+        decoder = self._decoder
+        typeId, isNull = _qvariantHeader.unpack_from(data, offset)
+        offset += 5
+        if typeId == _QVARIANTMAP:
+            kind = self._MAP
+        elif typeId == _QVARIANTLIST:
+            # Lists of messages are decoded in one go, into a batch.
+            if _isMessage(data, offset + 4):
+                kind = None
+            else:
+                kind = self._LIST
+        elif typeId == _USERTYPE:
+            name, userOffset = _readBytes(data, offset, nullable=False)
+            reader = decoder._userTypeReaders.get(name[:-1])
+            if reader != decoder.readQVariantMap:
+                kind = None
+            else:
+                kind = self._MAP
+                offset = userOffset
+        else:
+            kind = None
+
+        if kind is None:
+            value, self._offset = decoder.readQVariant(data, self._offset)
+            return True, value
+
+        size, = _uint32.unpack_from(data, offset)
+        self._offset = offset + 4
+        container = {} if kind == self._MAP else []
+        self._stack.append([kind, container, size, None])
+        return False, None
+
+
+    def _deliver(self, value):
+        """
+        Store a completed value in its parent container, or as the result.
+        """
+        if not self._stack:
+            self.result = value
+            self.done = True
+            return
+        frame = self._stack[-1]
+        if frame[0] == self._MAP:
+            frame[1][frame[3]] = value
+            frame[3] = None
+        else:
+            frame[1].append(value)
+        frame[2] -= 1
+
+
+    def resume(self, count):
+        """
+        Decode up to C{count} more elements.
+
+        @raise DecodeError: If the data is truncated or contains an
+            unsupported type.
+
+        @rtype: C{bool}
+        @return: C{True} once decoding is complete.
+        """
+        try:
+            return self._resume(count)
+        except struct.error, e:
+            raise DecodeError(str(e))
+
+
+    def _resume(self, count):
+        stack = self._stack
+        readString = self._decoder.readString
+        while count > 0 and not self.done:
+            count -= 1
+            if not stack:
+                isComplete, value = self._readValue()
+                if isComplete:
+                    self._deliver(value)
+                continue
+
+            frame = stack[-1]
+            if frame[2] == 0:
+                stack.pop()
+                self._deliver(frame[1])
+                continue
+
+            if frame[0] == self._MAP:
+                frame[3], self._offset = readString(self._data, self._offset)
+            isComplete, value = self._readValue()
+            if isComplete:
+                self._deliver(value)
+        return self.done
+
+
+
+class IncrementalLazyDecoder(object):
+    """
+    Resumable lazy C{QVariant} decoder.
+
+    Walks a single serialized C{QVariant} a bounded number of elements at a
+    time, recording where each C{QVariantMap} and C{QVariantList} ends, and
+    the keys of large maps, before decoding it with
+    L{QVariantDecoder.decodeLazy}; so that neither decoding it nor accessing
+    its lazy values has to skip over all of the data in one go.
+
+    @type indexSize: C{int}
+    @ivar indexSize: Maps with at least this many entries have the offsets of
+        their values recorded while walking.
+
+    @ivar result: Decoded value, once L{resume} has returned C{True}.
+    """
+    indexSize = 64
+
+    def __init__(self, decoder, data):
+        """
+        @type  decoder: L{QVariantDecoder}
+        @param decoder: Decoder used to read keys and skip non-container
+            values.
+
+        @type  data: C{str}
+        @param data: Serialized C{QVariant}.
+        """
+        self._decoder = decoder
+        self._data = data
+        self._offset = 0
+        self._ends = {}
+        self._indexes = {}
+        # Each frame is [contentOffset, remaining, isMap, index], index is
+        # None for lists and small maps.
+        self._stack = None
+        self.done = False
+        self.result = None
+
+
+    def _enter(self):
+        """
+        Enter the C{QVariant} at the current offset, pushing maps and lists
+        onto the stack and skipping anything else.
+        """
+        data = self._data
+        offset = self._offset
+        typeId, isNull = _qvariantHeader.unpack_from(data, offset)
+        if typeId != _QVARIANTMAP and typeId != _QVARIANTLIST:
+            self._offset = self._decoder.skipQVariant(data, offset)
+            return
+        contentOffset = offset + 5
+        size, = _uint32.unpack_from(data, contentOffset)
+        isMap = typeId == _QVARIANTMAP
+        index = None
+        if isMap and size >= self.indexSize:
+            index = self._indexes[contentOffset] = {}
+        self._stack.append([contentOffset, size, isMap, index])
+        self._offset = contentOffset + 4
+
+
+    def resume(self, count):
+        """
+        Walk up to C{count} more elements.
+
+        @raise DecodeError: If the data is truncated or contains an
+            unsupported type.
+
+        @rtype: C{bool}
+        @return: C{True} once decoding is complete.
+        """
+        try:
+            return self._resume(count)
+        except struct.error, e:
+            raise DecodeError(str(e))
+
+
+    def _resume(self, count):
+        if self._stack is None:
+            self._stack = []
+            self._enter()
+        stack = self._stack
+        data = self._data
+        readString = self._decoder.readString
+        while count > 0 and stack:
+            count -= 1
+            frame = stack[-1]
+            if frame[1] == 0:
+                stack.pop()
+                self._ends[frame[0]] = self._offset
+                continue
+            frame[1] -= 1
+            if frame[3] is not None:
+                key, self._offset = readString(data, self._offset)
+                frame[3][key] = self._offset
+            elif frame[2]:
+                self._offset = _skipBytes(data, self._offset)
+            self._enter()
+        if stack:
+            return False
+        if not self.done:
+            self.result = self._decoder.decodeLazy(
+                data, self._ends, self._indexes)
+            self.done = True
+        return True
+
+
+
+def _writeFixed(fmt, convert=None):
+    """
+    Create a writer for a fixed-size value.
+    """
+    pack = fmt.pack
+    if convert is None:
+        def _write(buf, value):
+            buf += pack(value.value)
+    else:
+        def _write(buf, value):
+            buf += pack(convert(value.value))
+    return _write
+
+
+
+def _writeBool(buf, value):
+    buf += '\x01' if value.value else '\x00'
+
+
+
+def _writeBytes(buf, value):
+    buf += _uint32.pack(len(value))
+    buf += value
+
+
+
+def _writeByteArray(buf, value):
+    _writeBytes(buf, value.value)
+
+
+
+def _writeString(buf, value):
+    _writeBytes(buf, value.encode('utf-16be'))
+
+
+
+def _writeQString(buf, value):
+    _writeString(buf, value.value)
+
+
+
+def _writeQStringList(buf, value):
+    items = value.value
+    buf += _uint32.pack(len(items))
+    for item in items:
+        _writeString(buf, item.value)
+
+
+
+def _writeQChar(buf, value):
+    value = value.value
+    if isinstance(value, basestring):
+        value = ord(value)
+    buf += _uint16.pack(value)
+
+
+
+def _writeConstruct(schema):
+    """
+    Create a writer building a value with its Construct schema.
+    """
+    def _write(buf, value):
+        try:
+            buf += schema.build(value.serialize())
+        except (ConstructError, NotImplementedError), e:
+            raise EncodeError('Unable to encode %r: %s' % (value, e))
+    return _write
+
+
+
+def _writeBufferInfo(buf, value):
+    value = value.value
+    try:
+        bufferType = bufferTypes[value['type']]
+    except KeyError:
+        raise EncodeError('Unknown buffer type %r' % (value['type'],))
+    buf += _bufferInfoHeader.pack(
+        value['id'], value['networkId'], bufferType, value['groupId'])
+    name = value['name']
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    _writeBytes(buf, name)
+
+
+
+def _writeMessageInfo(buf, value):
+    value = value.value
+    try:
+        messageType = messageTypes[value.type]
+    except KeyError:
+        raise EncodeError('Unknown message type %r' % (value.type,))
+    buf += _messageInfoHeader.pack(
+        value.id, value.timestamp, messageType, value.flags)
+    _writeBufferInfo(buf, adapters.BufferInfo(value.bufferInfo.toJSON()))
+    _writeBytes(buf, value.sender)
+    _writeBytes(buf, value.content)
+
+
+
+class QVariantEncoder(object):
+    """
+    Single-pass C{QVariant} encoder.
+
+    Produces the same output as L{ConstructEncoder} by writing
+    L{waffle.qt.adapters} values directly into a C{bytearray}.
+
+    UserTypes are written as registered with
+    L{waffle.qt.types.registerUserType}, when the encoder is created; schemas
+    without a direct writer are built with Construct.
+    """
+    def __init__(self):
+        self._writers = {
+            adapters.QVariant: self.writeQVariant,
+            adapters.QVariantMap: self.writeQVariantMap,
+            adapters.QVariantList: self.writeQVariantList,
+            adapters.QStringList: _writeQStringList,
+            adapters.QByteArray: _writeByteArray,
+            adapters.QString: _writeQString,
+            adapters.QChar: _writeQChar,
+            adapters.Bool: _writeBool,
+            adapters.Int: _writeFixed(_int32),
+            adapters.UInt: _writeFixed(_uint32),
+            adapters.Short: _writeFixed(_int16),
+            adapters.UShort: _writeFixed(_uint16),
+            adapters.QTime: self.writeTime,
+            adapters.QDateTime: self.writeDateTime,
+            adapters.UserType: self.writeUserType,
+        }
+
+        writers = self._writers
+        schemaWriters = {
+            types.Bool: writers[adapters.Bool],
+            types.Int: writers[adapters.Int],
+            types.UInt: writers[adapters.UInt],
+            types.Short: writers[adapters.Short],
+            types.UShort: writers[adapters.UShort],
+            types.QChar: writers[adapters.QChar],
+            types.String: writers[adapters.QString],
+            types.StringList: writers[adapters.QStringList],
+            types.ByteArray: writers[adapters.QByteArray],
+            types.Time: writers[adapters.QTime],
+            types.DateTime: writers[adapters.QDateTime],
+            types.QVariantMap: writers[adapters.QVariantMap],
+            types.QVariantList: writers[adapters.QVariantList],
+            quassel.BufferInfo: _writeBufferInfo,
+            quassel.MessageInfo: _writeMessageInfo,
+        }
+        self._userTypeWriters = {}
+        for name, schema in types.getUserTypes().iteritems():
+            writer = schemaWriters.get(schema)
+            if writer is None:
+                writer = _writeConstruct(schema)
+            self._userTypeWriters[name] = writer
+
+
+    def encode(self, value):
+        """
+        Encode a value as a serialized C{QVariant}.
+
+        @param value: Adapter value, such as L{adapters.QVariantMap}, to wrap
+            in a C{QVariant}.
+
+        @rtype: C{str}
+        """
+        buf = bytearray()
+        self.writeQVariant(buf, adapters.QVariant(value))
+        return str(buf)
+
+
+    def _getWriter(self, value):
+        writer = self._writers.get(type(value))
+        if writer is None:
+            raise EncodeError('Unable to encode %r' % (value,))
+        return writer
+
+
+    def writeQVariant(self, buf, value):
+        value = value.value
+        writer = self._getWriter(value)
+        try:
+            typeId = types.qvariantTypes[value.typeName]
+        except (AttributeError, KeyError):
+            raise EncodeError('No QVariant type for %r' % (value,))
+        buf += _qvariantHeader.pack(typeId, 0)
+        writer(buf, value)
+
+
+    def writeQVariantMap(self, buf, value):
+        items = value.value
+        buf += _uint32.pack(len(items))
+        writeQVariant = self.writeQVariant
+        for key, value in items.iteritems():
+            _writeString(buf, key.value)
+            writeQVariant(buf, value)
+
+
+    def writeQVariantList(self, buf, value):
+        items = value.value
+        buf += _uint32.pack(len(items))
+        writeQVariant = self.writeQVariant
+        for value in items:
+            writeQVariant(buf, value)
+
+
+    def writeTime(self, buf, value):
+        buf += _uint32.pack(value.serialize())
+
+
+    def writeDateTime(self, buf, value):
+        value = value.value
+        buf += _dateTime.pack(value.date, value.time, 1 if value.isUTC else 0)
+
+
+    def writeUserType(self, buf, value):
+        writer = self._userTypeWriters.get(value.type)
+        if writer is None:
+            raise EncodeError('Unable to encode UserType %r' % (value.type,))
+        _writeBytes(buf, value.type + '\x00')
+        writer(buf, value.value)
+
+
+
+class ConstructDecoder(object):
+    """
+    C{QVariant} decoder using the Construct types and adapters.
+    """
+    def decode(self, data):
+        return adapters.QVariant.parse(types.QVariant.parse(data))
+
+
+
+class ConstructEncoder(object):
+    """
+    C{QVariant} encoder using the Construct types and adapters.
+    """
+    def encode(self, value):
+        return types.QVariant.build(adapters.QVariant(value).serialize())
+
+
+
+__all__ = [
+    'DecodeError', 'EncodeError', 'InternTable', 'compileUserTypes',
+    'QVariantDecoder', 'IncrementalDecoder', 'IncrementalLazyDecoder',
+    'LazyQVariantMap',
+    'LazyQVariantList', 'materialize', 'QVariantEncoder', 'ConstructDecoder',
+    'ConstructEncoder']
+
+
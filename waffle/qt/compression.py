@@ -0,0 +1,147 @@
+"""
+Qt compatible compression.
+
+@see: U{http://doc.qt.nokia.com/4.7/qbytearray.html#qCompress}
+"""
+import struct
+import zlib
+
+from waffle.qt.codec import DecodeError
+
+
+
+_uint32 = struct.Struct('>I')
+
+
+
+def qCompress(data, level=-1):
+    """
+    Compress data in the same way as C{qCompress}.
+
+    @rtype: C{str}
+    @return: The uncompressed length, as a big-endian C{quint32}, followed by
+        a zlib stream.
+    """
+    return _uint32.pack(len(data)) + zlib.compress(data, level)
+
+
+
+def qUncompress(data, maxLength):
+    """
+    Uncompress data compressed by C{qCompress}.
+
+    @param maxLength: Maximum permitted uncompressed length.
+
+    @raise DecodeError: If the data is invalid, or would uncompress to more
+        than C{maxLength} bytes.
+    """
+    if len(data) < 4:
+        raise DecodeError('Compressed data is too short')
+    expectedLength, = _uint32.unpack_from(data, 0)
+    if expectedLength > maxLength:
+        raise DecodeError(
+            'Compressed data claims to be %d bytes, maximum is %d' % (
+                expectedLength, maxLength))
+    decompressor = zlib.decompressobj()
+    try:
+        # Bound the output, a stream that inflates to more than it claims
+        # leaves input behind in unconsumed_tail.
+        result = decompressor.decompress(buffer(data, 4), expectedLength)
+    except zlib.error, e:
+        raise DecodeError('Invalid compressed data: %s' % (e,))
+    if len(result) != expectedLength or decompressor.unconsumed_tail:
+        raise DecodeError(
+            'Compressed data does not uncompress to %d bytes' % (
+                expectedLength,))
+    return result
+
+
+
+def compressFrame(data, level=-1):
+    """
+    Compress a frame in the manner of a legacy protocol Quassel peer: a
+    C{QByteArray} containing the C{qCompress}ed frame.
+    """
+    data = qCompress(data, level)
+    return _uint32.pack(len(data)) + data
+
+
+
+def decompressFrame(data, maxLength):
+    """
+    Decompress a frame compressed by L{compressFrame}.
+
+    @see: L{qUncompress}
+    """
+    if len(data) < 4:
+        raise DecodeError('Compressed frame is too short')
+    length, = _uint32.unpack_from(data, 0)
+    if length != len(data) - 4:
+        raise DecodeError(
+            'Compressed frame holds %d bytes, expected %d' % (
+                len(data) - 4, length))
+    return qUncompress(buffer(data, 4), maxLength)
+
+
+
+class StreamCompressor(object):
+    """
+    Compress a stream with zlib, flushing after every write so the peer can
+    decompress each write as soon as it arrives.
+    """
+    def __init__(self, level=-1):
+        self._compressor = zlib.compressobj(level)
+
+
+    def compress(self, data):
+        """
+        Compress and flush C{data}.
+
+        @rtype: C{str}
+        """
+        compressor = self._compressor
+        return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+
+class StreamDecompressor(object):
+    """
+    Decompress a stream compressed with zlib.
+
+    @type chunkSize: C{int}
+    @ivar chunkSize: Maximum size of each chunk of decompressed data, the
+        decompressed data is never held in memory all at once.
+    """
+    chunkSize = 64 * 1024
+
+    def __init__(self):
+        self._decompressor = zlib.decompressobj()
+
+
+    def decompress(self, data):
+        """
+        Decompress the next part of the stream.
+
+        @raise DecodeError: If the stream is invalid.
+
+        @return: Iterable of decompressed chunks.
+        """
+        decompressor = self._decompressor
+        chunkSize = self.chunkSize
+        while True:
+            try:
+                chunk = decompressor.decompress(data, chunkSize)
+            except zlib.error, e:
+                raise DecodeError('Invalid compressed stream: %s' % (e,))
+            data = decompressor.unconsumed_tail
+            if chunk:
+                yield chunk
+            # A full chunk may leave output pending without leaving input.
+            if not data and len(chunk) < chunkSize:
+                break
+
+
+
+__all__ = [
+    'qCompress', 'qUncompress', 'compressFrame', 'decompressFrame',
+    'StreamCompressor', 'StreamDecompressor']
@@ -107,13 +107,27 @@ UserType = Struct(
 def registerUserType(name, type):
     """
     Register a UserType.
+
+    L{waffle.qt.codec.QVariantDecoder} and L{waffle.qt.codec.QVariantEncoder}
+    instances created afterwards read and write it; decoders compile the
+    schema, with L{waffle.qt.codec.compileUserTypes}, when they are created.
     """
     _userTypeTypes[name] = type
 
 
 
-QVariantTypeEnum = Enum(
-    UBInt32('type'),
+def getUserTypes():
+    """
+    Get all registered UserTypes.
+
+    @rtype: C{dict}
+    @return: Mapping of UserType names to schemas.
+    """
+    return dict(_userTypeTypes)
+
+
+
+qvariantTypes = dict(
     Void=0,
     Bool=1,
     Int=2,
@@ -141,6 +155,8 @@ QVariantTypeEnum = Enum(
     Float=135,
     QVariant=138)
 
+QVariantTypeEnum = Enum(UBInt32('type'), **qvariantTypes)
+
 def _QVariantSwitchFunc(ctx):
     #print '*** Switching QVariant on %r' % (ctx.type,)
     return ctx.type
@@ -192,4 +208,4 @@ __all__ = [
     'Map', 'List', 'Bool', 'Short', 'Int', 'UInt', 'LongLong', 'ULongLong',
     'Double', 'Char', 'String', 'StringList', 'ByteArray', 'Date', 'Time',
     'DateTime', 'QVariant', 'UserType', 'Long', 'Short', 'Char', 'ULong',
-    'UShort', 'UChar', 'Float', 'registerUserType']
+    'UShort', 'UChar', 'Float', 'registerUserType', 'getUserTypes']
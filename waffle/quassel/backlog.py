@@ -0,0 +1,397 @@
+"""
+Backlog fetch scheduling and caching.
+"""
+import collections
+
+from twisted.python import log
+
+from waffle.qt.adapters import MessageBatch
+
+
+
+class BacklogScheduler(object):
+    """
+    Fetch backlog for a session's buffers a few at a time, most relevant
+    first.
+
+    Buffers in the buffer view are fetched in the view's order, once it is
+    known, and a focused buffer jumps the queue. Hidden buffers are only
+    fetched when focused, unless L{fetchHidden} is set.
+
+    @type maxInFlight: C{int}
+    @ivar maxInFlight: Maximum number of outstanding backlog requests.
+
+    @type limit: C{int}
+    @ivar limit: Number of messages requested per buffer.
+
+    @type requestTimeout: C{int}
+    @ivar requestTimeout: Seconds to wait for a reply before giving up on a
+        request and freeing its slot.
+
+    @type fetchHidden: C{bool}
+    @ivar fetchHidden: Also fetch backlog for buffers outside the buffer view,
+        after every visible buffer.
+
+    @type latencies: C{collections.deque} of C{float}
+    @ivar latencies: Seconds taken by the most recent requests to complete.
+
+    @type cached: C{int}
+    @ivar cached: Number of requests answered without asking the core.
+    """
+    maxInFlight = 4
+    limit = 50
+    requestTimeout = 60
+    fetchHidden = False
+
+    def __init__(self, requestBacklog, clock):
+        """
+        @type  requestBacklog: C{callable}
+        @param requestBacklog: Called with C{bufferId, startMessageId,
+            endMessageId, limit} to request backlog from the core, returning
+            C{True} if the request was answered without asking the core, in
+            which case no reply is waited for.
+
+        @type  clock: L{twisted.internet.interfaces.IReactorTime}
+        """
+        self._requestBacklog = requestBacklog
+        self._clock = clock
+        self._buffers = set()
+        self._queue = collections.deque()
+        self._requested = set()
+        self._inFlight = {}
+        self._started = False
+        self.latencies = collections.deque(maxlen=100)
+        self.completed = 0
+        self.timedOut = 0
+        self.cached = 0
+
+
+    def addBuffers(self, bufferIds):
+        """
+        Make buffers known to the scheduler, without fetching them yet.
+        """
+        self._buffers.update(bufferIds)
+
+
+    def start(self, visibleBufferIds):
+        """
+        Start fetching backlog, once the buffer view is known.
+
+        @type  visibleBufferIds: C{list} of C{int}
+        @param visibleBufferIds: Buffers in the view, in display order.
+        """
+        if self._started:
+            return
+        self._started = True
+        visible = [
+            bufferId for bufferId in visibleBufferIds
+            if bufferId in self._buffers]
+        self._queue.extend(visible)
+        if self.fetchHidden:
+            self._queue.extend(sorted(self._buffers.difference(visible)))
+        self._dispatch()
+
+
+    def prioritise(self, bufferId):
+        """
+        Fetch a buffer's backlog next, whether or not it is hidden.
+        """
+        if bufferId in self._requested:
+            return
+        try:
+            self._queue.remove(bufferId)
+        except ValueError:
+            pass
+        self._queue.appendleft(bufferId)
+        self._dispatch()
+
+
+    def backlogReceived(self, bufferId):
+        """
+        Note that a buffer's backlog has arrived.
+        """
+        request = self._inFlight.pop(bufferId, None)
+        if request is None:
+            return
+        sentAt, timeout = request
+        if timeout.active():
+            timeout.cancel()
+        self.completed += 1
+        self.latencies.append(self._clock.seconds() - sentAt)
+        self._dispatch()
+
+
+    def stop(self):
+        """
+        Stop fetching backlog and cancel outstanding timeouts.
+        """
+        self._queue.clear()
+        for sentAt, timeout in self._inFlight.itervalues():
+            if timeout.active():
+                timeout.cancel()
+        self._inFlight.clear()
+
+
+    def _timedOut(self, bufferId):
+        log.msg('Backlog request for buffer %r timed out' % (bufferId,))
+        del self._inFlight[bufferId]
+        self.timedOut += 1
+        self._dispatch()
+
+
+    def _dispatch(self):
+        while self._queue and len(self._inFlight) < self.maxInFlight:
+            bufferId = self._queue.popleft()
+            if bufferId in self._requested:
+                continue
+            self._requested.add(bufferId)
+            if self._requestBacklog(bufferId, -1, -1, self.limit):
+                self.cached += 1
+                continue
+            timeout = self._clock.callLater(
+                self.requestTimeout, self._timedOut, bufferId)
+            self._inFlight[bufferId] = self._clock.seconds(), timeout
+
+
+    def stats(self):
+        """
+        Summarise the scheduler's progress.
+
+        @rtype: C{dict}
+        """
+        latencies = list(self.latencies)
+        return dict(
+            pending=len(self._queue),
+            inFlight=len(self._inFlight),
+            completed=self.completed,
+            timedOut=self.timedOut,
+            cached=self.cached,
+            meanLatency=(
+                sum(latencies) / len(latencies) if latencies else None),
+            maxLatency=max(latencies) if latencies else None)
+
+
+
+# Estimated bytes used by each cached message, besides its content and sender:
+# its share of the batch's columns and the content string object.
+_messageOverhead = 64
+
+
+
+def _batchSize(messages):
+    """
+    Estimate the memory used by a L{MessageBatch}, in bytes.
+    """
+    return (
+        len(messages) * _messageOverhead +
+        sum(len(content) for content in messages.contents) +
+        sum(len(sender) for sender in messages.senderTable))
+
+
+
+class _CachedBacklog(object):
+    """
+    Cached messages of a single buffer.
+
+    @type messages: L{MessageBatch}
+    @ivar messages: Contiguous messages, oldest first, ending with the newest
+        message known.
+
+    @type complete: C{bool}
+    @ivar complete: C{messages} starts with the buffer's oldest message.
+
+    @type current: C{bool}
+    @ivar current: C{messages} is known to end with the buffer's newest
+        message, because a connected session keeps it up to date.
+
+    @type size: C{int}
+    @ivar size: Estimated bytes used by C{messages}.
+    """
+    __slots__ = ['messages', 'complete', 'current', 'size']
+
+    def __init__(self, messages, complete):
+        self.messages = messages
+        self.complete = complete
+        self.current = True
+        self.size = _batchSize(messages)
+
+
+
+class BacklogCache(object):
+    """
+    Recent messages of buffers, keyed on C{(account, bufferId)} and shared by
+    every core session, so that logging in again does not fetch the same
+    backlog from the core.
+
+    A buffer's messages are filled from backlog replies and kept current, by
+    adding messages as they arrive, while a session for its account is
+    connected. Once the session goes away only the messages newer than those
+    cached need fetching.
+
+    The least recently used buffers are evicted once more than L{maxBytes},
+    approximately, are cached.
+
+    @type maxBytes: C{int}
+    @ivar maxBytes: Maximum number of bytes to cache.
+
+    @type maxMessages: C{int}
+    @ivar maxMessages: Maximum number of messages cached per buffer.
+
+    @type bytes: C{int}
+    @ivar bytes: Estimated number of bytes cached.
+    """
+    maxBytes = 32 * 1024 * 1024
+    maxMessages = 500
+
+    def __init__(self):
+        self._entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.partialHits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def _touch(self, key):
+        self._entries[key] = self._entries.pop(key)
+
+
+    def lookup(self, key, limit):
+        """
+        Look up a buffer's newest messages.
+
+        @param key: C{(account, bufferId)}.
+
+        @type  limit: C{int}
+        @param limit: Number of messages wanted.
+
+        @rtype: C{(MessageBatch, int)}
+        @return: The cached messages, oldest first, or C{None}; and the ID of
+            the oldest message that must still be fetched from the core,
+            C{-1} to fetch the newest C{limit} messages, or C{None} if
+            nothing needs fetching.
+        """
+        entry = self._entries.get(key)
+        if (entry is None or
+            (len(entry.messages) < limit and not entry.complete) or
+            (not entry.messages and not entry.current)):
+            self.misses += 1
+            return None, -1
+        self._touch(key)
+        messages = entry.messages[-limit:]
+        if entry.current:
+            self.hits += 1
+            return messages, None
+        self.partialHits += 1
+        return messages, entry.messages.ids[-1] + 1
+
+
+    def recent(self, key, limit):
+        """
+        Get a buffer's newest cached messages, without counting a lookup or
+        fetching anything.
+
+        @param key: C{(account, bufferId)}.
+
+        @type  limit: C{int}
+        @param limit: Maximum number of messages wanted.
+
+        @rtype: L{MessageBatch}
+        @return: The cached messages, oldest first, or C{None}.
+        """
+        entry = self._entries.get(key)
+        if entry is None or not entry.messages:
+            return None
+        return entry.messages[-limit:]
+
+
+    def backlogReceived(self, key, messages, startMessageId, limit):
+        """
+        Merge backlog fetched from the core into a buffer's cached messages.
+
+        @param key: C{(account, bufferId)}.
+
+        @type  messages: L{MessageBatch}
+        @param messages: Messages, oldest first.
+
+        @param startMessageId: ID of the oldest message requested, or C{-1}.
+
+        @param limit: Maximum number of messages requested.
+        """
+        entry = self._entries.pop(key, None)
+        merged = MessageBatch()
+        complete = startMessageId == -1 and len(messages) < limit
+        if entry is not None:
+            self.bytes -= entry.size
+            cached = entry.messages
+            if messages and len(messages) >= limit:
+                # There may be a gap between the cached messages and the
+                # reply, keep only the cached messages the reply overlaps.
+                oldest = min(messages.ids)
+                cached = [record for record in cached if record.id >= oldest]
+            else:
+                complete = complete or entry.complete
+            merged.extend(cached)
+        merged.extend(messages)
+        merged.sort()
+        merged.dedupe()
+        if len(merged) > self.maxMessages:
+            merged = merged[-self.maxMessages:]
+            complete = False
+        entry = self._entries[key] = _CachedBacklog(merged, complete)
+        self.bytes += entry.size
+        self._evict()
+
+
+    def addMessage(self, key, record):
+        """
+        Add a newly arrived message to a buffer's cached messages, if they
+        are current.
+
+        @param key: C{(account, bufferId)}.
+
+        @type  record: L{waffle.qt.adapters.MessageRecord}
+        """
+        entry = self._entries.get(key)
+        if entry is None or not entry.current:
+            return
+        messages = entry.messages
+        if messages and record.id <= messages.ids[-1]:
+            return
+        self._touch(key)
+        messages.extend([record])
+        if len(messages) > self.maxMessages:
+            entry.messages = messages[-self.maxMessages:]
+            entry.complete = False
+            self.bytes -= entry.size
+            entry.size = _batchSize(entry.messages)
+            self.bytes += entry.size
+        else:
+            size = _messageOverhead + len(record.content) + len(record.sender)
+            entry.size += size
+            self.bytes += size
+        self._evict()
+
+
+    def expire(self, account):
+        """
+        Note that an account's messages are no longer kept current.
+        """
+        for (entryAccount, bufferId), entry in self._entries.iteritems():
+            if entryAccount == account:
+                entry.current = False
+
+
+    def _evict(self):
+        while self.bytes > self.maxBytes and self._entries:
+            key, entry = self._entries.popitem(last=False)
+            self.bytes -= entry.size
+            self.evictions += 1
+
+
+
+__all__ = ['BacklogScheduler', 'BacklogCache']
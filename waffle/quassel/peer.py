@@ -0,0 +1,228 @@
+"""
+Quassel wire protocols.
+
+The legacy protocol sends every message as a C{QVariant}: handshake messages
+are C{QVariantMap}s and signal proxy messages C{QVariantList}s. The
+DataStream protocol sends bare C{QVariantList}s: handshake messages as
+alternating keys and values, and signal proxy messages with a C{Short}
+request type and C{QByteArray} class, object and function names.
+
+Cores that support more than one protocol choose between them after the
+client probes with the protocols it supports.
+
+@see: U{http://git.quassel-irc.org/?p=quassel.git;a=blob;f=src/common/protocol.h}
+"""
+import struct
+
+from twisted.python.constants import Values, ValueConstant
+
+from waffle.qt import adapters
+
+
+
+class ProbeFailed(Exception):
+    """
+    The core did not accept a protocol probe.
+    """
+
+
+
+class ProtocolType(Values):
+    Legacy = ValueConstant(0x01)
+    DataStream = ValueConstant(0x02)
+
+
+
+PROTOCOL_MAGIC = 0x42b33f00
+ENCRYPTION = 0x01
+COMPRESSION = 0x02
+
+_uint32 = struct.Struct('>I')
+_LIST_END = 0x80000000
+# Serialized QVariant header of a QVariantList.
+_listHeader = struct.pack('>IB', 9, 0)
+
+# Number of names, following the request type, in each kind of signal proxy
+# message: Sync, RpcCall, InitRequest and InitData.
+_nameCounts = {1: 3, 2: 1, 3: 2, 4: 2}
+_INIT_DATA = 4
+
+
+
+def buildProbe(protocolTypes, connectionFeatures):
+    """
+    Build the probe sent to the core on connecting.
+
+    @type  protocolTypes: C{list} of L{ProtocolType}
+    @param protocolTypes: Supported protocols, most preferred first.
+
+    @param connectionFeatures: Bitmask of connection features, such as
+        L{COMPRESSION}, the client supports.
+
+    @rtype: C{str}
+    """
+    data = [_uint32.pack(PROTOCOL_MAGIC | connectionFeatures)]
+    for i, protocolType in enumerate(protocolTypes):
+        value = protocolType.value
+        if i == len(protocolTypes) - 1:
+            value |= _LIST_END
+        data.append(_uint32.pack(value))
+    return ''.join(data)
+
+
+
+def parseProbeReply(data):
+    """
+    Parse the core's reply to a probe.
+
+    @type  data: C{str}
+    @param data: 4 byte reply.
+
+    @raise ProbeFailed: If the core chose an unknown protocol.
+
+    @return: C{(protocolType, protocolFeatures, connectionFeatures)}.
+    """
+    reply, = _uint32.unpack(data)
+    try:
+        protocolType = ProtocolType.lookupByValue(reply & 0xff)
+    except ValueError:
+        raise ProbeFailed('Unknown protocol type 0x%02x' % (reply & 0xff,))
+    return protocolType, (reply >> 8) & 0xffff, reply >> 24
+
+
+
+def _pairs(values):
+    """
+    Convert alternating C{QByteArray} keys and values into a C{dict}.
+    """
+    it = iter(values)
+    return dict((key.decode('utf-8'), value) for key, value in zip(it, it))
+
+
+
+class LegacyPeer(object):
+    """
+    The legacy protocol.
+    """
+    protocolType = ProtocolType.Legacy
+
+    def __init__(self, encoder):
+        self._encoder = encoder
+
+
+    def wrapFrame(self, data):
+        """
+        Get a received frame as a serialized C{QVariant}.
+        """
+        return data
+
+
+    def handshakeReceived(self, value):
+        """
+        Convert a decoded handshake message to a C{dict}.
+        """
+        return value
+
+
+    def messageReceived(self, value):
+        """
+        Convert a decoded signal proxy message to a C{list} of the request
+        type, names and arguments.
+        """
+        return value
+
+
+    def encodeHandshake(self, message):
+        """
+        Encode a handshake message.
+
+        @type  message: C{dict}
+        @param message: Mapping of C{unicode} keys to L{adapters} values.
+        """
+        return self._encoder.encode(adapters.QVariantMap(message))
+
+
+    def encodeRequest(self, requestType, args):
+        """
+        Encode a signal proxy message.
+
+        @param args: L{adapters} values, names are L{adapters.QString}s.
+        """
+        return self._encoder.encode(
+            adapters.QVariantList([adapters.Int(requestType)] + list(args)))
+
+
+    def heartbeat(self, now):
+        """
+        Create a heartbeat timestamp.
+
+        @type  now: C{datetime.datetime}
+        """
+        return adapters.QTime(now.time())
+
+
+
+class DataStreamPeer(LegacyPeer):
+    """
+    The DataStream protocol.
+    """
+    protocolType = ProtocolType.DataStream
+
+    def wrapFrame(self, data):
+        # Frames are a bare QVariantList, wrapping it in a QVariant allows the
+        # decoder to decode it like any other frame.
+        return _listHeader + data
+
+
+    def handshakeReceived(self, value):
+        return _pairs(value)
+
+
+    def messageReceived(self, value):
+        requestType = value[0]
+        count = _nameCounts.get(requestType, 0)
+        names = [name.decode('utf-8') for name in value[1:count + 1]]
+        args = value[count + 1:]
+        if requestType == _INIT_DATA:
+            args = [_pairs(args)]
+        return [requestType] + names + args
+
+
+    def _encodeList(self, items):
+        # Strip the QVariant header, leaving the bare QVariantList.
+        return self._encoder.encode(
+            adapters.QVariantList(items))[len(_listHeader):]
+
+
+    def encodeHandshake(self, message):
+        items = []
+        for key, value in message.iteritems():
+            items.append(adapters.QByteArray(key.encode('utf-8')))
+            items.append(value)
+        return self._encodeList(items)
+
+
+    def encodeRequest(self, requestType, args):
+        count = _nameCounts.get(requestType, 0)
+        names = [
+            adapters.QByteArray(name.value.encode('utf-8'))
+            for name in args[:count]]
+        return self._encodeList(
+            [adapters.Short(requestType)] + names + list(args[count:]))
+
+
+    def heartbeat(self, now):
+        return adapters.QDateTime.fromDateTime(now)
+
+
+
+peers = {
+    ProtocolType.Legacy: LegacyPeer,
+    ProtocolType.DataStream: DataStreamPeer}
+
+
+
+__all__ = [
+    'ProbeFailed', 'ProtocolType', 'PROTOCOL_MAGIC', 'ENCRYPTION',
+    'COMPRESSION', 'buildProbe', 'parseProbeReply', 'LegacyPeer',
+    'DataStreamPeer', 'peers']
@@ -0,0 +1,120 @@
+"""
+Projection of Network InitData onto what web clients use.
+"""
+
+
+
+def _select(mapping, fields):
+    """
+    Copy the items of C{mapping} whose keys are in C{fields}, or every item if
+    C{fields} is C{None}.
+
+    Only the selected values of a lazily decoded map are decoded.
+    """
+    if fields is None:
+        return dict(mapping)
+    return dict((key, mapping[key]) for key in fields if key in mapping)
+
+
+
+class NetworkProjection(object):
+    """
+    Strip Network InitData of the properties the web client does not use,
+    before it is sent to it.
+
+    @type networkFields: C{frozenset} of C{unicode}
+    @ivar networkFields: Network properties to keep, other than its users and
+        channels, or C{None} to keep every property.
+
+    @type userFields: C{frozenset} of C{unicode}
+    @ivar userFields: User properties to keep, or C{None} to keep every
+        property.
+
+    @type channelFields: C{frozenset} of C{unicode}
+    @ivar channelFields: Channel properties to keep, other than its members,
+        or C{None} to keep every property.
+
+    @type deferMembers: C{bool}
+    @ivar deferMembers: Leave out channel members, which are instead sent to
+        a web client when it opens the channel's buffer; the C{u'UserModes'}
+        of every channel is C{None}.
+    """
+    networkFields = frozenset([
+        u'networkName', u'myNick', u'Supports', u'latency'])
+    userFields = frozenset([u'nick'])
+    channelFields = frozenset([u'topic'])
+    deferMembers = True
+
+    def projectInfo(self, info):
+        """
+        Project a network's properties, other than its users and channels.
+
+        @rtype: C{dict}
+        """
+        info = _select(info, self.networkFields)
+        info.pop(u'IrcUsersAndChannels', None)
+        return info
+
+
+    def projectUser(self, userInfo):
+        """
+        Project a user's properties.
+
+        @rtype: C{dict}
+        """
+        return _select(userInfo, self.userFields)
+
+
+    def projectChannel(self, channelInfo):
+        """
+        Project a channel's properties, the projected C{u'UserModes'} are
+        C{None} if L{deferMembers} is set.
+
+        @rtype: C{dict}
+        """
+        projected = _select(channelInfo, self.channelFields)
+        if self.deferMembers:
+            projected[u'UserModes'] = None
+        else:
+            projected[u'UserModes'] = dict(
+                channelInfo.get(u'UserModes') or {})
+        return projected
+
+
+    def project(self, networkInfo):
+        """
+        Project Network InitData.
+
+        @type  networkInfo: C{dict}
+        @param networkInfo: Network InitData, as delivered by the core.
+
+        @rtype: C{dict}
+        """
+        info = self.projectInfo(networkInfo)
+        usersAndChannels = networkInfo.get(u'IrcUsersAndChannels') or {}
+        users = usersAndChannels.get(u'users') or {}
+        channels = usersAndChannels.get(u'channels') or {}
+        info[u'IrcUsersAndChannels'] = {
+            u'users': dict(
+                (hostmask, self.projectUser(userInfo))
+                for hostmask, userInfo in users.items()),
+            u'channels': dict(
+                (name, self.projectChannel(channelInfo))
+                for name, channelInfo in channels.items())}
+        return info
+
+
+
+class IdentityProjection(NetworkProjection):
+    """
+    Projection keeping every property of Network InitData, including channel
+    members.
+    """
+    networkFields = None
+    userFields = None
+    channelFields = None
+    deferMembers = False
+
+
+
+__all__ = ['NetworkProjection', 'IdentityProjection']
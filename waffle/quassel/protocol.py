@@ -1,16 +1,44 @@
+import itertools
 import re
+import struct
+import time
 from datetime import datetime
 
-from twisted.internet import task
+from twisted.cred.error import UnauthorizedLogin
+from twisted.internet import defer, reactor, task
+from twisted.internet.protocol import ClientCreator
 from twisted.protocols.basic import Int32StringReceiver, StatefulStringProtocol
 from twisted.python import log
 from twisted.python.constants import Values, ValueConstant
 
-from waffle.qt import adapters, types
+from waffle.metrics import Sample, metrics
+from waffle.qt import adapters, codec, compression, types
+from waffle.quassel import backlog, peer, projection
+from waffle.quassel.state import StateStore
+from waffle.trace import tracer, CORE_IN, CORE_OUT
 from waffle.util import CommandDispatcherMixin, UnhandledCommand, splitEvery
 
 
 
+# The start of a serialized QVariantList: its type, null flag and length.
+_listHeader = struct.Struct('>IBI')
+_listType = struct.pack('>I', types.qvariantTypes['QVariantList'])
+
+
+
+_decodeSeconds = metrics.histogram(
+    'waffle_core_decode_seconds',
+    'Time spent decoding frames from the core in one go.')
+_encodeSeconds = metrics.histogram(
+    'waffle_core_encode_seconds',
+    'Time spent encoding messages sent to the core.')
+_heartbeatSeconds = metrics.histogram(
+    'waffle_core_heartbeat_rtt_seconds',
+    'Round-trip time of heartbeats sent to the core.',
+    [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10])
+
+
+
 class RequestType(Values):
     Invalid = ValueConstant(0)
     Sync = ValueConstant(1)
@@ -87,8 +115,11 @@ class QuasselSyncMessage(CommandDispatcherMixin):
         # messages. Probably it should tell the client it's backlog and
         # probably the client should insert messages according to their
         # timestamp.
+        if not isinstance(messages, adapters.MessageBatch):
+            messages = adapters.MessageBatch.fromRecords(messages)
         messages.reverse()
-        self.protocol.backlogReceived(messages)
+        self.protocol.backlogReceived(
+            bufferId, messages, startMessageId, limit)
 
 
     def sync_Network_setLatency(self, networkId, latency):
@@ -224,24 +255,25 @@ class QuasselMessage(CommandDispatcherMixin):
 
 
     def message_HeartbeatReply(self, timestamp):
-        #return RequestType.HeartbeatReply, [
-        #    adapters.QTime(datetime.now().time())]
-        pass
+        self.protocol.heartbeatReplied()
 
 
     def message_InitData(self, className, objectName, *args):
-        print '+InitData+ %s: %r: %r' % (className, objectName, args)
+        tracer.record(
+            CORE_IN, args, '+InitData+ %s: %r', className, objectName)
         return self._initMessageHandler.dispatch(className, objectName, *args)
 
 
     def message_Sync(self, className, objectName, functionName, *args):
-        print '+Sync+ %s_%s: %r: %r' % (className, functionName, objectName, args)
+        tracer.record(
+            CORE_IN, args, '+Sync+ %s_%s: %r', className, functionName,
+            objectName)
         return self._syncMessageHandler.dispatch(
-            '%s_%s' % (className, functionName), objectName, *args)
+            (className, functionName), objectName, *args)
 
 
     def message_RpcCall(self, functionName, *args):
-        print '+RpcCall+ %s: %r' % (functionName, args)
+        tracer.record(CORE_IN, args, '+RpcCall+ %s', functionName)
         functionName = self._rpcFunctionMangleRe.sub('', functionName)
         return self._rpcMessageHandler.dispatch(
             functionName, *args)
@@ -249,38 +281,429 @@ class QuasselMessage(CommandDispatcherMixin):
 
 
 class QuasselClient(Int32StringReceiver, StatefulStringProtocol):
+    """
+    Quassel core client.
+
+    @type decoderFactory: C{callable}
+    @ivar decoderFactory: Callable returning an object with a C{decode} method,
+        used to decode C{QVariant}s received from the core; either
+        L{codec.QVariantDecoder} or L{codec.ConstructDecoder}.
+
+    @type encoderFactory: C{callable}
+    @ivar encoderFactory: Callable returning an object with an C{encode}
+        method, used to encode C{QVariant}s sent to the core; either
+        L{codec.QVariantEncoder} or L{codec.ConstructEncoder}.
+
+    @type incrementalDecodeThreshold: C{int}
+    @ivar incrementalDecodeThreshold: Frames of at least this many bytes are
+        decoded incrementally, via the reactor's cooperator, instead of in one
+        go; C{None} to always decode in one go.
+
+    @type incrementalDecodeStep: C{int}
+    @ivar incrementalDecodeStep: Number of elements to decode between yielding
+        to the cooperator.
+
+    @type useCompression: C{bool}
+    @ivar useCompression: Request compression from the core; frames are only
+        compressed if the core's C{ClientInitAck}, or its reply to the
+        protocol probe, indicates it supports it.
+
+    @type compressionLevel: C{int}
+    @ivar compressionLevel: zlib compression level for outgoing frames.
+
+    @type wireBytesReceived: C{int}
+    @ivar wireBytesReceived: Number of bytes received from the core.
+
+    @type wireBytesSent: C{int}
+    @ivar wireBytesSent: Number of bytes sent to the core.
+
+    @type frameBytesReceived: C{int}
+    @ivar frameBytesReceived: Number of bytes, including the length prefix,
+        received from the core after decompression.
+
+    @type frameBytesSent: C{int}
+    @ivar frameBytesSent: Number of bytes, including the length prefix, sent to
+        the core before compression.
+
+    @type framesReceived: C{int}
+    @ivar framesReceived: Number of frames received from the core.
+
+    @type framesSent: C{int}
+    @ivar framesSent: Number of frames sent to the core.
+
+    @type heartbeatLatency: C{float}
+    @ivar heartbeatLatency: Round-trip time, in seconds, of the most recently
+        answered heartbeat, or C{None}.
+
+    @type lazyInitClasses: C{frozenset} of C{unicode}
+    @ivar lazyInitClasses: Class names whose InitData is decoded lazily, maps
+        and lists are only decoded when accessed; large frames are walked
+        incrementally first, and what is accessed of them is decoded as it is
+        sent to web clients, in cooperative steps.
+
+    @type probeProtocols: C{bool}
+    @ivar probeProtocols: Probe the core for the protocols in
+        L{protocolTypes} on connecting, rather than assuming it only speaks
+        the legacy protocol.
+
+    @type protocolTypes: C{list} of L{peer.ProtocolType}
+    @ivar protocolTypes: Protocols offered when probing, most preferred first.
+
+    @type probeTimeout: C{int}
+    @ivar probeTimeout: Seconds to wait for the core to reply to the probe.
+
+    @type ready: L{defer.Deferred}
+    @ivar ready: Fires once the wire protocol has been established, or fails
+        with L{peer.ProbeFailed} if the core does not accept the probe.
+
+    @type loggedIn: L{defer.Deferred}
+    @ivar loggedIn: Fires once the core has accepted the login, or fails with
+        C{UnauthorizedLogin} if it rejects it; only fires, or fails, once
+        L{ready} has fired.
+
+    @type store: L{StateStore}
+    @ivar store: Materialised state of the session, kept up to date as
+        messages arrive from the core.
+
+    @type backlogSchedulerFactory: C{callable}
+    @ivar backlogSchedulerFactory: Callable taking a function to request
+        backlog with and an C{IReactorTime}, returning an object like
+        L{backlog.BacklogScheduler}.
+
+    @type streamChunkSize: C{int}
+    @ivar streamChunkSize: Joined users and network InitData with more than
+        this many users are streamed to web clients in chunks of this many
+        items, rather than sent as a single event the browser has to parse in
+        one go.
+
+    @type backlogCache: L{backlog.BacklogCache}
+    @ivar backlogCache: Cache backlog is fetched through, or C{None}.
+
+    @type account: C{tuple}
+    @ivar account: C{(host, port, username)} of the core account, keying
+        L{backlogCache}.
+
+    @type networkProjection: L{projection.NetworkProjection}
+    @ivar networkProjection: Projection applied to Network InitData before it
+        is sent to web clients, or C{None} to send it as delivered by the
+        core.
+    """
     state = 'login'
 
+    MAX_LENGTH = 64 * 1024 * 1024
+
     _heartbeat = None
     heartbeatInterval = 120
-
-
-    def __init__(self, username, password):
+    incrementalDecodeThreshold = 128 * 1024
+    incrementalDecodeStep = 500
+    lazyInitClasses = frozenset([u'Network'])
+    useCompression = True
+    compressionLevel = 6
+    _compressed = False
+    decoderFactory = codec.QVariantDecoder
+    encoderFactory = codec.QVariantEncoder
+    backlogSchedulerFactory = backlog.BacklogScheduler
+    _backlog = None
+    backlogCache = None
+    account = None
+    _heartbeatSentAt = None
+    heartbeatLatency = None
+    web = None
+    _loggingIn = False
+    _lazyPrefixes = None
+    probeProtocols = True
+    protocolTypes = [peer.ProtocolType.DataStream, peer.ProtocolType.Legacy]
+    probeTimeout = 10
+    _probing = False
+    _probed = False
+    _probeTimeoutCall = None
+    _streamCompressor = None
+    _streamDecompressor = None
+    streamChunkSize = 500
+    networkProjection = projection.NetworkProjection()
+
+
+    def __init__(self, username, password, probe=None):
         self.username = username
         self.password = password
+        if probe is not None:
+            self.probeProtocols = probe
+        self._decoder = self.decoderFactory()
+        self._encoder = self.encoderFactory()
+        self._peer = peer.LegacyPeer(self._encoder)
+        self.ready = defer.Deferred()
+        self.loggedIn = defer.Deferred()
+        self.store = StateStore()
+        self.wireBytesReceived = 0
+        self.wireBytesSent = 0
+        self.frameBytesReceived = 0
+        self.frameBytesSent = 0
+        self.framesReceived = 0
+        self.framesSent = 0
+        self._streamIds = itertools.count()
+        self._tasks = set()
+        self._pauses = 0
 
 
     def connectionMade(self):
+        if not self.probeProtocols:
+            self._sendClientInit()
+            self._loggingIn = True
+            self.ready.callback(None)
+            return
+        features = peer.COMPRESSION if self.useCompression else 0
+        data = peer.buildProbe(self.protocolTypes, features)
+        self.wireBytesSent += len(data)
+        self.transport.write(data)
+        self._probing = True
+        self._probeBuffer = ''
+        self._probeTimeoutCall = reactor.callLater(
+            self.probeTimeout, self._probeFailed,
+            peer.ProbeFailed('No reply to the protocol probe'))
+
+
+    def _sendClientInit(self):
         now = datetime.now().strftime('%b %d %Y %H:%M:%S').decode('ascii')
-        self._sendQVariant(
-            adapters.QVariantMap({
-                u'ClientDate': adapters.QString(now),
-                u'UseSsl': adapters.Bool(False),
-                u'ClientVersion': adapters.QString(u"v0.6.1 (dist-<a href='http://git.quassel-irc.org/?p=quassel.git;a=commit;h=611ebccdb6a2a4a89cf1f565bee7e72bcad13ffb'>611ebcc</a>)"),
-                u'UseCompression': adapters.Bool(False),
-                u'MsgType': adapters.QString(u'ClientInit'),
-                u'ProtocolVersion': adapters.Int(10)}))
+        self._sendHandshake({
+            u'ClientDate': adapters.QString(now),
+            u'UseSsl': adapters.Bool(False),
+            u'ClientVersion': adapters.QString(u"v0.6.1 (dist-<a href='http://git.quassel-irc.org/?p=quassel.git;a=commit;h=611ebccdb6a2a4a89cf1f565bee7e72bcad13ffb'>611ebcc</a>)"),
+            # Probed connections have already negotiated compression.
+            u'UseCompression': adapters.Bool(
+                self.useCompression and not self._probed),
+            u'MsgType': adapters.QString(u'ClientInit'),
+            u'ProtocolVersion': adapters.Int(10)})
+
+
+    def _probeReplied(self, data):
+        """
+        Establish the wire protocol the core chose in reply to the probe.
+        """
+        self._cancelProbeTimeout()
+        try:
+            protocolType, protocolFeatures, connectionFeatures = (
+                peer.parseProbeReply(data))
+        except peer.ProbeFailed, e:
+            self._probeFailed(e)
+            return
+        self._probing = False
+        self._probed = True
+        self._peer = peer.peers[protocolType](self._encoder)
+        if connectionFeatures & peer.COMPRESSION:
+            self._streamCompressor = compression.StreamCompressor(
+                self.compressionLevel)
+            self._streamDecompressor = compression.StreamDecompressor()
+        self._sendClientInit()
+        self._loggingIn = True
+        self.ready.callback(None)
+
+
+    def _probeFailed(self, reason):
+        self._probeTimeoutCall = None
+        if self._probing:
+            self._probing = False
+            self.transport.loseConnection()
+            self.ready.errback(reason)
+
+
+    def _cancelProbeTimeout(self):
+        if self._probeTimeoutCall is not None:
+            self._probeTimeoutCall.cancel()
+            self._probeTimeoutCall = None
+
+
+    def internStats(self):
+        """
+        Summarise the effectiveness of the decoder's string intern tables.
+
+        @rtype: C{dict}
+        @return: See L{codec.QVariantDecoder.internStats}, or an empty
+            C{dict} if the decoder does not intern strings.
+        """
+        internStats = getattr(self._decoder, 'internStats', None)
+        if internStats is None:
+            return {}
+        return internStats()
+
+
+    def dataReceived(self, data):
+        self.wireBytesReceived += len(data)
+        if self._probing:
+            self._probeBuffer += data
+            if len(self._probeBuffer) < 4:
+                return
+            reply, data = self._probeBuffer[:4], self._probeBuffer[4:]
+            del self._probeBuffer
+            self._probeReplied(reply)
+            if not self._probed or not data:
+                return
+        # resumeProducing delivers the frames buffered while paused by
+        # calling this with no data, which the decompressor would swallow.
+        if self._streamDecompressor is None or not data:
+            Int32StringReceiver.dataReceived(self, data)
+            return
+        try:
+            for chunk in self._streamDecompressor.decompress(data):
+                Int32StringReceiver.dataReceived(self, chunk)
+        except codec.DecodeError:
+            log.err(None, 'Failed to decompress data from the core')
+            self.transport.loseConnection()
+
+
+    def sendString(self, string):
+        self.framesSent += 1
+        self.frameBytesSent += len(string) + self.prefixLength
+        if self._streamCompressor is not None:
+            data = self._streamCompressor.compress(
+                struct.pack(self.structFormat, len(string)) + string)
+            self.wireBytesSent += len(data)
+            self.transport.write(data)
+            return
+        if self._compressed:
+            string = compression.compressFrame(string, self.compressionLevel)
+        self.wireBytesSent += len(string) + self.prefixLength
+        Int32StringReceiver.sendString(self, string)
 
 
     def stringReceived(self, data):
-        #print '<-', len(data), repr(data)
-        data = adapters.QVariant.parse(types.QVariant.parse(data))
-        print '<=', data
+        if self._compressed:
+            data = compression.decompressFrame(data, self.MAX_LENGTH)
+        self.framesReceived += 1
+        self.frameBytesReceived += len(data) + self.prefixLength
+        data = self._peer.wrapFrame(data)
+        threshold = self.incrementalDecodeThreshold
+        isLazy = self._isLazyFrame(data)
+        if threshold is not None and len(data) >= threshold:
+            self._decodeIncrementally(data, isLazy)
+            return
+        start = time.time()
+        if isLazy:
+            value = self._decoder.decodeLazy(data)
+        else:
+            value = self._decoder.decode(data)
+        _decodeSeconds.observe(time.time() - start)
+        self._frameDecoded(value)
+
+
+    def _lazyFramePrefixes(self):
+        """
+        Get the serialized elements that start InitData for one of
+        L{lazyInitClasses}: the request type, and the class names as both
+        wire protocols serialize them.
+
+        @rtype: C{(str, tuple)}
+        """
+        classes = self.lazyInitClasses
+        if self._lazyPrefixes is None or self._lazyPrefixes[0] is not classes:
+            encode = self._encoder.encode
+            names = []
+            for name in classes:
+                names.append(encode(adapters.QString(name)))
+                names.append(encode(adapters.QByteArray(name.encode('utf-8'))))
+            self._lazyPrefixes = (
+                classes,
+                encode(adapters.Int(RequestType.InitData.value)),
+                tuple(names))
+        return self._lazyPrefixes[1:]
+
+
+    def _isLazyFrame(self, data):
+        """
+        Determine whether a frame is InitData for one of L{lazyInitClasses},
+        from its serialized first elements, without decoding them.
+        """
+        if self.state != 'message' or not self.lazyInitClasses:
+            return False
+        requestType, names = self._lazyFramePrefixes()
+        offset = _listHeader.size
+        return (
+            data.startswith(_listType) and
+            data.startswith(requestType, offset) and
+            data.startswith(names, offset + len(requestType)))
+
+
+    def _frameDecoded(self, data):
+        if self.state == 'message':
+            data = self._peer.messageReceived(data)
+        else:
+            data = self._peer.handshakeReceived(data)
+            tracer.record(CORE_IN, data, '<= %s', self.state)
         return StatefulStringProtocol.stringReceived(self, data)
 
 
+    def _cooperate(self, iterator, description):
+        """
+        Run C{iterator} in cooperative steps, via the reactor's cooperator.
+
+        The transport is paused until the iterator is exhausted, any frames
+        received in the meantime are buffered and delivered, in order, once
+        it, and any other paused work, finishes.
+
+        @param description: Description of the work, for logging failures.
+
+        @rtype: L{defer.Deferred}
+        @return: Fires with C{None} once the iterator is exhausted, or once
+            the connection is lost.
+        """
+        def _done(ignored):
+            self._tasks.discard(cooperativeTask)
+            self._pauses -= 1
+            if not self._pauses:
+                self.resumeProducing()
+
+        def _failed(f):
+            self._tasks.discard(cooperativeTask)
+            if f.check(task.TaskStopped) is None:
+                log.err(f, 'Failed to %s' % (description,))
+                self.transport.loseConnection()
+
+        self._pauses += 1
+        if self._pauses == 1:
+            self.pauseProducing()
+        cooperativeTask = task.cooperate(iterator)
+        self._tasks.add(cooperativeTask)
+        return cooperativeTask.whenDone().addCallbacks(_done, _failed)
+
+
+    def _iterDecode(self, decoder):
+        while not decoder.resume(self.incrementalDecodeStep):
+            yield None
+        self._frameDecoded(decoder.result)
+
+
+    def _decodeIncrementally(self, data, lazy=False):
+        """
+        Decode, and handle, a large frame in cooperative steps.
+
+        @param lazy: Decode the frame lazily, only walking it in steps to find
+            where its maps and lists are.
+        """
+        if lazy:
+            decoder = codec.IncrementalLazyDecoder(self._decoder, data)
+        else:
+            decoder = codec.IncrementalDecoder(self._decoder, data)
+        self._cooperate(
+            self._iterDecode(decoder), 'decode a %d byte frame' % (len(data),))
+
+
     def connectionLost(self, reason):
+        self._cancelProbeTimeout()
+        if self._probing:
+            self._probing = False
+            self.ready.errback(peer.ProbeFailed(
+                'Connection lost during the protocol probe'))
+        if self._loggingIn:
+            self._loggingIn = False
+            self.loggedIn.errback(reason)
         self._stopHeartbeat()
+        if self._backlog is not None:
+            self._backlog.stop()
+        if self.backlogCache is not None:
+            self.backlogCache.expire(self.account)
+        for cooperativeTask in list(self._tasks):
+            cooperativeTask.stop()
+        if self.web is not None:
+            self.web.coreConnectionLost(reason)
         Int32StringReceiver.connectionLost(self, reason)
 
 
@@ -304,14 +727,23 @@ class QuasselClient(Int32StringReceiver, StatefulStringProtocol):
 
 
     def privmsgReceived(self, messageInfo):
+        if self.backlogCache is not None:
+            self.backlogCache.addMessage(
+                (self.account, messageInfo.bufferInfo.id), messageInfo)
         self.web.sendJSON(u'message', messageInfo)
 
 
-    def backlogReceived(self, messages):
+    def backlogReceived(self, bufferId, messages, startMessageId=-1,
+                        limit=None):
+        if self.backlogCache is not None and limit is not None:
+            self.backlogCache.backlogReceived(
+                (self.account, bufferId), messages, startMessageId, limit)
+        self._backlog.backlogReceived(bufferId)
         self.web.sendJSON(u'backlog', messages)
 
 
     def userModeAdded(self, networkId, bufferName, nickname, mode):
+        self.store.userModeAdded(networkId, bufferName, nickname, mode)
         self.web.sendJSON(u'userModeAdded',
             {u'networkId': networkId,
              u'bufferName': bufferName,
@@ -320,6 +752,7 @@ class QuasselClient(Int32StringReceiver, StatefulStringProtocol):
 
 
     def userModeRemoved(self, networkId, bufferName, nickname, mode):
+        self.store.userModeRemoved(networkId, bufferName, nickname, mode)
         self.web.sendJSON(u'userModeRemoved',
             {u'networkId': networkId,
              u'bufferName': bufferName,
@@ -328,6 +761,7 @@ class QuasselClient(Int32StringReceiver, StatefulStringProtocol):
 
 
     def topicChanged(self, networkId, bufferName, topic):
+        self.store.topicChanged(networkId, bufferName, topic)
         self.web.sendJSON(u'topicChanged',
             {u'networkId': networkId,
              u'bufferName': bufferName,
@@ -335,12 +769,14 @@ class QuasselClient(Int32StringReceiver, StatefulStringProtocol):
 
 
     def latencyUpdated(self, networkId, latency):
+        self.store.latencyUpdated(networkId, latency)
         self.web.sendJSON(u'latencyUpdated',
             {u'networkId': networkId,
              u'latency': latency})
 
 
     def objectRenamed(self, objectType, old, new):
+        self.store.objectRenamed(objectType, old, new)
         self.web.sendJSON(u'objectRenamed',
             {u'type': objectType,
              u'old': old,
@@ -348,6 +784,7 @@ class QuasselClient(Int32StringReceiver, StatefulStringProtocol):
 
 
     def userSetMetadata(self, networkId, nickname, key, value):
+        self.store.userSetMetadata(networkId, nickname, key, value)
         self.web.sendJSON(u'userSetMetadata',
             {u'networkId': networkId,
              u'nickname': nickname,
@@ -356,18 +793,21 @@ class QuasselClient(Int32StringReceiver, StatefulStringProtocol):
 
 
     def userConnected(self, networkId, host):
+        self.store.userConnected(networkId, host)
         self.web.sendJSON(u'userConnected',
             {u'networkId': networkId,
              u'host': host})
 
 
     def userQuit(self, networkId, nickname):
+        self.store.userQuit(networkId, nickname)
         self.web.sendJSON(u'userQuit',
             {u'networkId': networkId,
              u'nickname': nickname})
 
 
     def userParted(self, networkId, nickname, bufferName):
+        self.store.userParted(networkId, nickname, bufferName)
         self.web.sendJSON(u'userParted',
             {u'networkId': networkId,
              u'nickname': nickname,
@@ -375,19 +815,24 @@ class QuasselClient(Int32StringReceiver, StatefulStringProtocol):
 
 
     def usersJoined(self, networkId, bufferName, userModes):
-        self.web.sendJSON(u'usersJoined',
-            {u'networkId': networkId,
-             u'bufferName': bufferName,
-             u'userModes': userModes})
+        self.store.usersJoined(networkId, bufferName, userModes)
+        data = {u'networkId': networkId, u'bufferName': bufferName}
+        if len(userModes) > self.streamChunkSize:
+            self.sendStream(self.web, u'usersJoined', data, userModes)
+        else:
+            data[u'userModes'] = userModes
+            self.web.sendJSON(u'usersJoined', data)
 
 
     def channelJoined(self, networkId, bufferName):
+        self.store.channelJoined(networkId, bufferName)
         self.web.sendJSON(u'channelJoined',
             {u'networkId': networkId,
              u'bufferName': bufferName})
 
 
     def bufferAdded(self, bufferViewId, bufferId, index):
+        self.store.bufferAdded(bufferViewId, bufferId, index)
         self.web.sendJSON(u'bufferAdded',
             {u'bufferViewId': bufferViewId,
              u'bufferId': bufferId,
@@ -395,6 +840,7 @@ class QuasselClient(Int32StringReceiver, StatefulStringProtocol):
 
 
     def bufferRemoved(self, bufferViewId, bufferId, permanent=False):
+        self.store.bufferRemoved(bufferViewId, bufferId, permanent)
         self.web.sendJSON(u'bufferRemoved',
             {u'bufferViewId': bufferViewId,
              u'bufferId': bufferId,
@@ -402,13 +848,15 @@ class QuasselClient(Int32StringReceiver, StatefulStringProtocol):
 
 
     def markerUpdated(self, bufferId, messageId):
+        self.store.markerUpdated(bufferId, messageId)
         self.web.sendJSON(u'markerUpdated',
             {u'bufferId': bufferId,
              u'messageId': messageId})
 
 
     def initializeNetwork(self, networkId, networkInfo):
-        self.web.sendJSON('initializeNetwork', [networkId, networkInfo])
+        self.store.initializeNetwork(networkId, networkInfo)
+        self.sendNetwork(self.web, self.store.networks[networkId])
 
         #List<QVariant<?>> reqPackedFunc = new LinkedList<QVariant<?>>();
         #reqPackedFunc.add(new QVariant<Integer>(RequestType.Sync.getValue(), QVariantType.Int));
@@ -418,27 +866,198 @@ class QuasselClient(Int32StringReceiver, StatefulStringProtocol):
         #sendQVariantList(reqPackedFunc);	
 
 
+    def sendStream(self, web, streamType, data, items):
+        """
+        Stream a list of items to a web client in chunks of at most
+        L{streamChunkSize} items.
+
+        A C{streamBegin} event, carrying C{streamType}, C{data} and the number
+        of items, is followed by a C{streamChunk} event for each chunk and
+        finally a C{streamEnd} event; each event carries the stream's ID.
+
+        @type  web: L{waffle.websocket.WaffleProtocol}
+        @param web: Web client, or session, to send the events to.
+
+        @type  streamType: C{unicode}
+        @param streamType: Kind of items being streamed, such as
+            C{u'usersJoined'}.
+
+        @type  data: C{dict}
+        @param data: Details common to every item, such as the network ID.
+
+        @type  items: C{list}
+        """
+        for ignored in self._iterStream(
+                web, streamType, data, items, len(items)):
+            pass
+
+
+    def _iterStream(self, web, streamType, data, items, count):
+        """
+        Stream C{count} items, from an iterable, to a web client, yielding
+        after each chunk.
+
+        @see: L{sendStream}
+        """
+        streamId = next(self._streamIds)
+        web.sendJSON(u'streamBegin',
+            {u'stream': streamId,
+             u'type': streamType,
+             u'data': data,
+             u'count': count})
+        items = iter(items)
+        while True:
+            chunk = list(itertools.islice(items, self.streamChunkSize))
+            if not chunk:
+                break
+            web.sendJSON(u'streamChunk',
+                {u'stream': streamId,
+                 u'items': chunk})
+            yield None
+        web.sendJSON(u'streamEnd', {u'stream': streamId})
+
+
+    def sendNetwork(self, web, network):
+        """
+        Send a network to a web client, projected by L{networkProjection}.
+
+        Networks with more than L{streamChunkSize} users, counting each
+        channel member, are sent without their users and channel members,
+        which are then streamed with L{sendStream}: the network's users as a
+        C{u'networkUsers'} stream, of C{[hostmask, userInfo]} items, and each
+        channel's members as a C{u'usersJoined'} stream.
+
+        Users and channels are projected, and sent, L{streamChunkSize} at a
+        time in cooperative steps, so that a large network does not block the
+        reactor; messages from the core are handled once it has been sent.
+
+        @type  web: L{waffle.websocket.WaffleProtocol}
+
+        @type  network: L{waffle.quassel.state.NetworkState}
+
+        @rtype: L{defer.Deferred}
+        @return: Fires once the network has been sent.
+        """
+        return self._cooperate(
+            self._iterSendNetwork(web, network),
+            'send network %d' % (network.id,))
+
+
+    def _iterSendNetwork(self, web, network):
+        networkProjection = self.networkProjection
+        if networkProjection is None:
+            networkProjection = projection.IdentityProjection()
+        size = self.streamChunkSize
+        info = networkProjection.projectInfo(network.info)
+        users = (
+            (hostmask, networkProjection.projectUser(userInfo))
+            for hostmask, userInfo in network.iterUsers())
+        channels = {}
+        total = network.userCount()
+        for i, (name, channelInfo) in enumerate(network.iterChannels()):
+            channel = channels[name] = networkProjection.projectChannel(
+                channelInfo)
+            total += len(channel[u'UserModes'] or ())
+            if i % size == size - 1:
+                yield None
+        if total <= size:
+            info[u'IrcUsersAndChannels'] = {
+                u'users': dict(users), u'channels': channels}
+            web.sendJSON(u'initializeNetwork', [network.id, info])
+            return
+
+        members = []
+        for name, channel in channels.iteritems():
+            userModes = channel[u'UserModes']
+            # Deferred members stay deferred.
+            if userModes is not None:
+                channel[u'UserModes'] = {}
+                if userModes:
+                    members.append((name, userModes.items()))
+        info[u'IrcUsersAndChannels'] = {u'users': {}, u'channels': channels}
+        web.sendJSON(u'initializeNetwork', [network.id, info])
+        for ignored in self._iterStream(
+                web, u'networkUsers', {u'networkId': network.id}, users,
+                network.userCount()):
+            yield None
+        for name, userModes in members:
+            for ignored in self._iterStream(
+                    web, u'usersJoined',
+                    {u'networkId': network.id, u'bufferName': name},
+                    userModes, len(userModes)):
+                yield None
+
+
+    def sendChannelMembers(self, web, bufferId):
+        """
+        Send the members of a channel to a web client, if
+        L{networkProjection} deferred sending them, as a C{channelMembers}
+        event or stream.
+
+        @type  web: L{waffle.websocket.WaffleProtocol}
+
+        @type  bufferId: C{int}
+        @param bufferId: Channel buffer ID.
+        """
+        if (self.networkProjection is None or
+            not self.networkProjection.deferMembers):
+            return
+        bufferInfo = self.store.buffers.get(bufferId)
+        if bufferInfo is None:
+            return
+        network = self.store.networks.get(bufferInfo.networkId)
+        if network is None:
+            return
+        channel = network.findChannel(bufferInfo.name)
+        if channel is None:
+            return
+        userModes = channel.members.items()
+        data = {u'networkId': bufferInfo.networkId,
+                u'bufferName': bufferInfo.name}
+        if len(userModes) > self.streamChunkSize:
+            self.sendStream(web, u'channelMembers', data, userModes)
+        else:
+            data[u'userModes'] = userModes
+            web.sendJSON(u'channelMembers', data)
+
+
     def initializeBufferView(self, bufferViewId, bufferViewInfo):
+        self.store.initializeBufferView(bufferViewId, bufferViewInfo)
+        if bufferViewId == 0:
+            self._backlog.start(bufferViewInfo.get(u'BufferList', []))
         self.web.sendJSON(
             'initializeBufferView', [bufferViewId, bufferViewInfo])
 
 
     def initializeBufferSyncer(self, markerLines, lastSeenMessages):
+        self.store.initializeBufferSyncer(markerLines, lastSeenMessages)
         self.web.sendJSON('initializeBufferSyncer',
             {u'markerLines': markerLines,
              u'lastSeenMessages': lastSeenMessages})
 
 
-    def _sendQVariant(self, value):
-        self.sendString(
-            types.QVariant.build(
-                adapters.QVariant(value).serialize()))
+    def _sendHandshake(self, message):
+        if tracer.enabled(CORE_OUT):
+            tracer.record(
+                CORE_OUT,
+                dict((key, value) for key, value in message.iteritems()
+                     if key != u'Password'),
+                '=> %s', message[u'MsgType'].value)
+        start = time.time()
+        data = self._peer.encodeHandshake(message)
+        _encodeSeconds.observe(time.time() - start)
+        self.sendString(data)
 
 
     def _sendRequest(self, requestType, *args):
-        self._sendQVariant(
-            adapters.QVariantList(
-                [adapters.Int(requestType)] + list(args)))
+        if tracer.enabled(CORE_OUT):
+            tracer.record(
+                CORE_OUT, args, '=> %s',
+                RequestType.lookupByValue(requestType).name)
+        start = time.time()
+        data = self._peer.encodeRequest(requestType, args)
+        _encodeSeconds.observe(time.time() - start)
+        self.sendString(data)
 
 
     def _sendInitRequest(self, className, objectName):
@@ -456,9 +1075,21 @@ class QuasselClient(Int32StringReceiver, StatefulStringProtocol):
 
 
     def _sendHeartbeat(self):
+        self._heartbeatSentAt = time.time()
         self._sendRequest(
             RequestType.Heartbeat.value,
-            adapters.QTime(datetime.now().time()))
+            self._peer.heartbeat(datetime.now()))
+
+
+    def heartbeatReplied(self):
+        """
+        Measure the round-trip time of the outstanding heartbeat.
+        """
+        if self._heartbeatSentAt is None:
+            return
+        self.heartbeatLatency = time.time() - self._heartbeatSentAt
+        self._heartbeatSentAt = None
+        _heartbeatSeconds.observe(self.heartbeatLatency)
 
 
     def _stopHeartbeat(self):
@@ -477,16 +1108,28 @@ class QuasselClient(Int32StringReceiver, StatefulStringProtocol):
 
     def proto_login(self, data):
         assert data[u'MsgType'] == u'ClientInitAck'
-        self._sendQVariant(
-            adapters.QVariantMap({
-                u'MsgType': adapters.QString(u'ClientLogin'),
-                u'User': adapters.QString(self.username),
-                u'Password': adapters.QString(self.password)}))
+        # Both sides compress everything after ClientInitAck, unless the probe
+        # already negotiated compression.
+        self._compressed = (
+            self.useCompression and
+            not self._probed and
+            bool(data.get(u'SupportsCompression', False)))
+        self._sendHandshake({
+            u'MsgType': adapters.QString(u'ClientLogin'),
+            u'User': adapters.QString(self.username),
+            u'Password': adapters.QString(self.password)})
         return 'loginAck'
 
 
     def proto_loginAck(self, data):
+        self._loggingIn = False
+        if data[u'MsgType'] == u'ClientLoginReject':
+            self.loggedIn.errback(UnauthorizedLogin(data.get(u'Error')))
+            return 'done'
         assert data[u'MsgType'] == u'ClientLoginAck'
+        # Session events follow, they are sent to whoever is waiting for the
+        # login.
+        self.loggedIn.callback(None)
         return 'sessionInit'
 
 
@@ -495,14 +1138,18 @@ class QuasselClient(Int32StringReceiver, StatefulStringProtocol):
         data = data.get(u'SessionState')
 
         for bufferInfo in data.get('BufferInfos'):
+            self.store.initializeBuffer(bufferInfo)
             self.web.sendJSON('initializeBuffer', bufferInfo)
 
         self._messageHandler = QuasselMessage(self)
         for networkId in data.get(u'NetworkIds', []):
             self._sendInitRequest(u'Network', unicode(networkId))
 
-        for bufferInfo in data.get('BufferInfos', []):
-            self.requestBacklog(bufferInfo.get(u'id'), -1, -1, 50)
+        # Backlog is fetched once the buffer view is known.
+        self._backlog = self.backlogSchedulerFactory(
+            self._fetchBacklog, reactor)
+        self._backlog.addBuffers(
+            bufferInfo.id for bufferInfo in data.get('BufferInfos', []))
 
         self._sendInitRequest(u'BufferSyncer', u'');
         ##self._sendInitRequest(u'BufferViewManager', u'');
@@ -536,6 +1183,36 @@ class QuasselClient(Int32StringReceiver, StatefulStringProtocol):
             adapters.Int(0))
 
 
+    def _fetchBacklog(self, bufferId, startMessageId, endMessageId, limit):
+        """
+        Fetch the newest backlog of a buffer, answering from L{backlogCache}
+        where possible and only requesting the messages it is missing from
+        the core.
+
+        @rtype: C{bool}
+        @return: C{True} if the cache answered without asking the core.
+        """
+        if (self.backlogCache is not None and
+            startMessageId == endMessageId == -1):
+            messages, startMessageId = self.backlogCache.lookup(
+                (self.account, bufferId), limit)
+            if messages:
+                self.web.sendJSON(u'backlog', messages)
+            if startMessageId is None:
+                return True
+        self.requestBacklog(bufferId, startMessageId, endMessageId, limit)
+        return False
+
+
+    def focusBuffer(self, bufferId):
+        """
+        Fetch a buffer's backlog ahead of other buffers, since the user is
+        looking at it.
+        """
+        if self._backlog is not None:
+            self._backlog.prioritise(bufferId)
+
+
     def hideBuffer(self, bufferId):
         self._sendRequest(
             RequestType.Sync.value,
@@ -553,3 +1230,62 @@ class QuasselClient(Int32StringReceiver, StatefulStringProtocol):
             adapters.QString('requestAddBuffer'),
             adapters.UserType('BufferId', adapters.Int(bufferId)),
             adapters.Int(index))
+
+
+
+def connectToCore(reactor, host, port, username, password):
+    """
+    Connect to a Quassel core, probing for its supported protocols and
+    reconnecting with the legacy protocol if the core does not understand the
+    probe.
+
+    @raise UnauthorizedLogin: Via the L{defer.Deferred}, if the core
+        rejects the login.
+
+    @rtype: L{defer.Deferred}
+    @return: Fires with the connected L{QuasselClient}, once the core has
+        accepted the login.
+    """
+    def _loggedIn(protocol):
+        d = protocol.ready.addCallback(lambda _: protocol.loggedIn)
+        return d.addCallback(lambda _: protocol)
+
+    def _connect(probe):
+        cc = ClientCreator(
+            reactor, QuasselClient, username, password, probe=probe)
+        return cc.connectTCP(host, port).addCallback(_loggedIn)
+
+    def _probeFailed(f):
+        f.trap(peer.ProbeFailed)
+        log.msg('Protocol probe failed, falling back to legacy: %s' % (
+            f.getErrorMessage(),))
+        return _connect(False)
+
+    return _connect(True).addErrback(_probeFailed)
+
+
+
+def _collectDispatchStats():
+    """
+    Report the handler counters of the core message dispatchers.
+    """
+    calls = Sample(
+        'waffle_dispatch_calls_total', 'counter',
+        'Messages from the core dispatched to each handler.')
+    unhandled = Sample(
+        'waffle_dispatch_unhandled_total', 'counter',
+        'Messages from the core without a handler of their own.')
+    seconds = Sample(
+        'waffle_dispatch_seconds_total', 'counter',
+        'Time spent in each core message handler.')
+    for dispatcher in [QuasselMessage, QuasselSyncMessage,
+                       QuasselInitDataMessage, QuasselRpcMessage]:
+        for name, stats in dispatcher.dispatchStats().iteritems():
+            calls.add(stats['calls'], handler=name)
+            unhandled.add(stats['unhandled'], handler=name)
+            seconds.add(stats['time'], handler=name)
+    return [calls, unhandled, seconds]
+
+
+
+metrics.addCollector(_collectDispatchStats)
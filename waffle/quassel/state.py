@@ -0,0 +1,459 @@
+"""
+Materialised core session state.
+
+L{StateStore} is kept up to date by L{waffle.quassel.protocol.QuasselClient}
+as InitData and Sync messages arrive, so that web clients attaching to an
+established session can be sent a single snapshot of it.
+"""
+
+
+
+def _splitHostmask(hostmask):
+    """
+    Split C{nick!user@host} into its parts, missing parts are empty.
+    """
+    nick, _, rest = hostmask.partition(u'!')
+    user, _, host = rest.partition(u'@')
+    return nick, user, host
+
+
+
+class IrcUser(object):
+    """
+    A user on a network.
+
+    @type info: C{dict}
+    @ivar info: User properties, as delivered by the core, such as C{u'nick'}
+        and C{u'realName'}.
+
+    @type channels: C{set} of C{unicode}
+    @ivar channels: Names of the channels the user is in.
+    """
+    __slots__ = ['info', 'channels']
+
+    def __init__(self, info):
+        self.info = info
+        self.channels = set()
+
+
+    @property
+    def nick(self):
+        return self.info.get(u'nick', u'')
+
+
+    @property
+    def hostmask(self):
+        info = self.info
+        return u'%s!%s@%s' % (
+            self.nick, info.get(u'user', u''), info.get(u'host', u''))
+
+
+    def toJSON(self):
+        info = dict(self.info)
+        info[u'channels'] = sorted(self.channels)
+        return info
+
+
+
+class IrcChannel(object):
+    """
+    A channel on a network.
+
+    @type info: C{dict}
+    @ivar info: Channel properties, as delivered by the core, other than its
+        members.
+
+    @type members: C{dict} of C{unicode} to C{unicode}
+    @ivar members: Mapping of member nicknames to their mode characters.
+    """
+    __slots__ = ['name', 'info', 'members']
+
+    def __init__(self, name, info=None):
+        self.name = name
+        self.info = info or {}
+        self.members = {}
+
+
+    def toJSON(self):
+        info = dict(self.info)
+        info[u'UserModes'] = self.members
+        return info
+
+
+
+class NetworkState(object):
+    """
+    State of a single network.
+
+    The users and channels in a network's InitData, which may be lazily
+    decoded, are only materialised when they are first looked up, so that
+    storing a large network does not decode every user; L{iterUsers} and
+    L{iterChannels} describe the rest without materialising them.
+
+    @type info: C{dict}
+    @ivar info: Network properties, as delivered by the core, other than its
+        users and channels.
+
+    @type users: C{dict} of C{unicode} to L{IrcUser}
+    @ivar users: Materialised users, keyed by nickname; use L{findUser} or
+        L{getUser} to look one up.
+
+    @type channels: C{dict} of C{unicode} to L{IrcChannel}
+    @ivar channels: Materialised channels, keyed by name; use L{findChannel}
+        or L{getChannel} to look one up.
+    """
+    def __init__(self, networkId, info=None, users=None, channels=None):
+        """
+        @param users: User properties from the network's InitData, keyed by
+            hostmask.
+
+        @param channels: Channel properties, including their C{u'UserModes'},
+            from the network's InitData, keyed by name.
+        """
+        self.id = networkId
+        self.info = info or {}
+        self.users = {}
+        self.channels = {}
+        self._initUsers = users or {}
+        self._initChannels = channels or {}
+        # Hostmasks of the users in the InitData not materialised yet, keyed
+        # by nickname, or None until a user is first looked up.
+        self._pendingUsers = None
+
+
+    def _getPendingUsers(self):
+        if self._pendingUsers is None:
+            self._pendingUsers = dict(
+                (_splitHostmask(hostmask)[0], hostmask)
+                for hostmask in self._initUsers)
+        return self._pendingUsers
+
+
+    def findUser(self, nickname):
+        """
+        Get a user by nickname, or C{None} if it is not known.
+        """
+        user = self.users.get(nickname)
+        if user is not None:
+            return user
+        hostmask = self._getPendingUsers().pop(nickname, None)
+        if hostmask is None:
+            return None
+        info = dict(self._initUsers[hostmask])
+        channels = info.pop(u'channels', None) or []
+        user = self.users[nickname] = IrcUser(info)
+        user.channels.update(channels)
+        return user
+
+
+    def getUser(self, nickname):
+        """
+        Get a user by nickname, creating it if it is not known yet.
+        """
+        user = self.findUser(nickname)
+        if user is None:
+            user = self.users[nickname] = IrcUser({u'nick': nickname})
+        return user
+
+
+    def removeUser(self, nickname):
+        """
+        Forget a user, returning it or C{None} if it was not known.
+        """
+        if self.findUser(nickname) is None:
+            return None
+        return self.users.pop(nickname)
+
+
+    def findChannel(self, name):
+        """
+        Get a channel by name, or C{None} if it is not known.
+        """
+        channel = self.channels.get(name)
+        if channel is not None:
+            return channel
+        info = self._initChannels.get(name)
+        if info is None:
+            return None
+        info = dict(info)
+        userModes = info.pop(u'UserModes', None) or {}
+        channel = self.channels[name] = IrcChannel(name, info)
+        channel.members.update(userModes)
+        return channel
+
+
+    def getChannel(self, name):
+        """
+        Get a channel by name, creating it if it is not known yet.
+        """
+        channel = self.findChannel(name)
+        if channel is None:
+            channel = self.channels[name] = IrcChannel(name)
+        return channel
+
+
+    def removeMember(self, name, nickname):
+        channel = self.findChannel(name)
+        if channel is not None:
+            channel.members.pop(nickname, None)
+        user = self.findUser(nickname)
+        if user is not None:
+            user.channels.discard(name)
+
+
+    def userCount(self):
+        """
+        Count the users, without materialising them.
+        """
+        if self._pendingUsers is None:
+            return len(self.users) + len(self._initUsers)
+        return len(self.users) + len(self._pendingUsers)
+
+
+    def iterUsers(self):
+        """
+        Iterate over every user, without materialising them.
+
+        @return: Iterator of C{(hostmask, info)}, where C{info} is a mapping
+            of the user's properties, including C{u'channels'}.
+        """
+        users = self.users.values()
+        if self._pendingUsers is None:
+            pending = list(self._initUsers)
+        else:
+            pending = self._pendingUsers.values()
+        for user in users:
+            yield user.hostmask, user.toJSON()
+        for hostmask in pending:
+            yield hostmask, self._initUsers[hostmask]
+
+
+    def iterChannels(self):
+        """
+        Iterate over every channel, without materialising them.
+
+        @return: Iterator of C{(name, info)}, where C{info} is a mapping of
+            the channel's properties, including C{u'UserModes'}.
+        """
+        channels = self.channels.values()
+        pending = [
+            name for name in self._initChannels if name not in self.channels]
+        for channel in channels:
+            yield channel.name, channel.toJSON()
+        for name in pending:
+            yield name, self._initChannels[name]
+
+
+    def toJSON(self):
+        info = dict(self.info)
+        info[u'IrcUsersAndChannels'] = {
+            u'users': dict(self.iterUsers()),
+            u'channels': dict(self.iterChannels())}
+        return info
+
+
+
+class StateStore(object):
+    """
+    Materialised state of a core session.
+
+    @type networks: C{dict} of C{int} to L{NetworkState}
+    @ivar networks: Networks, keyed by network ID.
+
+    @type buffers: C{dict} of C{int} to L{waffle.qt.adapters.BufferInfoRecord}
+    @ivar buffers: Buffers, keyed by buffer ID.
+
+    @type bufferViews: C{dict} of C{int} to C{dict}
+    @ivar bufferViews: Buffer view configuration, keyed by buffer view ID.
+
+    @type markerLines: C{dict} of C{int} to C{int}
+    @ivar markerLines: Marker line message IDs, keyed by buffer ID.
+
+    @type lastSeenMessages: C{dict} of C{int} to C{int}
+    @ivar lastSeenMessages: Last seen message IDs, keyed by buffer ID.
+    """
+    def __init__(self):
+        self.networks = {}
+        self.buffers = {}
+        self.bufferViews = {}
+        self.markerLines = {}
+        self.lastSeenMessages = {}
+
+
+    def getNetwork(self, networkId):
+        """
+        Get a network by ID, creating it if it is not known yet.
+        """
+        network = self.networks.get(networkId)
+        if network is None:
+            network = self.networks[networkId] = NetworkState(networkId)
+        return network
+
+
+    def getBufferByName(self, networkId, name):
+        """
+        Get a buffer's info by network ID and name, or C{None}.
+        """
+        for bufferInfo in self.buffers.itervalues():
+            if bufferInfo.networkId == networkId and bufferInfo.name == name:
+                return bufferInfo
+        return None
+
+
+    def initializeBuffer(self, bufferInfo):
+        self.buffers[bufferInfo.id] = bufferInfo
+
+
+    def initializeNetwork(self, networkId, networkInfo):
+        info = dict(networkInfo)
+        usersAndChannels = info.pop(u'IrcUsersAndChannels', None) or {}
+        self.networks[networkId] = NetworkState(
+            networkId, info, usersAndChannels.get(u'users'),
+            usersAndChannels.get(u'channels'))
+
+
+    def initializeBufferView(self, bufferViewId, bufferViewInfo):
+        info = dict(bufferViewInfo)
+        for key in [u'BufferList', u'TemporarilyRemovedBuffers',
+                    u'RemovedBuffers']:
+            info[key] = list(info.get(key) or [])
+        self.bufferViews[bufferViewId] = info
+
+
+    def initializeBufferSyncer(self, markerLines, lastSeenMessages):
+        self.markerLines = dict(markerLines)
+        self.lastSeenMessages = dict(lastSeenMessages)
+
+
+    def latencyUpdated(self, networkId, latency):
+        self.getNetwork(networkId).info[u'latency'] = latency
+
+
+    def channelJoined(self, networkId, bufferName):
+        self.getNetwork(networkId).getChannel(bufferName)
+
+
+    def topicChanged(self, networkId, bufferName, topic):
+        channel = self.getNetwork(networkId).getChannel(bufferName)
+        channel.info[u'topic'] = topic
+
+
+    def userConnected(self, networkId, hostmask):
+        nick, user, host = _splitHostmask(hostmask)
+        info = self.getNetwork(networkId).getUser(nick).info
+        info[u'user'] = user
+        info[u'host'] = host
+
+
+    def userQuit(self, networkId, nickname):
+        network = self.getNetwork(networkId)
+        user = network.removeUser(nickname)
+        if user is not None:
+            for name in user.channels:
+                channel = network.findChannel(name)
+                if channel is not None:
+                    channel.members.pop(nickname, None)
+
+
+    def usersJoined(self, networkId, bufferName, userModes):
+        network = self.getNetwork(networkId)
+        channel = network.getChannel(bufferName)
+        for nickname, modes in userModes:
+            channel.members[nickname] = modes
+            network.getUser(nickname).channels.add(bufferName)
+
+
+    def userParted(self, networkId, nickname, bufferName):
+        self.getNetwork(networkId).removeMember(bufferName, nickname)
+
+
+    def userModeAdded(self, networkId, bufferName, nickname, mode):
+        members = self.getNetwork(networkId).getChannel(bufferName).members
+        modes = members.get(nickname, u'')
+        if mode not in modes:
+            members[nickname] = modes + mode
+
+
+    def userModeRemoved(self, networkId, bufferName, nickname, mode):
+        members = self.getNetwork(networkId).getChannel(bufferName).members
+        if nickname in members:
+            members[nickname] = members[nickname].replace(mode, u'')
+
+
+    def userSetMetadata(self, networkId, nickname, key, value):
+        network = self.getNetwork(networkId)
+        if key == 'nick':
+            self._renameUser(network, nickname, value)
+        else:
+            network.getUser(nickname).info[key] = value
+
+
+    def objectRenamed(self, objectType, old, new):
+        (networkId, oldNickname), (_, newNickname) = old, new
+        self._renameUser(self.getNetwork(networkId), oldNickname, newNickname)
+
+
+    def _renameUser(self, network, old, new):
+        user = network.removeUser(old)
+        if user is None:
+            network.getUser(new)
+            return
+        user.info[u'nick'] = new
+        network.users[new] = user
+        for name in user.channels:
+            members = network.getChannel(name).members
+            if old in members:
+                members[new] = members.pop(old)
+
+
+    def bufferAdded(self, bufferViewId, bufferId, index):
+        info = self.bufferViews.get(bufferViewId)
+        if info is None:
+            return
+        for key in [u'TemporarilyRemovedBuffers', u'RemovedBuffers']:
+            if bufferId in info[key]:
+                info[key].remove(bufferId)
+        if bufferId not in info[u'BufferList']:
+            info[u'BufferList'].insert(index, bufferId)
+
+
+    def bufferRemoved(self, bufferViewId, bufferId, permanent=False):
+        info = self.bufferViews.get(bufferViewId)
+        if info is None:
+            return
+        if bufferId in info[u'BufferList']:
+            info[u'BufferList'].remove(bufferId)
+        if permanent:
+            key = u'RemovedBuffers'
+        else:
+            key = u'TemporarilyRemovedBuffers'
+        if bufferId not in info[key]:
+            info[key].append(bufferId)
+
+
+    def markerUpdated(self, bufferId, messageId):
+        self.markerLines[bufferId] = messageId
+
+
+    def snapshot(self):
+        """
+        Describe the whole state, in the form of the initialisation events
+        sent to web clients.
+
+        @rtype: C{dict}
+        """
+        return {
+            u'buffers': self.buffers.values(),
+            u'networks': [
+                [networkId, network]
+                for networkId, network in self.networks.iteritems()],
+            u'bufferViews': [
+                [bufferViewId, info]
+                for bufferViewId, info in self.bufferViews.iteritems()],
+            u'bufferSyncer': {
+                u'markerLines': self.markerLines.items(),
+                u'lastSeenMessages': self.lastSeenMessages.items()}}
+
+
+
+__all__ = ['IrcUser', 'IrcChannel', 'NetworkState', 'StateStore']
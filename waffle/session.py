@@ -0,0 +1,370 @@
+"""
+Core sessions shared between the web clients of a single user.
+"""
+import hashlib
+import hmac
+import os
+
+from twisted.cred.error import UnauthorizedLogin
+from twisted.internet import defer
+from twisted.python import log
+
+from waffle.metrics import Sample
+from waffle.quassel.backlog import BacklogCache
+
+
+
+def _passwordDigest(salt, password):
+    return hmac.new(salt, password.encode('utf-8'), hashlib.sha256).digest()
+
+
+
+def _constantTimeEqual(a, b):
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+
+class Session(object):
+    """
+    A core connection shared by one or more web clients.
+
+    Events sent to the session are fanned out to every attached web client.
+    Web clients that attach later are sent a snapshot of the session's state,
+    and the newest messages of each buffer from the backlog cache.
+
+    @type key: C{tuple}
+    @ivar key: C{(host, port, username)} of the core account.
+
+    @type quassel: L{waffle.quassel.protocol.QuasselClient}
+    @ivar quassel: Core connection, or C{None} until it is established.
+
+    @type webs: C{list} of L{waffle.websocket.WaffleProtocol}
+    @ivar webs: Attached web clients.
+
+    @type replayLimit: C{int}
+    @ivar replayLimit: Number of each buffer's newest messages sent to web
+        clients attaching after the core connection is initialised.
+    """
+    replayLimit = 50
+
+    def __init__(self, registry, key, password):
+        self._registry = registry
+        self.key = key
+        self.quassel = None
+        self.webs = []
+        self._salt = os.urandom(16)
+        self._digest = _passwordDigest(self._salt, password)
+        self._waiters = []
+        self._attaching = set()
+
+
+    def __repr__(self):
+        return '<%s %s:%d %r webs=%d>' % (
+            (type(self).__name__,) + self.key + (len(self.webs),))
+
+
+    def checkPassword(self, password):
+        """
+        Determine whether C{password} is the one the session logged in with.
+        """
+        return _constantTimeEqual(
+            self._digest, _passwordDigest(self._salt, password))
+
+
+    def whenConnected(self):
+        """
+        Get a L{defer.Deferred} firing with the session once its core
+        connection is established.
+        """
+        if self.quassel is not None:
+            return defer.succeed(self)
+        d = defer.Deferred()
+        self._waiters.append(d)
+        return d
+
+
+    def _connected(self, quassel):
+        self.quassel = quassel
+        quassel.web = self
+        quassel.account = self.key
+        quassel.backlogCache = self._registry.backlogCache
+        waiters, self._waiters = self._waiters, []
+        for d in waiters:
+            d.callback(self)
+
+
+    def _connectionFailed(self, f):
+        waiters, self._waiters = self._waiters, []
+        for d in waiters:
+            d.errback(f)
+
+
+    def attach(self, web):
+        """
+        Attach a web client, sending it a snapshot of the session's state and
+        the newest messages of each buffer.
+
+        Networks are sent in cooperative steps, the web client is only sent
+        the session's events once they have been. Messages come from the
+        backlog cache, which includes those that arrived since the session
+        connected; backlog still being fetched is sent to every attached web
+        client once it arrives.
+
+        @rtype: L{defer.Deferred}
+        @return: Fires once the web client is attached.
+        """
+        def _attach(ignored):
+            if web not in self._attaching:
+                return
+            self._attaching.remove(web)
+            cache = self._registry.backlogCache
+            for bufferId in store.buffers:
+                messages = cache.recent(
+                    (self.key, bufferId), self.replayLimit)
+                if messages:
+                    web.sendJSON(u'backlog', messages)
+            self.webs.append(web)
+
+        store = self.quassel.store
+        snapshot = store.snapshot()
+        # Networks can be large enough to need streaming.
+        networks, snapshot[u'networks'] = snapshot[u'networks'], []
+        web.sendJSON(u'snapshot', snapshot)
+        self._attaching.add(web)
+        d = defer.gatherResults([
+            self.quassel.sendNetwork(web, network)
+            for networkId, network in networks])
+        return d.addCallback(_attach)
+
+
+    def detach(self, web):
+        """
+        Detach a web client.
+        """
+        self._attaching.discard(web)
+        if web in self.webs:
+            self.webs.remove(web)
+
+
+    def sendJSON(self, messageType, data):
+        """
+        Send an event to every attached web client.
+        """
+        for web in list(self.webs):
+            web.sendJSON(messageType, data)
+
+
+    def coreConnectionLost(self, reason):
+        """
+        Forget the session and disconnect every attached web client, since
+        the core connection has gone away.
+        """
+        self._registry._forget(self)
+        for web in list(self.webs):
+            web.transport.loseConnection()
+
+
+
+class SessionRegistry(object):
+    """
+    Core sessions, keyed on core account.
+
+    @type releaseDelay: C{int}
+    @ivar releaseDelay: Seconds to keep a core connection open after its last
+        web client detaches, so that reloading the page reuses it.
+
+    @type backlogCache: L{BacklogCache}
+    @ivar backlogCache: Backlog cache shared by every session.
+    """
+    releaseDelay = 10
+
+    def __init__(self, connect, clock):
+        """
+        @type  connect: C{callable}
+        @param connect: Called with C{clock, host, port, username, password}
+            and returning a L{defer.Deferred} firing with a connected
+            L{waffle.quassel.protocol.QuasselClient}, such as
+            L{waffle.quassel.protocol.connectToCore}.
+
+        @type  clock: L{twisted.internet.interfaces.IReactorTime}
+        """
+        self._connect = connect
+        self._clock = clock
+        self._sessions = {}
+        self._pending = {}
+        self._releases = {}
+        self.backlogCache = BacklogCache()
+
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+    def sessions(self):
+        """
+        Get the current sessions.
+        """
+        return self._sessions.values()
+
+
+    def collectMetrics(self):
+        """
+        Report the state of every session, for L{waffle.metrics}.
+        """
+        def _sample(name, metricType, help, attr):
+            sample = Sample(name, metricType, help)
+            for labels, quassel in connected:
+                value = getattr(quassel, attr)
+                if value is not None:
+                    sample.add(value, **labels)
+            return sample
+
+        connected = [
+            (dict(user=session.key[2], core='%s:%d' % session.key[:2]),
+             session.quassel)
+            for session in self._sessions.itervalues()
+            if session.quassel is not None]
+        webs = [web for session in self._sessions.itervalues()
+                for web in session.webs]
+        cache = self.backlogCache
+        return [
+            Sample('waffle_sessions', 'gauge', 'Active core sessions.').add(
+                len(self._sessions)),
+            Sample('waffle_web_clients', 'gauge',
+                   'Web clients attached to core sessions.').add(len(webs)),
+            Sample('waffle_web_outbound_pending_bytes', 'gauge',
+                   'Bytes waiting to be written to web clients.').add(
+                sum(web.pendingBytes() for web in webs)),
+            _sample('waffle_core_frames_received_total', 'counter',
+                    'Frames received from the core.', 'framesReceived'),
+            _sample('waffle_core_frames_sent_total', 'counter',
+                    'Frames sent to the core.', 'framesSent'),
+            _sample('waffle_core_wire_bytes_received_total', 'counter',
+                    'Bytes received from the core.', 'wireBytesReceived'),
+            _sample('waffle_core_wire_bytes_sent_total', 'counter',
+                    'Bytes sent to the core.', 'wireBytesSent'),
+            _sample('waffle_core_frame_bytes_received_total', 'counter',
+                    'Bytes received from the core, after decompression.',
+                    'frameBytesReceived'),
+            _sample('waffle_core_frame_bytes_sent_total', 'counter',
+                    'Bytes sent to the core, before compression.',
+                    'frameBytesSent'),
+            _sample('waffle_core_heartbeat_latency_seconds', 'gauge',
+                    'Round-trip time of the last answered heartbeat.',
+                    'heartbeatLatency'),
+            Sample('waffle_backlog_cache_bytes', 'gauge',
+                   'Estimated bytes of cached backlog.').add(cache.bytes),
+            Sample('waffle_backlog_cache_buffers', 'gauge',
+                   'Buffers with cached backlog.').add(len(cache)),
+            Sample('waffle_backlog_cache_lookups_total', 'counter',
+                   'Backlog cache lookups, by whether the core was asked '
+                   'for all, some or none of the messages.').add(
+                cache.hits, result='hit').add(
+                cache.partialHits, result='partial').add(
+                cache.misses, result='miss'),
+            Sample('waffle_backlog_cache_evictions_total', 'counter',
+                   'Buffers evicted from the backlog cache.').add(
+                cache.evictions)]
+
+
+    def open(self, host, port, username, password):
+        """
+        Get the session for a core account, connecting to the core if there
+        is no such session.
+
+        The caller should L{Session.attach} to the session, or L{detach} from
+        it if it no longer wants it, so that it can be released.
+
+        A session is only shared once the core has accepted its login, until
+        then other callers wait for the outcome and try again, so that they
+        are not checked against a password the core has not accepted.
+
+        @raise UnauthorizedLogin: Via the L{defer.Deferred}, if the core
+            rejects the login, or the session exists but C{password} is not
+            the one it logged in with.
+
+        @rtype: L{defer.Deferred}
+        @return: Fires with the L{Session} once it is connected.
+        """
+        def _opened(session):
+            self._cancelRelease(session.key)
+            return session
+
+        key = host, port, username
+        session = self._sessions.get(key)
+        if session is not None:
+            if not session.checkPassword(password):
+                return defer.fail(UnauthorizedLogin())
+            return session.whenConnected().addCallback(_opened)
+
+        session = self._pending.get(key)
+        if session is not None:
+            d = session.whenConnected()
+            return d.addBoth(
+                lambda ignored: self.open(host, port, username, password))
+
+        session = self._pending[key] = Session(self, key, password)
+        d = self._connect(self._clock, host, port, username, password)
+        d.addCallbacks(self._connected, self._connectionFailed,
+                       callbackArgs=(session,), errbackArgs=(session,))
+        return session.whenConnected().addCallback(_opened)
+
+
+    def _connected(self, quassel, session):
+        del self._pending[session.key]
+        self._sessions[session.key] = session
+        session._connected(quassel)
+
+
+    def detach(self, web, session):
+        """
+        Detach a web client from its session, releasing the core connection
+        once no web clients remain.
+        """
+        session.detach(web)
+        if self._sessions.get(session.key) is not session:
+            return
+        if (not session.webs and not session._attaching and
+            session.key not in self._releases):
+            self._releases[session.key] = self._clock.callLater(
+                self.releaseDelay, self._release, session)
+
+
+    def _forget(self, session):
+        self._cancelRelease(session.key)
+        if self._sessions.get(session.key) is session:
+            del self._sessions[session.key]
+        if self._pending.get(session.key) is session:
+            del self._pending[session.key]
+
+
+    def _connectionFailed(self, f, session):
+        if f.check(UnauthorizedLogin) is not None:
+            log.msg('Core rejected the login of session %r' % (session,))
+        else:
+            log.err(f, 'Failed to connect session %r' % (session,))
+        self._forget(session)
+        session._connectionFailed(f)
+
+
+    def _cancelRelease(self, key):
+        release = self._releases.pop(key, None)
+        if release is not None and release.active():
+            release.cancel()
+
+
+    def _release(self, session):
+        del self._releases[session.key]
+        if session.webs or session._attaching:
+            return
+        self._forget(session)
+        session.quassel.transport.loseConnection()
+
+
+
+__all__ = ['Session', 'SessionRegistry']
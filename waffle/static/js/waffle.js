@@ -1,6 +1,6 @@
 // Generated by CoffeeScript 1.3.3
 (function() {
-  var App, AppView, Buffer, BufferTabView, BufferUser, BufferUserView, BufferUsers, BufferUsersView, BufferView, Buffers, Client, ClientView, DOMBuilder, EventHandler, LoginView, Message, MessageView, Messages, Network, NetworkInfoView, NetworkUser, NetworkUsers, NetworkView, WaffleRouter,
+  var App, AppView, Buffer, BufferTabView, BufferUser, BufferUserView, BufferUsers, BufferUsersView, BufferView, Buffers, Client, ClientView, CompactDecoder, DOMBuilder, EventHandler, LoginView, Message, MessageView, Messages, Network, NetworkInfoView, NetworkUser, NetworkUsers, NetworkView, WaffleRouter,
     __bind = function(fn, me){ return function(){ return fn.apply(me, arguments); }; },
     __hasProp = {}.hasOwnProperty,
     __extends = function(child, parent) { for (var key in parent) { if (__hasProp.call(parent, key)) child[key] = parent[key]; } function ctor() { this.constructor = child; } ctor.prototype = parent.prototype; child.prototype = new ctor(); child.__super__ = parent.prototype; return child; };
@@ -344,7 +344,8 @@
 
     Buffer.prototype.defaults = {
       focus: false,
-      hidden: false
+      hidden: false,
+      membersLoaded: false
     };
 
     Buffer.prototype.initialize = function() {
@@ -451,7 +452,10 @@
 
     BufferTabView.prototype.focused = function(event) {
       console.log('FOCUSED!!!');
-      return this.model.set('focus', true);
+      this.model.set('focus', true);
+      return this.model.protocol.send('focusBuffer', {
+        bufferId: this.model.id
+      });
     };
 
     BufferTabView.prototype.hideBuffer = function(event) {
@@ -867,6 +871,138 @@
 
   })(Backbone.View);
 
+  CompactDecoder = (function() {
+    /*
+        Decode events in the compact binary encoding, see waffle.encoding.
+    */
+
+    function CompactDecoder(strings) {
+      this.strings = strings != null ? strings : [];
+      this._value = __bind(this._value, this);
+
+      this._utf8 = __bind(this._utf8, this);
+
+      this._varint = __bind(this._varint, this);
+
+      this.decode = __bind(this.decode, this);
+
+    }
+
+    CompactDecoder.prototype.decode = function(buffer) {
+      var d, data, t, type, _ref;
+      this._bytes = new Uint8Array(buffer);
+      this._view = new DataView(buffer);
+      this._offset = 0;
+      _ref = this._value(), type = _ref[0], data = _ref[1];
+      if (type === 'batch') {
+        data = (function() {
+          var _i, _len, _ref1, _results;
+          _results = [];
+          for (_i = 0, _len = data.length; _i < _len; _i++) {
+            _ref1 = data[_i], t = _ref1[0], d = _ref1[1];
+            _results.push({
+              type: t,
+              data: d
+            });
+          }
+          return _results;
+        })();
+      }
+      return {
+        type: type,
+        data: data
+      };
+    };
+
+    CompactDecoder.prototype._varint = function() {
+      var byte, result, scale;
+      result = 0;
+      scale = 1;
+      while (true) {
+        byte = this._bytes[this._offset++];
+        result += (byte & 0x7f) * scale;
+        scale *= 128;
+        if (byte < 0x80) {
+          break;
+        }
+      }
+      return result;
+    };
+
+    CompactDecoder.prototype._utf8 = function(end) {
+      var bytes, c, chars;
+      bytes = this._bytes;
+      chars = [];
+      while (this._offset < end) {
+        c = bytes[this._offset++];
+        if (c >= 0xf0) {
+          c = ((c & 0x07) << 18) | ((bytes[this._offset++] & 0x3f) << 12) | ((bytes[this._offset++] & 0x3f) << 6) | (bytes[this._offset++] & 0x3f);
+          c -= 0x10000;
+          chars.push(String.fromCharCode(0xd800 + (c >> 10), 0xdc00 + (c & 0x3ff)));
+          continue;
+        } else if (c >= 0xe0) {
+          c = ((c & 0x0f) << 12) | ((bytes[this._offset++] & 0x3f) << 6) | (bytes[this._offset++] & 0x3f);
+        } else if (c >= 0xc0) {
+          c = ((c & 0x1f) << 6) | (bytes[this._offset++] & 0x3f);
+        }
+        chars.push(String.fromCharCode(c));
+      }
+      return chars.join('');
+    };
+
+    CompactDecoder.prototype._value = function() {
+      var i, key, length, n, o, tag, value, _i, _ref;
+      tag = this._bytes[this._offset++];
+      if (tag >= 0x80) {
+        return tag & 0x7f;
+      }
+      switch (tag) {
+        case 0:
+          return null;
+        case 1:
+          return false;
+        case 2:
+          return true;
+        case 3:
+          n = this._varint();
+          if (n % 2) {
+            return -(n + 1) / 2;
+          } else {
+            return n / 2;
+          }
+        case 4:
+          value = this._view.getFloat64(this._offset);
+          this._offset += 8;
+          return value;
+        case 5:
+          length = this._varint();
+          return this._utf8(this._offset + length);
+        case 6:
+          return (function() {
+            var _i, _ref, _results;
+            _results = [];
+            for (i = _i = 0, _ref = this._varint(); 0 <= _ref ? _i < _ref : _i > _ref; i = 0 <= _ref ? ++_i : --_i) {
+              _results.push(this._value());
+            }
+            return _results;
+          }).call(this);
+        case 7:
+          o = {};
+          for (i = _i = 0, _ref = this._varint(); 0 <= _ref ? _i < _ref : _i > _ref; i = 0 <= _ref ? ++_i : --_i) {
+            key = this._value();
+            o[key] = this._value();
+          }
+          return o;
+        case 8:
+          return this.strings[this._varint()];
+      }
+      throw new Error("Unknown compact encoding tag " + tag);
+    };
+
+    return CompactDecoder;
+
+  })();
+
   App = (function() {
 
     function App() {
@@ -881,21 +1017,38 @@
     };
 
     App.prototype.connect = function(options) {
-      var d, self, ws;
+      var d, decoder, self, ws;
       d = $.Deferred();
       console.log('connect');
       console.log(options);
       this._eventHandler = new EventHandler(options.events);
+      decoder = new CompactDecoder;
       self = this;
       ws = $.websocket(options.url, {
         open: function() {
+          var _ref;
           console.log('open');
           self._eventHandler.protocol = ws;
           return ws.send('auth', {
             username: options.username,
-            password: options.password
+            password: options.password,
+            batch: true,
+            encoding: (_ref = options.encoding) != null ? _ref : 'json'
           });
         },
+        message: function(e) {
+          var data, event, _base, _name;
+          data = e.originalEvent.data;
+          if (typeof data === 'string') {
+            return;
+          }
+          e.stopImmediatePropagation();
+          event = decoder.decode(data);
+          if (event.type === 'auth' && (event.data.strings != null)) {
+            decoder.strings = event.data.strings;
+          }
+          return typeof (_base = self._eventHandler)[_name = event.type] === "function" ? _base[_name](event) : void 0;
+        },
         close: function() {
           console.log('close');
           return self.errorAlert({
@@ -912,6 +1065,7 @@
         },
         events: this._eventHandler
       });
+      ws.binaryType = 'arraybuffer';
       return d;
     };
 
@@ -993,8 +1147,30 @@
 
       this.initializeBufferSyncer = __bind(this.initializeBufferSyncer, this);
 
+      this.snapshot = __bind(this.snapshot, this);
+
+      this._membersBuffer = __bind(this._membersBuffer, this);
+
+      this.channelMembers = __bind(this.channelMembers, this);
+
+      this._streamEnd_channelMembers = __bind(this._streamEnd_channelMembers, this);
+
+      this._stream_channelMembers = __bind(this._stream_channelMembers, this);
+
+      this._stream_usersJoined = __bind(this._stream_usersJoined, this);
+
+      this._stream_networkUsers = __bind(this._stream_networkUsers, this);
+
+      this.streamEnd = __bind(this.streamEnd, this);
+
+      this.streamChunk = __bind(this.streamChunk, this);
+
+      this.streamBegin = __bind(this.streamBegin, this);
+
       this.initializeNetwork = __bind(this.initializeNetwork, this);
 
+      this._addNetworkUsers = __bind(this._addNetworkUsers, this);
+
       this._addUsers = __bind(this._addUsers, this);
 
       this.initializeBuffer = __bind(this.initializeBuffer, this);
@@ -1003,11 +1179,27 @@
 
       this.initializeBufferView = __bind(this.initializeBufferView, this);
 
+      this.authFailed = __bind(this.authFailed, this);
+
       this.auth = __bind(this.auth, this);
 
+      this.batch = __bind(this.batch, this);
+
       this._maxBufferId = 0;
+      this._streams = {};
     }
 
+    EventHandler.prototype.batch = function(e) {
+      var event, _i, _len, _name, _ref, _results;
+      _ref = e.data;
+      _results = [];
+      for (_i = 0, _len = _ref.length; _i < _len; _i++) {
+        event = _ref[_i];
+        _results.push(typeof this[_name = event.type] === "function" ? this[_name](event) : void 0);
+      }
+      return _results;
+    };
+
     EventHandler.prototype.auth = function(e) {
       var _base;
       console.log('event:auth');
@@ -1017,6 +1209,13 @@
       return typeof (_base = this.handler).authenticated === "function" ? _base.authenticated() : void 0;
     };
 
+    EventHandler.prototype.authFailed = function(e) {
+      var _base;
+      console.log('event:authFailed');
+      console.log(e);
+      return typeof (_base = this.handler).rejected === "function" ? _base.rejected(e.data.reason) : void 0;
+    };
+
     EventHandler.prototype.initializeBufferView = function(e) {
       var buffer, bufferId, bufferIds, bufferViewId, data, _i, _j, _len, _len1, _ref, _ref1, _ref2, _results;
       console.log('event:initializeBufferView');
@@ -1080,8 +1279,20 @@
       return buffer.users.add(users);
     };
 
+    EventHandler.prototype._addNetworkUsers = function(network, hostInfos) {
+      var host, info, user, users, _i, _len, _ref;
+      users = [];
+      for (_i = 0, _len = hostInfos.length; _i < _len; _i++) {
+        _ref = hostInfos[_i], host = _ref[0], info = _ref[1];
+        info.id = host;
+        user = new NetworkUser(info);
+        users.push(user);
+      }
+      return network.users.add(users);
+    };
+
     EventHandler.prototype.initializeNetwork = function(e) {
-      var buffer, channel, data, host, info, network, networkId, user, users, _ref, _ref1, _ref2, _results;
+      var buffer, channel, data, info, network, networkId, usersAndChannels, _ref, _ref1, _results;
       console.log('event:initializeNetwork');
       _ref = e.data, networkId = _ref[0], data = _ref[1];
       network = this.client.get(networkId);
@@ -1091,26 +1302,124 @@
         features: data.Supports,
         latency: data.latency
       });
-      users = [];
-      _ref1 = data.IrcUsersAndChannels.users;
-      for (host in _ref1) {
-        info = _ref1[host];
-        info.id = host;
-        user = new NetworkUser(info);
-        users.push(user);
-      }
-      network.users.add(users);
-      _ref2 = data.IrcUsersAndChannels.channels;
+      usersAndChannels = data.IrcUsersAndChannels;
+      this._addNetworkUsers(network, _.mappingItems(usersAndChannels.users));
+      _ref1 = usersAndChannels.channels;
       _results = [];
-      for (channel in _ref2) {
-        info = _ref2[channel];
+      for (channel in _ref1) {
+        info = _ref1[channel];
         buffer = network.buffers.getByName(channel);
         buffer.set('topic', info.topic);
-        _results.push(this._addUsers(buffer, _.mappingItems(info.UserModes)));
+        if (info.UserModes != null) {
+          buffer.set('membersLoaded', true);
+          _results.push(this._addUsers(buffer, _.mappingItems(info.UserModes)));
+        } else {
+          _results.push(void 0);
+        }
       }
       return _results;
     };
 
+    EventHandler.prototype.streamBegin = function(e) {
+      console.log('event:streamBegin', e.data.type, e.data.count);
+      return this._streams[e.data.stream] = e.data;
+    };
+
+    EventHandler.prototype.streamChunk = function(e) {
+      var stream, _name;
+      stream = this._streams[e.data.stream];
+      if (stream) {
+        return typeof this[_name = '_stream_' + stream.type] === "function" ? this[_name](stream.data, e.data.items) : void 0;
+      }
+    };
+
+    EventHandler.prototype.streamEnd = function(e) {
+      var stream, _name;
+      stream = this._streams[e.data.stream];
+      delete this._streams[e.data.stream];
+      if (stream) {
+        return typeof this[_name = '_streamEnd_' + stream.type] === "function" ? this[_name](stream.data) : void 0;
+      }
+    };
+
+    EventHandler.prototype._stream_networkUsers = function(data, items) {
+      var network;
+      network = this.client.get(data.networkId);
+      return this._addNetworkUsers(network, items);
+    };
+
+    EventHandler.prototype._stream_usersJoined = function(data, items) {
+      var buffer;
+      buffer = this._membersBuffer(data);
+      if (buffer) {
+        return this._addUsers(buffer, items);
+      }
+    };
+
+    EventHandler.prototype._stream_channelMembers = function(data, items) {
+      var buffer, network;
+      network = this.client.get(data.networkId);
+      buffer = network.buffers.getByName(data.bufferName);
+      if (!buffer.get('membersLoaded')) {
+        return this._addUsers(buffer, items);
+      }
+    };
+
+    EventHandler.prototype._streamEnd_channelMembers = function(data) {
+      var buffer, network;
+      network = this.client.get(data.networkId);
+      buffer = network.buffers.getByName(data.bufferName);
+      return buffer.set('membersLoaded', true);
+    };
+
+    EventHandler.prototype.channelMembers = function(e) {
+      console.log('event:channelMembers');
+      this._stream_channelMembers(e.data, e.data.userModes);
+      return this._streamEnd_channelMembers(e.data);
+    };
+
+    EventHandler.prototype._membersBuffer = function(data) {
+      /*
+              Get the channel buffer an event about its members refers to, or
+              null if its members have not been loaded yet.
+      */
+
+      var buffer, network;
+      network = this.client.get(data.networkId);
+      buffer = network.buffers.getByName(data.bufferName);
+      if (buffer != null ? buffer.get('membersLoaded') : void 0) {
+        return buffer;
+      }
+      return null;
+    };
+
+    EventHandler.prototype.snapshot = function(e) {
+      var bufferInfo, data, _i, _j, _k, _len, _len1, _len2, _ref, _ref1, _ref2;
+      console.log('event:snapshot');
+      _ref = e.data.buffers;
+      for (_i = 0, _len = _ref.length; _i < _len; _i++) {
+        bufferInfo = _ref[_i];
+        this._addBuffer(bufferInfo);
+      }
+      _ref1 = e.data.networks;
+      for (_j = 0, _len1 = _ref1.length; _j < _len1; _j++) {
+        data = _ref1[_j];
+        this.initializeNetwork({
+          data: data
+        });
+      }
+      _ref2 = e.data.bufferViews;
+      for (_k = 0, _len2 = _ref2.length; _k < _len2; _k++) {
+        data = _ref2[_k];
+        this.initializeBufferView({
+          data: data
+        });
+      }
+      return this.initializeBufferSyncer({
+        data: e.data.bufferSyncer
+      });
+    };
+
     EventHandler.prototype.initializeBufferSyncer = function(e) {
       var buffer, bufferId, messageId, _i, _len, _ref, _ref1, _results;
       console.log('event:initializeBufferSyncer');
@@ -1167,22 +1476,25 @@
     };
 
     EventHandler.prototype.userModeAdded = function(e) {
-      var buffer, network, user;
+      var buffer, user;
       console.log('event:userModeAdded');
       console.log(e);
-      network = this.client.get(e.data.networkId);
-      buffer = network.buffers.getByName(e.data.bufferName);
+      buffer = this._membersBuffer(e.data);
+      if (!buffer) {
+        return;
+      }
       user = buffer.users.get(e.data.nickname);
       return user.addMode(e.data.mode);
     };
 
     EventHandler.prototype.userModeRemoved = function(e) {
-      var buffer, modeInfo, network, user;
+      var buffer, user;
       console.log('event:userModeRemoved');
       console.log(e);
-      modeInfo = e.data;
-      network = this.client.get(modeInfo.networkId);
-      buffer = network.buffers.getByName(modeInfo.bufferName);
+      buffer = this._membersBuffer(e.data);
+      if (!buffer) {
+        return;
+      }
       user = buffer.users.get(e.data.nickname);
       return user.removeMode(e.data.mode);
     };
@@ -1239,12 +1551,13 @@
     };
 
     EventHandler.prototype.usersJoined = function(e) {
-      var buffer, network;
+      var buffer;
       console.log('event:usersJoined');
       console.log(e);
-      network = this.client.get(e.data.networkId);
-      buffer = network.buffers.getByName(e.data.bufferName);
-      return this._addUsers(buffer, e.data.userModes);
+      buffer = this._membersBuffer(e.data);
+      if (buffer) {
+        return this._addUsers(buffer, e.data.userModes);
+      }
     };
 
     EventHandler.prototype.userParted = function(e) {
@@ -1252,7 +1565,10 @@
       console.log('event:userParted');
       console.log(e);
       network = this.client.get(e.data.networkId);
-      buffer = network.buffers.getByName(e.data.bufferName);
+      buffer = this._membersBuffer(e.data);
+      if (!buffer) {
+        return;
+      }
       if (false) {
         console.log('self leaving');
         return network.buffers.remove([buffer]);
@@ -1270,14 +1586,18 @@
     };
 
     EventHandler.prototype.channelJoined = function(e) {
+      var buffer, network;
       console.log('event:channelJoined');
       console.log(e);
-      return this._addBuffer({
+      this._addBuffer({
         id: this._maxBufferId + 1,
         networkId: e.data.networkId,
         name: e.data.bufferName,
         type: 'channel'
       });
+      network = this.client.get(e.data.networkId);
+      buffer = network.buffers.getByName(e.data.bufferName);
+      return buffer.set('membersLoaded', true);
     };
 
     EventHandler.prototype.bufferAdded = function(e) {
@@ -1387,10 +1707,12 @@
     };
 
     WaffleRouter.prototype._connect = function(creds) {
+      var _ref;
       return this.appView.app.connect({
         url: 'wss://callisto.jsphere.com:8076',
         username: creds.username[0],
         password: creds.password[0],
+        encoding: (_ref = $.totalStorage('encoding')) != null ? _ref : 'json',
         events: {
           authenticated: function() {
             console.log('AUTHENTICATED!!!!');
@@ -1398,8 +1720,14 @@
               trigger: true
             });
           },
-          rejected: function() {
-            return console.log('REJECTED!!!!');
+          rejected: function(reason) {
+            console.log('REJECTED!!!!', reason);
+            if (reason === 'unauthorized') {
+              $.totalStorage('credentials', null);
+              return window.router.navigate('login', {
+                trigger: true
+              });
+            }
           }
         }
       });
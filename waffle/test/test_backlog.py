@@ -0,0 +1,354 @@
+"""
+Tests for L{waffle.quassel.backlog}.
+"""
+from twisted.internet import task
+from twisted.trial import unittest
+
+from waffle.qt.adapters import BufferInfoRecord, MessageBatch, MessageRecord
+from waffle.quassel.backlog import BacklogCache, BacklogScheduler
+
+
+
+_bufferInfo = BufferInfoRecord(7, 1, 2, 0, u'#channel')
+
+
+
+def _message(messageId):
+    return MessageRecord(
+        messageId, 1000 + messageId, u'plain', 0, _bufferInfo,
+        u'nick!user@host', u'message %d' % (messageId,))
+
+
+
+def _batch(messageIds):
+    return MessageBatch.fromRecords(
+        [_message(messageId) for messageId in messageIds])
+
+
+
+class BacklogSchedulerTests(unittest.TestCase):
+    """
+    Tests for L{BacklogScheduler}.
+    """
+    def setUp(self):
+        self.clock = task.Clock()
+        self.requests = []
+        self.cachedBuffers = set()
+        self.scheduler = BacklogScheduler(self._requestBacklog, self.clock)
+        self.scheduler.maxInFlight = 2
+
+
+    def _requestBacklog(self, bufferId, startMessageId, endMessageId, limit):
+        self.requests.append((bufferId, startMessageId, endMessageId, limit))
+        return bufferId in self.cachedBuffers
+
+
+    def _requested(self):
+        return [request[0] for request in self.requests]
+
+
+    def test_notStarted(self):
+        """
+        Nothing is fetched until the buffer view is known.
+        """
+        self.scheduler.addBuffers([1, 2, 3])
+        self.assertEqual(self.requests, [])
+
+
+    def test_inFlightCap(self):
+        """
+        At most C{maxInFlight} requests are outstanding, in the view's order,
+        and each reply frees a slot for the next buffer.
+        """
+        self.scheduler.addBuffers([1, 2, 3, 4])
+        self.scheduler.start([3, 1, 4, 2])
+        self.assertEqual(self.requests, [(3, -1, -1, 50), (1, -1, -1, 50)])
+        self.scheduler.backlogReceived(1)
+        self.assertEqual(self._requested(), [3, 1, 4])
+        self.scheduler.backlogReceived(4)
+        self.scheduler.backlogReceived(3)
+        self.assertEqual(self._requested(), [3, 1, 4, 2])
+        self.assertEqual(self.scheduler.stats()['completed'], 3)
+        self.assertEqual(self.scheduler.stats()['inFlight'], 1)
+
+
+    def test_unknownReply(self):
+        """
+        Replies to requests that are not outstanding do not free a slot.
+        """
+        self.scheduler.addBuffers([1, 2, 3])
+        self.scheduler.start([1, 2, 3])
+        self.scheduler.backlogReceived(3)
+        self.assertEqual(self._requested(), [1, 2])
+        self.assertEqual(self.scheduler.completed, 0)
+
+
+    def test_hidden(self):
+        """
+        Buffers outside the view, or not known to the scheduler, are not
+        fetched, unless C{fetchHidden} is set.
+        """
+        self.scheduler.addBuffers([1, 2, 3])
+        self.scheduler.start([2, 5])
+        self.scheduler.backlogReceived(2)
+        self.assertEqual(self._requested(), [2])
+
+        self.requests = []
+        scheduler = BacklogScheduler(self._requestBacklog, self.clock)
+        scheduler.fetchHidden = True
+        scheduler.addBuffers([1, 2, 3])
+        scheduler.start([2])
+        self.assertEqual(self._requested(), [2, 1, 3])
+
+
+    def test_prioritise(self):
+        """
+        A prioritised buffer is fetched next, whether or not it is hidden,
+        and only once.
+        """
+        self.scheduler.addBuffers([1, 2, 3, 4, 5])
+        self.scheduler.start([1, 2, 3, 4])
+        self.scheduler.prioritise(4)
+        self.scheduler.prioritise(5)
+        self.scheduler.prioritise(1)
+        self.assertEqual(self._requested(), [1, 2])
+        self.scheduler.backlogReceived(1)
+        self.scheduler.backlogReceived(2)
+        self.assertEqual(self._requested(), [1, 2, 5, 4])
+        self.scheduler.backlogReceived(5)
+        self.scheduler.backlogReceived(4)
+        self.assertEqual(self._requested(), [1, 2, 5, 4, 3])
+
+
+    def test_prioritiseBeforeStart(self):
+        """
+        A buffer prioritised before the view is known is fetched at once.
+        """
+        self.scheduler.addBuffers([1, 2])
+        self.scheduler.prioritise(2)
+        self.assertEqual(self._requested(), [2])
+        self.scheduler.start([1, 2])
+        self.assertEqual(self._requested(), [2, 1])
+
+
+    def test_cached(self):
+        """
+        Requests answered without asking the core do not take a slot.
+        """
+        self.cachedBuffers.update([1, 2])
+        self.scheduler.addBuffers([1, 2, 3, 4])
+        self.scheduler.start([1, 2, 3, 4])
+        self.assertEqual(self._requested(), [1, 2, 3, 4])
+        self.assertEqual(self.scheduler.cached, 2)
+        self.assertEqual(self.scheduler.stats()['inFlight'], 2)
+
+
+    def test_timeout(self):
+        """
+        A request without a reply within C{requestTimeout} seconds is given
+        up on, freeing its slot, and a late reply is ignored.
+        """
+        self.scheduler.addBuffers([1, 2, 3])
+        self.scheduler.start([1, 2, 3])
+        self.clock.advance(10)
+        self.scheduler.backlogReceived(2)
+        self.assertEqual(self._requested(), [1, 2, 3])
+        self.clock.advance(self.scheduler.requestTimeout - 10)
+        self.assertEqual(self.scheduler.timedOut, 1)
+        self.assertEqual(self.scheduler.stats()['inFlight'], 1)
+        self.scheduler.backlogReceived(1)
+        self.assertEqual(self.scheduler.completed, 1)
+        self.assertEqual(list(self.scheduler.latencies), [10])
+
+
+    def test_latency(self):
+        """
+        The time each request took is recorded.
+        """
+        self.scheduler.addBuffers([1, 2])
+        self.scheduler.start([1, 2])
+        self.clock.advance(2)
+        self.scheduler.backlogReceived(2)
+        self.clock.advance(4)
+        self.scheduler.backlogReceived(1)
+        stats = self.scheduler.stats()
+        self.assertEqual(stats['meanLatency'], 4)
+        self.assertEqual(stats['maxLatency'], 6)
+
+
+    def test_stop(self):
+        """
+        Stopping cancels outstanding timeouts and fetches nothing more.
+        """
+        self.scheduler.addBuffers([1, 2, 3])
+        self.scheduler.start([1, 2, 3])
+        self.scheduler.stop()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.scheduler.backlogReceived(1)
+        self.assertEqual(self._requested(), [1, 2])
+
+
+
+class BacklogCacheTests(unittest.TestCase):
+    """
+    Tests for L{BacklogCache}.
+    """
+    def setUp(self):
+        self.cache = BacklogCache()
+        self.key = ('alice', 7)
+
+
+    def _ids(self, messages):
+        return list(messages.ids)
+
+
+    def test_miss(self):
+        """
+        Buffers not cached are fetched in full.
+        """
+        self.assertEqual(self.cache.lookup(self.key, 50), (None, -1))
+        self.assertEqual(self.cache.misses, 1)
+        self.assertIdentical(self.cache.recent(self.key, 50), None)
+
+
+    def test_hit(self):
+        """
+        A current buffer's newest messages are served without fetching
+        anything.
+        """
+        self.cache.backlogReceived(self.key, _batch(range(1, 61)), -1, 60)
+        messages, start = self.cache.lookup(self.key, 50)
+        self.assertEqual(self._ids(messages), range(11, 61))
+        self.assertIdentical(start, None)
+        self.assertEqual(self.cache.hits, 1)
+
+
+    def test_tooFew(self):
+        """
+        Fewer messages than wanted are a miss, unless they are the buffer's
+        oldest.
+        """
+        self.cache.backlogReceived(self.key, _batch(range(1, 11)), 5, 10)
+        self.assertEqual(self.cache.lookup(self.key, 20), (None, -1))
+        self.cache.backlogReceived(('alice', 8), _batch(range(1, 11)), -1, 50)
+        messages, start = self.cache.lookup(('alice', 8), 20)
+        self.assertEqual(self._ids(messages), range(1, 11))
+        self.assertIdentical(start, None)
+
+
+    def test_addMessage(self):
+        """
+        Messages arriving for a current buffer are added to it, unless they
+        are already cached.
+        """
+        self.cache.backlogReceived(self.key, _batch(range(1, 11)), -1, 50)
+        size = self.cache.bytes
+        self.cache.addMessage(self.key, _message(11))
+        self.assertTrue(self.cache.bytes > size)
+        size = self.cache.bytes
+        self.cache.addMessage(self.key, _message(5))
+        self.cache.addMessage(('alice', 8), _message(12))
+        self.assertEqual(self.cache.bytes, size)
+        self.assertEqual(
+            self._ids(self.cache.recent(self.key, 50)), range(1, 12))
+        self.assertEqual(len(self.cache), 1)
+
+
+    def test_maxMessages(self):
+        """
+        No more than C{maxMessages} messages are cached for each buffer, and
+        trimming them makes the buffer incomplete.
+        """
+        self.cache.maxMessages = 10
+        self.cache.backlogReceived(self.key, _batch(range(1, 11)), -1, 50)
+        self.cache.addMessage(self.key, _message(11))
+        self.assertEqual(
+            self._ids(self.cache.recent(self.key, 50)), range(2, 12))
+        self.assertEqual(self.cache.lookup(self.key, 20), (None, -1))
+
+
+    def test_partialHit(self):
+        """
+        Once a buffer is no longer kept current, its cached messages are
+        served and only newer messages are fetched, then merged in.
+        """
+        self.cache.backlogReceived(self.key, _batch(range(1, 11)), -1, 50)
+        self.cache.expire('alice')
+        self.cache.addMessage(self.key, _message(11))
+        messages, start = self.cache.lookup(self.key, 5)
+        self.assertEqual(self._ids(messages), range(6, 11))
+        self.assertEqual(start, 11)
+        self.assertEqual(self.cache.partialHits, 1)
+
+        self.cache.backlogReceived(self.key, _batch(range(11, 14)), 11, 50)
+        messages, start = self.cache.lookup(self.key, 50)
+        self.assertEqual(self._ids(messages), range(1, 14))
+        self.assertIdentical(start, None)
+
+
+    def test_partialHitGap(self):
+        """
+        When as many newer messages arrive as were requested, there may be a
+        gap before them, so older cached messages are dropped.
+        """
+        self.cache.backlogReceived(self.key, _batch(range(1, 11)), -1, 50)
+        self.cache.expire('alice')
+        messages, start = self.cache.lookup(self.key, 5)
+        self.cache.backlogReceived(self.key, _batch(range(100, 105)), start, 5)
+        messages, start = self.cache.lookup(self.key, 5)
+        self.assertEqual(self._ids(messages), range(100, 105))
+        self.assertIdentical(start, None)
+        self.assertEqual(self.cache.lookup(self.key, 10), (None, -1))
+
+
+    def test_partialHitOverlap(self):
+        """
+        A full reply overlapping the cached messages keeps the cached
+        messages it overlaps.
+        """
+        self.cache.backlogReceived(self.key, _batch(range(1, 11)), -1, 50)
+        self.cache.expire('alice')
+        self.cache.backlogReceived(self.key, _batch(range(8, 13)), 8, 5)
+        self.assertEqual(
+            self._ids(self.cache.recent(self.key, 50)), range(8, 13))
+
+
+    def test_expire(self):
+        """
+        Only the expired account's buffers stop being kept current.
+        """
+        self.cache.backlogReceived(self.key, _batch(range(1, 11)), -1, 50)
+        self.cache.backlogReceived(('bob', 7), _batch(range(1, 11)), -1, 50)
+        self.cache.expire('alice')
+        self.cache.addMessage(self.key, _message(11))
+        self.cache.addMessage(('bob', 7), _message(11))
+        self.assertEqual(self.cache.lookup(self.key, 5)[1], 11)
+        self.assertIdentical(self.cache.lookup(('bob', 7), 5)[1], None)
+
+
+    def test_evictLeastRecentlyUsed(self):
+        """
+        Once more than C{maxBytes} are cached, the least recently used
+        buffers are evicted.
+        """
+        for bufferId in [1, 2, 3]:
+            self.cache.backlogReceived(
+                ('alice', bufferId), _batch(range(1, 11)), -1, 50)
+        self.cache.maxBytes = self.cache.bytes
+        self.cache.lookup(('alice', 1), 5)
+        self.cache.addMessage(('alice', 3), _message(11))
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.evictions, 1)
+        self.assertEqual(self.cache.lookup(('alice', 2), 5), (None, -1))
+        self.assertIdentical(self.cache.lookup(('alice', 1), 5)[1], None)
+        self.assertTrue(self.cache.bytes <= self.cache.maxBytes)
+
+
+    def test_evictLarge(self):
+        """
+        A buffer larger than C{maxBytes} on its own is not kept.
+        """
+        self.cache.maxBytes = 100
+        self.cache.backlogReceived(self.key, _batch(range(1, 11)), -1, 50)
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.bytes, 0)
@@ -0,0 +1,226 @@
+"""
+Tests for L{waffle.qt.codec}.
+"""
+import random
+from datetime import datetime, time
+
+from construct import Container, Rename, Struct
+from twisted.trial import unittest
+
+from waffle.benchmark import corpus
+from waffle.qt import adapters, codec, types
+from waffle.qt.quassel import messageFlags
+
+
+
+def _bufferInfo(name=u'#channel'):
+    return adapters.UserType('BufferInfo', adapters.BufferInfo({
+        u'id': 7, u'networkId': 1, u'type': 'channel', u'groupId': 0,
+        u'name': name}))
+
+
+
+def _serializeMessage(self):
+    """
+    Serialize a message for the Construct types, which
+    L{adapters.MessageInfo} does not implement.
+    """
+    record = self.value
+    bufferInfo = record.bufferInfo
+    flags = Container()
+    for name, bit in messageFlags.iteritems():
+        setattr(flags, name, bool(record.flags & bit))
+    return Container(
+        id=record.id,
+        timestamp=record.timestamp,
+        type=record.type,
+        flags=flags,
+        bufferInfo=Container(
+            id=bufferInfo.id,
+            networkId=bufferInfo.networkId,
+            type=bufferInfo.type,
+            groupId=bufferInfo.groupId,
+            name=bufferInfo.name),
+        sender=record.sender,
+        content=record.content)
+
+
+
+class EncoderTests(unittest.TestCase):
+    """
+    Tests for L{codec.QVariantEncoder}, which must produce the same bytes as
+    L{codec.ConstructEncoder}.
+    """
+    def setUp(self):
+        self.encoder = codec.QVariantEncoder()
+        self.constructEncoder = codec.ConstructEncoder()
+        self.patch(adapters.MessageInfo, 'serialize', _serializeMessage)
+
+
+    def assertSameEncoding(self, value):
+        """
+        Assert that L{codec.QVariantEncoder} encodes C{value} to the same
+        bytes as L{codec.ConstructEncoder}.
+        """
+        self.assertEqual(
+            self.encoder.encode(value), self.constructEncoder.encode(value))
+
+
+    def test_corpus(self):
+        """
+        Every value in the benchmark corpus is encoded to the same bytes.
+        """
+        for case in corpus.generate(random.Random(0), 0.05):
+            for value in case.values:
+                self.assertSameEncoding(value)
+
+
+    def test_scalars(self):
+        """
+        Scalars are encoded to the same bytes.
+        """
+        for value in [
+                adapters.Bool(True), adapters.Bool(False),
+                adapters.Int(-2 ** 31), adapters.Int(2 ** 31 - 1),
+                adapters.UInt(2 ** 32 - 1), adapters.Short(-1),
+                adapters.UShort(65535), adapters.QChar(0xe9),
+                adapters.QChar(0x263a)]:
+            self.assertSameEncoding(value)
+
+
+    def test_strings(self):
+        """
+        Strings, including empty and non-BMP ones, are encoded to the same
+        bytes.
+        """
+        for value in [
+                adapters.QString(u''), adapters.QString(u'caf\xe9'),
+                adapters.QString(u'\U0001f600'), adapters.QByteArray(''),
+                adapters.QByteArray('\x00\xff'), adapters.QStringList([]),
+                adapters.QStringList([u'', u'a', u'\u263a'])]:
+            self.assertSameEncoding(value)
+
+
+    def test_times(self):
+        """
+        C{QTime} and C{QDateTime} are encoded to the same bytes.
+        """
+        self.assertSameEncoding(adapters.QTime(time(0, 0)))
+        self.assertSameEncoding(adapters.QTime(time(23, 59, 59, 999000)))
+        dt = datetime(2012, 3, 13, 1, 2, 3, 4000)
+        self.assertSameEncoding(adapters.QDateTime.fromDateTime(dt))
+        self.assertSameEncoding(
+            adapters.QDateTime.fromDateTime(dt, isUTC=True))
+
+
+    def test_userTypes(self):
+        """
+        User types are encoded to the same bytes.
+        """
+        record = adapters.MessageRecord(
+            1, 1331600000, 'action', messageFlags['self'] |
+            messageFlags['highlight'], adapters.BufferInfoRecord(
+                7, 1, 'query', 0, 'nick'),
+            'nick!user@host', 'caf\xc3\xa9')
+        for value in [
+                _bufferInfo(), _bufferInfo('#caf\xc3\xa9'),
+                adapters.UserType('BufferId', adapters.Int(7)),
+                adapters.UserType('MsgId', adapters.Int(-1)),
+                adapters.UserType('NetworkId', adapters.Int(1)),
+                adapters.UserType('IdentityId', adapters.Int(1)),
+                adapters.UserType('Message', adapters.MessageInfo(record)),
+                adapters.UserType('Network::Server', adapters.QVariantMap({
+                    u'Host': adapters.QString(u'irc.example.net'),
+                    u'Port': adapters.UInt(6667)}))]:
+            self.assertSameEncoding(value)
+
+
+    def test_nested(self):
+        """
+        Nested maps and lists are encoded to the same bytes.
+        """
+        self.assertSameEncoding(adapters.QVariantMap({}))
+        self.assertSameEncoding(adapters.QVariantList([]))
+        self.assertSameEncoding(adapters.QVariantMap({
+            u'': adapters.QString(u''),
+            u'list': adapters.QVariantList([
+                adapters.QVariantMap({
+                    u'buffer': _bufferInfo(),
+                    u'empty': adapters.QVariantList([])}),
+                adapters.QVariantList([adapters.Int(1), adapters.Bool(True)]),
+                adapters.QStringList([u'x'])]),
+            u'caf\xe9': adapters.QVariantMap({
+                u'time': adapters.QTime(time(12, 0))})}))
+
+
+    def test_unknownUserType(self):
+        """
+        Encoding an unregistered user type raises L{codec.EncodeError}.
+        """
+        self.assertRaises(
+            codec.EncodeError, self.encoder.encode,
+            adapters.UserType('Unknown', adapters.Int(1)))
+
+
+
+class _Point(object):
+    """
+    Value of the C{Test::Point} UserType, serialized with Construct.
+    """
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+
+    def serialize(self):
+        return Container(x=self.x, y=self.y)
+
+
+
+class UserTypeRegistryTests(unittest.TestCase):
+    """
+    Tests for UserTypes registered with L{types.registerUserType}.
+    """
+    def register(self, name, schema):
+        self.addCleanup(types._userTypeTypes.pop, name)
+        types.registerUserType(name, schema)
+
+
+    def test_registeredSchema(self):
+        """
+        A registered UserType with a schema the encoder has a direct writer
+        for is encoded, and decoded, like its schema's type.
+        """
+        self.register('Test::Id', types.Int)
+        value = adapters.UserType('Test::Id', adapters.Int(-5))
+        data = codec.QVariantEncoder().encode(value)
+        self.assertEqual(
+            data[-4:], codec.QVariantEncoder().encode(adapters.Int(-5))[-4:])
+        self.assertEqual(codec.QVariantDecoder().decode(data), -5)
+
+
+    def test_registeredStruct(self):
+        """
+        A registered UserType with any other schema is encoded with
+        Construct, and decoded.
+        """
+        self.register(
+            'Test::Point',
+            Struct('Point', Rename('x', types.Int), Rename('y', types.Int)))
+        data = codec.QVariantEncoder().encode(
+            adapters.UserType('Test::Point', _Point(3, -4)))
+        self.assertEqual(data[-8:], '\x00\x00\x00\x03\xff\xff\xff\xfc')
+        point = codec.QVariantDecoder().decode(data)
+        self.assertEqual((point.x, point.y), (3, -4))
+
+
+    def test_unregistered(self):
+        """
+        Encoding a UserType that was not registered when the encoder was
+        created raises L{codec.EncodeError}.
+        """
+        encoder = codec.QVariantEncoder()
+        self.register('Test::Id', types.Int)
+        self.assertRaises(
+            codec.EncodeError, encoder.encode,
+            adapters.UserType('Test::Id', adapters.Int(1)))
@@ -0,0 +1,443 @@
+"""
+Tests for L{waffle.deflate}.
+"""
+import struct
+import zlib
+
+from twisted.internet.protocol import Factory, Protocol
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+from txws import WSException, mask
+
+from waffle.deflate import (
+    parseExtensions, parseFrames, PerMessageDeflate, DeflateWebSocketFactory)
+
+
+
+_KEY = '\x01\x02\x03\x04'
+
+
+
+def _clientFrame(data, opcode=0x1, compressed=False, fin=True):
+    """
+    Build a masked frame, as sent by a client.
+    """
+    header = opcode
+    if fin:
+        header |= 0x80
+    if compressed:
+        header |= 0x40
+    if len(data) < 0x7e:
+        length = struct.pack('>BB', header, 0x80 | len(data))
+    else:
+        length = struct.pack('>BBH', header, 0x80 | 0x7e, len(data))
+    return length + _KEY + mask(data, _KEY)
+
+
+
+def _inflate(data):
+    """
+    Decompress a message compressed without context takeover.
+    """
+    return zlib.decompressobj(-15).decompress(data + '\x00\x00\xff\xff')
+
+
+
+class _Echo(Protocol):
+    """
+    Protocol recording the data it receives, and echoing it back.
+    """
+    def connectionMade(self):
+        self.received = []
+
+
+    def dataReceived(self, data):
+        self.received.append(data)
+        self.transport.write(data)
+
+
+
+class ParseExtensionsTests(unittest.TestCase):
+    """
+    Tests for L{parseExtensions}.
+    """
+    def test_offers(self):
+        """
+        Offers are returned in order, with their parameters; parameters
+        without a value map to C{None}, and quoted values are unquoted.
+        """
+        self.assertEqual(
+            parseExtensions(
+                'permessage-deflate; client_max_window_bits; '
+                'server_max_window_bits="10", x-webkit-deflate-frame'),
+            [('permessage-deflate',
+              {'client_max_window_bits': None,
+               'server_max_window_bits': '10'}),
+             ('x-webkit-deflate-frame', {})])
+
+
+    def test_empty(self):
+        """
+        Empty offers are skipped.
+        """
+        self.assertEqual(
+            parseExtensions(' , permessage-deflate,'),
+            [('permessage-deflate', {})])
+
+
+
+class ParseFramesTests(unittest.TestCase):
+    """
+    Tests for L{parseFrames}.
+    """
+    def test_frames(self):
+        """
+        Masked frames are unmasked, and RSV1 is reported as the message being
+        compressed.
+        """
+        buf = (_clientFrame('a' * 200, compressed=True) +
+               _clientFrame('b', opcode=0x0, fin=False))
+        self.assertEqual(
+            parseFrames(buf),
+            ([(True, True, 0x1, 'a' * 200), (False, False, 0x0, 'b')], ''))
+
+
+    def test_partial(self):
+        """
+        An incomplete frame is returned as the remaining data.
+        """
+        frame = _clientFrame('hello')
+        self.assertEqual(
+            parseFrames(frame + frame[:4]),
+            ([(True, False, 0x1, 'hello')], frame[:4]))
+
+
+    def test_reserved(self):
+        """
+        A reserved bit other than RSV1 is an error.
+        """
+        frame = _clientFrame('hello')
+        self.assertRaises(
+            WSException, parseFrames, chr(ord(frame[0]) | 0x20) + frame[1:])
+
+
+
+class PerMessageDeflateTests(unittest.TestCase):
+    """
+    Tests for L{PerMessageDeflate}.
+    """
+    def test_acceptNoOffer(self):
+        """
+        Nothing is accepted unless permessage-deflate is offered.
+        """
+        self.assertIdentical(PerMessageDeflate.accept([]), None)
+        self.assertIdentical(
+            PerMessageDeflate.accept([('x-webkit-deflate-frame', {})]), None)
+
+
+    def test_accept(self):
+        """
+        A plain offer is accepted with context takeover in both directions.
+        """
+        deflate, response = PerMessageDeflate.accept(
+            [('permessage-deflate', {})])
+        self.assertEqual(response, 'permessage-deflate')
+        self.assertTrue(deflate.serverContextTakeover)
+        self.assertTrue(deflate.clientContextTakeover)
+        self.assertEqual(deflate.serverWindowBits, 15)
+
+
+    def test_acceptParameters(self):
+        """
+        The client's parameters are honoured and echoed back.
+        """
+        deflate, response = PerMessageDeflate.accept(
+            [('permessage-deflate',
+              {'server_max_window_bits': '10',
+               'server_no_context_takeover': None,
+               'client_no_context_takeover': None})])
+        self.assertEqual(
+            response,
+            'permessage-deflate; server_max_window_bits=10; '
+            'server_no_context_takeover; client_no_context_takeover')
+        self.assertFalse(deflate.serverContextTakeover)
+        self.assertFalse(deflate.clientContextTakeover)
+        self.assertEqual(deflate.serverWindowBits, 10)
+
+
+    def test_acceptInvalidWindowBits(self):
+        """
+        Offers with a window zlib cannot produce are skipped in favour of
+        later offers.
+        """
+        deflate, response = PerMessageDeflate.accept(
+            [('permessage-deflate', {'server_max_window_bits': '8'}),
+             ('permessage-deflate', {'server_max_window_bits': 'x'}),
+             ('permessage-deflate', {})])
+        self.assertEqual(response, 'permessage-deflate')
+        self.assertIdentical(
+            PerMessageDeflate.accept(
+                [('permessage-deflate', {'server_max_window_bits': None})]),
+            None)
+
+
+    def test_acceptNoContextTakeover(self):
+        """
+        The server can decline context takeover for the messages it sends.
+        """
+        deflate, response = PerMessageDeflate.accept(
+            [('permessage-deflate', {})], contextTakeover=False)
+        self.assertEqual(
+            response, 'permessage-deflate; server_no_context_takeover')
+        self.assertFalse(deflate.serverContextTakeover)
+
+
+    def test_roundTrip(self):
+        """
+        Compressed messages leave out the trailing empty block, and decompress
+        to the original message.
+        """
+        message = 'hello world ' * 50
+        compressed = PerMessageDeflate().compress(message)
+        self.assertFalse(compressed.endswith('\x00\x00\xff\xff'))
+        self.assertTrue(len(compressed) < len(message))
+        self.assertEqual(_inflate(compressed), message)
+        self.assertEqual(
+            PerMessageDeflate().decompress(compressed, len(message)),
+            message)
+
+
+    def test_contextTakeover(self):
+        """
+        With context takeover, later messages are compressed against earlier
+        ones, and so only decompress with the same context.
+        """
+        message = 'hello world ' * 50
+        sender, receiver = PerMessageDeflate(), PerMessageDeflate()
+        first = sender.compress(message)
+        second = sender.compress(message)
+        self.assertTrue(len(second) < len(first))
+        self.assertEqual(receiver.decompress(first, 1024), message)
+        self.assertEqual(receiver.decompress(second, 1024), message)
+        self.assertRaises(
+            WSException, PerMessageDeflate().decompress, second, 1024)
+
+
+    def test_noContextTakeover(self):
+        """
+        Without context takeover, every message is compressed on its own.
+        """
+        message = 'hello world ' * 50
+        sender = PerMessageDeflate(serverContextTakeover=False)
+        first = sender.compress(message)
+        second = sender.compress(message)
+        self.assertEqual(first, second)
+        self.assertEqual(_inflate(second), message)
+        receiver = PerMessageDeflate(clientContextTakeover=False)
+        self.assertEqual(receiver.decompress(first, 1024), message)
+        self.assertEqual(receiver.decompress(second, 1024), message)
+
+
+    def test_decompressTooLong(self):
+        """
+        Messages decompressing to more than the permitted length are
+        rejected.
+        """
+        compressed = PerMessageDeflate().compress('a' * 1000)
+        self.assertRaises(
+            WSException, PerMessageDeflate().decompress, compressed, 999)
+
+
+    def test_decompressInvalid(self):
+        """
+        Invalid compressed data is rejected.
+        """
+        self.assertRaises(
+            WSException, PerMessageDeflate().decompress, '\xff\xff', 1024)
+
+
+
+class DeflateWebSocketProtocolTests(unittest.TestCase):
+    """
+    Tests for L{DeflateWebSocketProtocol}, through L{DeflateWebSocketFactory}.
+    """
+    def _connect(self, extensions=None, **kw):
+        factory = DeflateWebSocketFactory(Factory.forProtocol(_Echo), **kw)
+        protocol = factory.buildProtocol(None)
+        transport = StringTransport()
+        protocol.makeConnection(transport)
+        headers = [
+            'GET /ws HTTP/1.1',
+            'Host: example.com',
+            'Upgrade: websocket',
+            'Connection: Upgrade',
+            'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==',
+            'Sec-WebSocket-Version: 13']
+        if extensions is not None:
+            headers.append('Sec-WebSocket-Extensions: ' + extensions)
+        protocol.dataReceived('\r\n'.join(headers) + '\r\n\r\n')
+        head, sep, rest = transport.value().partition('\r\n\r\n')
+        transport.clear()
+        self.assertEqual(rest, '')
+        return protocol, transport, head.split('\r\n')
+
+
+    def _sent(self, transport):
+        frames, rest = parseFrames(transport.value())
+        self.assertEqual(rest, '')
+        transport.clear()
+        return frames
+
+
+    def test_noExtension(self):
+        """
+        A client offering no extension gets none, and plain frames both
+        ways.
+        """
+        protocol, transport, head = self._connect()
+        self.assertIdentical(protocol.deflate, None)
+        self.assertFalse(
+            [h for h in head if h.startswith('Sec-WebSocket-Extensions')])
+        message = 'hello world ' * 50
+        protocol.dataReceived(_clientFrame(message))
+        self.assertEqual(protocol.wrappedProtocol.received, [message])
+        self.assertEqual(
+            self._sent(transport), [(True, False, 0x1, message)])
+
+
+    def test_otherExtension(self):
+        """
+        A client offering only other extensions gets none.
+        """
+        protocol, transport, head = self._connect('x-webkit-deflate-frame')
+        self.assertIdentical(protocol.deflate, None)
+        self.assertFalse(
+            [h for h in head if h.startswith('Sec-WebSocket-Extensions')])
+
+
+    def test_disabled(self):
+        """
+        The extension is declined when the factory disables it.
+        """
+        self.patch(DeflateWebSocketFactory, 'deflate', False)
+        protocol, transport, head = self._connect('permessage-deflate')
+        self.assertIdentical(protocol.deflate, None)
+        self.assertFalse(
+            [h for h in head if h.startswith('Sec-WebSocket-Extensions')])
+
+
+    def test_negotiated(self):
+        """
+        An offer of permessage-deflate is accepted in the handshake, which
+        still completes.
+        """
+        protocol, transport, head = self._connect(
+            'permessage-deflate; client_max_window_bits',
+            contextTakeover=False, compressionLevel=9)
+        self.assertIn(
+            'Sec-WebSocket-Extensions: permessage-deflate; '
+            'server_no_context_takeover', head)
+        self.assertIn(
+            'Sec-WebSocket-Accept: s3pPLMBiTxaQ9kYGzzhZRbK+xOo=', head)
+        self.assertFalse(protocol.deflate.serverContextTakeover)
+        self.assertEqual(protocol.deflate.level, 9)
+
+
+    def test_roundTrip(self):
+        """
+        Compressed messages are decompressed for the wrapped protocol, and
+        large messages it writes are compressed, with RSV1 set.
+        """
+        protocol, transport, head = self._connect('permessage-deflate')
+        message = 'hello world ' * 50
+        compressed = PerMessageDeflate().compress(message)
+        protocol.dataReceived(_clientFrame(compressed, compressed=True))
+        self.assertEqual(protocol.wrappedProtocol.received, [message])
+        [(fin, isCompressed, opcode, data)] = self._sent(transport)
+        self.assertTrue(fin)
+        self.assertTrue(isCompressed)
+        self.assertEqual(opcode, 0x1)
+        self.assertEqual(_inflate(data), message)
+
+
+    def test_fragmented(self):
+        """
+        A compressed message split over continuation frames is joined before
+        it is decompressed.
+        """
+        protocol, transport, head = self._connect('permessage-deflate')
+        message = 'hello world ' * 50
+        compressed = PerMessageDeflate().compress(message)
+        protocol.dataReceived(
+            _clientFrame(compressed[:5], compressed=True, fin=False) +
+            _clientFrame(compressed[5:], opcode=0x0))
+        self.assertEqual(protocol.wrappedProtocol.received, [message])
+
+
+    def test_smallUncompressed(self):
+        """
+        Messages shorter than the factory's C{minCompressSize} are sent
+        uncompressed, and uncompressed messages from the client are accepted.
+        """
+        protocol, transport, head = self._connect(
+            'permessage-deflate', minCompressSize=10)
+        protocol.dataReceived(_clientFrame('hello'))
+        self.assertEqual(protocol.wrappedProtocol.received, ['hello'])
+        self.assertEqual(self._sent(transport), [(True, False, 0x1, 'hello')])
+
+
+    def test_contextTakeover(self):
+        """
+        With context takeover, the client must keep its decompression context
+        between messages, and later repeats compress better.
+        """
+        protocol, transport, head = self._connect('permessage-deflate')
+        message = 'hello world ' * 50
+        protocol.wrappedProtocol.transport.write(message)
+        protocol.wrappedProtocol.transport.write(message)
+        [first, second] = self._sent(transport)
+        self.assertTrue(len(second[3]) < len(first[3]))
+        client = PerMessageDeflate()
+        self.assertEqual(client.decompress(first[3], 1024), message)
+        self.assertEqual(client.decompress(second[3], 1024), message)
+
+
+    def test_noContextTakeover(self):
+        """
+        Without context takeover, every message decompresses on its own.
+        """
+        protocol, transport, head = self._connect(
+            'permessage-deflate; server_no_context_takeover')
+        message = 'hello world ' * 50
+        protocol.wrappedProtocol.transport.write(message)
+        protocol.wrappedProtocol.transport.write(message)
+        [first, second] = self._sent(transport)
+        self.assertEqual(_inflate(first[3]), message)
+        self.assertEqual(_inflate(second[3]), message)
+
+
+    def test_controlFrames(self):
+        """
+        Pings are not mistaken for messages, and a close frame from the
+        client is answered with an uncompressed close frame.
+        """
+        protocol, transport, head = self._connect(
+            'permessage-deflate', minCompressSize=0)
+        protocol.dataReceived(_clientFrame('ping', opcode=0x9))
+        self.assertEqual(protocol.wrappedProtocol.received, [])
+        protocol.dataReceived(
+            _clientFrame(struct.pack('>H', 1000) + 'bye', opcode=0x8))
+        self.assertEqual(self._sent(transport), [(True, False, 0x8, '')])
+        self.assertTrue(transport.disconnecting)
+
+
+    def test_invalidMessage(self):
+        """
+        An invalid compressed message closes the connection.
+        """
+        protocol, transport, head = self._connect('permessage-deflate')
+        protocol.dataReceived(_clientFrame('\xff\xff', compressed=True))
+        self.assertEqual(protocol.wrappedProtocol.received, [])
+        [(fin, compressed, opcode, data)] = self._sent(transport)
+        self.assertEqual((compressed, opcode), (False, 0x8))
+        self.assertTrue(transport.disconnecting)
@@ -0,0 +1,228 @@
+"""
+Tests for L{waffle.encoding}.
+"""
+import json
+import struct
+
+from twisted.trial import unittest
+
+from waffle.encoding import CompactEncoding, JSONEncoding, wellKnownStrings
+
+
+
+def _decodeCompact(data, strings):
+    """
+    Decode a value in the compact encoding, as the web client does.
+
+    @return: C{(value, rest)}, the value and the data following it.
+    """
+    def _varint(data):
+        n = shift = 0
+        while True:
+            byte = ord(data[0])
+            data = data[1:]
+            n |= (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                return n, data
+
+    tag, data = ord(data[0]), data[1:]
+    if tag & CompactEncoding.SMALL_INT:
+        return tag & 0x7f, data
+    if tag in (CompactEncoding.NULL, CompactEncoding.FALSE,
+               CompactEncoding.TRUE):
+        return [None, False, True][tag], data
+    if tag == CompactEncoding.INT:
+        zigzag, data = _varint(data)
+        return (zigzag >> 1) ^ -(zigzag & 1), data
+    if tag == CompactEncoding.FLOAT:
+        return struct.unpack('>d', data[:8])[0], data[8:]
+    if tag == CompactEncoding.STRING:
+        length, data = _varint(data)
+        return data[:length].decode('utf-8'), data[length:]
+    if tag == CompactEncoding.REF:
+        index, data = _varint(data)
+        return strings[index], data
+    if tag == CompactEncoding.ARRAY:
+        count, data = _varint(data)
+        items = []
+        for i in xrange(count):
+            item, data = _decodeCompact(data, strings)
+            items.append(item)
+        return items, data
+    if tag == CompactEncoding.MAP:
+        count, data = _varint(data)
+        items = {}
+        for i in xrange(count):
+            key, data = _decodeCompact(data, strings)
+            items[key], data = _decodeCompact(data, strings)
+        return items, data
+    raise ValueError('Unknown tag %d' % (tag,))
+
+
+
+class _Record(object):
+    """
+    Value that knows how to convert itself to JSON.
+    """
+    def toJSON(self):
+        return {u'id': 1}
+
+
+
+class JSONEncodingTests(unittest.TestCase):
+    """
+    Tests for L{JSONEncoding}.
+    """
+    def test_encode(self):
+        """
+        Events are encoded as JSON objects of their type and data, values
+        with a C{toJSON} method are encoded as what it returns.
+        """
+        data = JSONEncoding().encode(u'message', [_Record()])
+        self.assertEqual(
+            json.loads(data), {u'type': u'message', u'data': [{u'id': 1}]})
+
+
+    def test_encodeBatch(self):
+        """
+        A batch is a C{batch} event of encoded events.
+        """
+        encoding = JSONEncoding()
+        data = encoding.encodeBatch(
+            [encoding.encode(u'a', 1), encoding.encode(u'b', 2)])
+        self.assertEqual(json.loads(data), {
+            u'type': u'batch',
+            u'data': [{u'type': u'a', u'data': 1},
+                      {u'type': u'b', u'data': 2}]})
+
+
+
+class CompactEncodingTests(unittest.TestCase):
+    """
+    Tests for L{CompactEncoding}.
+    """
+    def setUp(self):
+        self.encoding = CompactEncoding()
+
+
+    def _roundTrip(self, value):
+        data = self.encoding.encode(u'message', value)
+        event, rest = _decodeCompact(data, self.encoding.strings)
+        self.assertEqual(rest, '')
+        self.assertEqual(event[0], u'message')
+        return event[1]
+
+
+    def test_constants(self):
+        """
+        C{None}, C{False} and C{True} are encoded as a single tag byte.
+        """
+        for value in [None, False, True]:
+            self.assertIdentical(self._roundTrip(value), value)
+        self.assertEqual(
+            self.encoding.encode(u'message', [None, False, True])[-3:],
+            '\x00\x01\x02')
+
+
+    def test_smallIntegers(self):
+        """
+        Integers from 0 to 127 are encoded as a single byte.
+        """
+        for value in [0, 1, 127]:
+            self.assertEqual(self._roundTrip(value), value)
+        self.assertEqual(self.encoding.encode(u'message', 127)[-1], '\xff')
+
+
+    def test_integers(self):
+        """
+        Other integers are encoded as zigzag varints.
+        """
+        for value in [128, 300, -1, -64, -65, 2 ** 31, -2 ** 31, 2 ** 62]:
+            self.assertEqual(self._roundTrip(value), value)
+        self.assertEqual(
+            self.encoding.encode(u'message', -1)[-2:], '\x03\x01')
+        self.assertEqual(
+            self.encoding.encode(u'message', 300)[-3:], '\x03\xd8\x04')
+
+
+    def test_floats(self):
+        """
+        Floats are encoded as doubles.
+        """
+        for value in [0.5, -1.25, 1e100]:
+            self.assertEqual(self._roundTrip(value), value)
+
+
+    def test_strings(self):
+        """
+        Strings are encoded as UTF-8.
+        """
+        for value in [u'', u'plain', u'\N{SNOWMAN} caf\xe9', u'\U0001f600']:
+            self.assertEqual(self._roundTrip(value), value)
+        self.assertEqual(self._roundTrip('bytes'), u'bytes')
+
+
+    def test_wellKnownStrings(self):
+        """
+        Well-known strings are encoded as a reference into the table.
+        """
+        index = wellKnownStrings.index(u'networkId')
+        self.assertEqual(
+            self.encoding.encode(u'message', u'networkId')[-2:],
+            '\x08' + chr(index))
+        self.assertEqual(self._roundTrip(u'networkId'), u'networkId')
+
+
+    def test_customStrings(self):
+        """
+        Only the strings in the encoding's table are encoded as references.
+        """
+        encoding = CompactEncoding([u'custom'])
+        self.assertEqual(encoding.encode(u'custom', u'networkId'), (
+            '\x06\x02\x08\x00\x05\x09networkId'))
+
+
+    def test_nested(self):
+        """
+        Lists, tuples and maps are encoded with their values, non-string keys
+        become strings.
+        """
+        value = {
+            u'networkId': 1,
+            u'users': [{u'nick': u'alice', u'away': True}, (1, -2)],
+            u'\xe9': {u'x': None},
+            7: u'seven'}
+        self.assertEqual(self._roundTrip(value), {
+            u'networkId': 1,
+            u'users': [{u'nick': u'alice', u'away': True}, [1, -2]],
+            u'\xe9': {u'x': None},
+            u'7': u'seven'})
+
+
+    def test_toJSON(self):
+        """
+        Values with a C{toJSON} method are encoded as what it returns.
+        """
+        self.assertEqual(self._roundTrip([_Record()]), [{u'id': 1}])
+
+
+    def test_unserializable(self):
+        """
+        Values that cannot be encoded raise C{TypeError}.
+        """
+        self.assertRaises(
+            TypeError, self.encoding.encode, u'message', object())
+
+
+    def test_encodeBatch(self):
+        """
+        A batch is a C{batch} event of encoded events.
+        """
+        data = self.encoding.encodeBatch([
+            self.encoding.encode(u'a', 1),
+            self.encoding.encode(u'b', u'networkId')])
+        event, rest = _decodeCompact(data, self.encoding.strings)
+        self.assertEqual(rest, '')
+        self.assertEqual(
+            event, [u'batch', [[u'a', 1], [u'b', u'networkId']]])
@@ -0,0 +1,112 @@
+"""
+Tests for L{waffle.outbound}.
+"""
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+
+from waffle.outbound import OutboundQueue
+
+
+
+class OutboundQueueTests(unittest.TestCase):
+    """
+    Tests for L{OutboundQueue}.
+    """
+    def setUp(self):
+        self.transport = StringTransport()
+        self.overflows = []
+        self.queue = OutboundQueue(
+            self.transport, lambda: self.overflows.append(None))
+
+
+    def test_registered(self):
+        """
+        The queue registers itself as a streaming producer with the
+        transport.
+        """
+        self.assertIdentical(self.transport.producer, self.queue)
+        self.assertTrue(self.transport.streaming)
+
+
+    def test_writeThrough(self):
+        """
+        Messages are written straight through while the transport is not
+        paused.
+        """
+        self.queue.put('a')
+        self.queue.put('b', 'key')
+        self.assertEqual(self.transport.value(), 'ab')
+        self.assertEqual(len(self.queue), 0)
+
+
+    def test_pauseResume(self):
+        """
+        Messages are queued while the transport is paused, and written in
+        order once it resumes.
+        """
+        self.queue.pauseProducing()
+        self.queue.put('a')
+        self.queue.put('bc')
+        self.assertEqual(self.transport.value(), '')
+        self.assertEqual((len(self.queue), self.queue.bytes), (2, 3))
+        self.queue.resumeProducing()
+        self.assertEqual(self.transport.value(), 'abc')
+        self.assertEqual((len(self.queue), self.queue.bytes), (0, 0))
+
+
+    def test_coalesce(self):
+        """
+        Queued messages with the same key are superseded by the newest one,
+        which is sent after everything queued before it.
+        """
+        self.queue.pauseProducing()
+        self.queue.put('1', 'x')
+        self.queue.put('2')
+        self.queue.put('3', 'y')
+        self.queue.put('4', 'x')
+        self.assertEqual(self.queue.coalesced, 1)
+        self.assertEqual(self.queue.bytes, 3)
+        self.queue.resumeProducing()
+        self.assertEqual(self.transport.value(), '234')
+
+
+    def test_noKeyNotCoalesced(self):
+        """
+        Messages without a key are never coalesced.
+        """
+        self.queue.pauseProducing()
+        self.queue.put('a')
+        self.queue.put('a')
+        self.queue.resumeProducing()
+        self.assertEqual(self.transport.value(), 'aa')
+        self.assertEqual(self.queue.coalesced, 0)
+
+
+    def test_overflow(self):
+        """
+        Once more than C{maxBytes} are queued the queue is discarded,
+        C{overflowed} is called and later messages are dropped.
+        """
+        self.queue.maxBytes = 4
+        self.queue.pauseProducing()
+        self.queue.put('abc')
+        self.queue.put('de')
+        self.assertEqual(self.overflows, [None])
+        self.assertEqual((len(self.queue), self.queue.bytes), (0, 0))
+        self.queue.put('f')
+        self.queue.resumeProducing()
+        self.assertEqual(self.transport.value(), '')
+        self.assertEqual(self.overflows, [None])
+
+
+    def test_overflowCoalesced(self):
+        """
+        Superseded messages do not count towards C{maxBytes}.
+        """
+        self.queue.maxBytes = 4
+        self.queue.pauseProducing()
+        self.queue.put('abc', 'x')
+        self.queue.put('def', 'x')
+        self.assertEqual(self.overflows, [])
+        self.queue.resumeProducing()
+        self.assertEqual(self.transport.value(), 'def')
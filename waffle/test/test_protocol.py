@@ -0,0 +1,296 @@
+"""
+Tests for L{waffle.quassel.protocol}.
+"""
+import random
+import struct
+
+from twisted.cred.error import UnauthorizedLogin
+from twisted.internet import task
+from twisted.internet.error import ConnectionDone
+from twisted.python import failure
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+
+from waffle.benchmark import corpus
+from waffle.qt import adapters, codec, compression
+from waffle.quassel import protocol
+
+
+
+def _frame(value):
+    """
+    Encode a C{QVariant} as a length-prefixed legacy frame.
+    """
+    data = codec.QVariantEncoder().encode(value)
+    return struct.pack('>I', len(data)) + data
+
+
+
+class _RecordingClient(protocol.QuasselClient):
+    """
+    Client recording the handshake messages it receives, instead of logging
+    in.
+    """
+    heartbeatInterval = None
+
+    def __init__(self, *a, **kw):
+        protocol.QuasselClient.__init__(self, *a, **kw)
+        self.received = []
+
+
+    def proto_login(self, data):
+        self.received.append(data)
+        return 'login'
+
+
+
+class _RecordingWeb(object):
+    """
+    Web client recording the events sent to it.
+    """
+    def __init__(self):
+        self.events = []
+
+
+    def sendJSON(self, messageType, data):
+        self.events.append((messageType, data))
+
+
+
+class _Turn(object):
+    """
+    A call scheduled by a cooperator, run when the test asks for it.
+    """
+    def __init__(self, turns, f):
+        self._turns = turns
+        self.f = f
+        turns.append(self)
+
+
+    def cancel(self):
+        self._turns.remove(self)
+
+
+
+class LoginTests(unittest.TestCase):
+    """
+    Tests for logging in to the core.
+    """
+    def setUp(self):
+        self.transport = StringTransport()
+        self.client = protocol.QuasselClient('user', 'password', probe=False)
+        self.client.heartbeatInterval = None
+        self.client.makeConnection(self.transport)
+        self.client.dataReceived(_frame(adapters.QVariantMap({
+            u'MsgType': adapters.QString(u'ClientInitAck')})))
+
+
+    def test_loginAccepted(self):
+        """
+        L{protocol.QuasselClient.loggedIn} fires once the core accepts the
+        login.
+        """
+        self.assertNoResult(self.client.loggedIn)
+        self.client.dataReceived(_frame(adapters.QVariantMap({
+            u'MsgType': adapters.QString(u'ClientLoginAck')})))
+        self.successResultOf(self.client.loggedIn)
+        self.assertEqual(self.client.state, 'sessionInit')
+
+
+    def test_loginRejected(self):
+        """
+        L{protocol.QuasselClient.loggedIn} fails with C{UnauthorizedLogin},
+        and the connection is closed, if the core rejects the login.
+        """
+        self.client.dataReceived(_frame(adapters.QVariantMap({
+            u'MsgType': adapters.QString(u'ClientLoginReject'),
+            u'Error': adapters.QString(u'Invalid username or password')})))
+        self.failureResultOf(self.client.loggedIn, UnauthorizedLogin)
+        self.assertTrue(self.transport.disconnecting)
+
+
+    def test_connectionLost(self):
+        """
+        L{protocol.QuasselClient.loggedIn} fails if the connection is lost
+        before the core answers the login.
+        """
+        self.client.connectionLost(failure.Failure(ConnectionDone()))
+        self.failureResultOf(self.client.loggedIn, ConnectionDone)
+
+
+
+class IncrementalDecodeTests(unittest.TestCase):
+    """
+    Tests for frames decoded incrementally, via the cooperator.
+    """
+    def setUp(self):
+        self.clock = task.Clock()
+        cooperator = task.Cooperator(
+            scheduler=lambda f: self.clock.callLater(0, f))
+        self.patch(task, 'cooperate', cooperator.cooperate)
+        self.client = _RecordingClient('user', 'password', probe=False)
+        self.client.incrementalDecodeThreshold = 1
+        self.client.incrementalDecodeStep = 1
+        self.client.makeConnection(StringTransport())
+
+
+    def _cooperate(self):
+        """
+        Run the cooperator until no work is left.
+        """
+        while self.clock.getDelayedCalls():
+            self.clock.advance(0)
+
+
+    def _frames(self, count):
+        return ''.join(
+            _frame(adapters.QVariantMap({
+                u'MsgType': adapters.QString(u'Test'),
+                u'Index': adapters.Int(i)}))
+            for i in xrange(count))
+
+
+    def test_pausedFrames(self):
+        """
+        Frames received while a frame is being decoded are buffered, and
+        delivered in order once it has been.
+        """
+        self.client.dataReceived(self._frames(3))
+        self.assertEqual(self.client.received, [])
+        self._cooperate()
+        self.assertEqual(
+            [data[u'Index'] for data in self.client.received], [0, 1, 2])
+
+
+    def test_pausedFramesStreamCompression(self):
+        """
+        Frames buffered while paused are delivered once decoding finishes,
+        even when the stream is compressed and no more data arrives.
+        """
+        self.client._streamDecompressor = compression.StreamDecompressor()
+        compressor = compression.StreamCompressor(6)
+        self.client.dataReceived(compressor.compress(self._frames(3)))
+        self._cooperate()
+        self.assertEqual(
+            [data[u'Index'] for data in self.client.received], [0, 1, 2])
+
+
+
+class LazyFrameTests(unittest.TestCase):
+    """
+    Tests for recognising frames to decode lazily.
+    """
+    def setUp(self):
+        self.client = protocol.QuasselClient('user', 'password', probe=False)
+        self.client.state = 'message'
+        self.encoder = codec.QVariantEncoder()
+
+
+    def _request(self, requestType, className):
+        return self.encoder.encode(adapters.QVariantList([
+            adapters.Int(requestType.value), className,
+            adapters.QString(u'1'), adapters.QVariantMap({})]))
+
+
+    def test_lazyInitData(self):
+        """
+        InitData for one of C{lazyInitClasses} is decoded lazily, whether its
+        class name is a C{QString} or a C{QByteArray}.
+        """
+        self.assertTrue(self.client._isLazyFrame(self._request(
+            protocol.RequestType.InitData, adapters.QString(u'Network'))))
+        self.assertTrue(self.client._isLazyFrame(self._request(
+            protocol.RequestType.InitData, adapters.QByteArray('Network'))))
+
+
+    def test_otherFrames(self):
+        """
+        Other InitData, other requests, and frames that are not requests are
+        decoded in full.
+        """
+        isLazyFrame = self.client._isLazyFrame
+        self.assertFalse(isLazyFrame(self._request(
+            protocol.RequestType.InitData, adapters.QString(u'NetworkX'))))
+        self.assertFalse(isLazyFrame(self._request(
+            protocol.RequestType.InitData, adapters.QString(u'IrcUser'))))
+        self.assertFalse(isLazyFrame(self._request(
+            protocol.RequestType.Sync, adapters.QString(u'Network'))))
+        self.assertFalse(isLazyFrame(self.encoder.encode(
+            adapters.QVariantMap({u'Network': adapters.Int(4)}))))
+        self.assertFalse(isLazyFrame(''))
+
+
+    def test_handshake(self):
+        """
+        Frames are only decoded lazily once the handshake is over.
+        """
+        self.client.state = 'sessionInit'
+        self.assertFalse(self.client._isLazyFrame(self._request(
+            protocol.RequestType.InitData, adapters.QString(u'Network'))))
+
+
+    def test_lazyInitClasses(self):
+        """
+        Changes to C{lazyInitClasses} are taken into account.
+        """
+        frame = self._request(
+            protocol.RequestType.InitData, adapters.QString(u'IrcUser'))
+        self.assertFalse(self.client._isLazyFrame(frame))
+        self.client.lazyInitClasses = frozenset([u'IrcUser'])
+        self.assertTrue(self.client._isLazyFrame(frame))
+
+
+
+class LazyNetworkInitTests(unittest.TestCase):
+    """
+    Tests for large Network InitData, decoded lazily and sent to the web
+    client in cooperative steps.
+    """
+    def setUp(self):
+        self.turns = []
+        cooperator = task.Cooperator(
+            terminationPredicateFactory=lambda: lambda: True,
+            scheduler=lambda f: _Turn(self.turns, f))
+        self.patch(task, 'cooperate', cooperator.cooperate)
+        self.transport = StringTransport()
+        self.client = protocol.QuasselClient('user', 'password', probe=False)
+        self.client.heartbeatInterval = None
+        self.client.incrementalDecodeThreshold = 1
+        self.client.incrementalDecodeStep = 10
+        self.client.streamChunkSize = 20
+        self.client.makeConnection(self.transport)
+        self.client.state = 'message'
+        self.client._messageHandler = protocol.QuasselMessage(self.client)
+        self.web = self.client.web = _RecordingWeb()
+
+
+    def test_initializeNetworkSteps(self):
+        """
+        Large Network InitData is decoded, stored and sent to the web client
+        over many cooperative steps, none of which decodes every user, with
+        the transport paused until it has been sent.
+        """
+        self.client.dataReceived(_frame(
+            corpus.networkInitData(random.Random(0), 200, 5)))
+        self.assertEqual(self.web.events, [])
+        self.assertEqual(self.transport.producerState, 'paused')
+
+        steps = 0
+        while self.turns:
+            self.turns.pop(0).f()
+            steps += 1
+        self.assertTrue(steps > 200 // self.client.streamChunkSize)
+        self.assertEqual(self.transport.producerState, 'producing')
+
+        network = self.client.store.networks[1]
+        self.assertEqual(network.users, {})
+        self.assertEqual(self.web.events[0][0], u'initializeNetwork')
+        messageType, begin = self.web.events[1]
+        self.assertEqual(
+            (messageType, begin[u'type'], begin[u'count']),
+            (u'streamBegin', u'networkUsers', 200))
+        self.assertEqual(
+            sum(len(data[u'items']) for messageType, data in self.web.events
+                if messageType == u'streamChunk' and
+                data[u'stream'] == begin[u'stream']),
+            200)
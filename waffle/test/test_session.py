@@ -0,0 +1,90 @@
+"""
+Tests for L{waffle.session}.
+"""
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from waffle.qt.adapters import BufferInfoRecord, MessageBatch, MessageRecord
+from waffle.quassel.protocol import QuasselClient
+from waffle.session import SessionRegistry
+
+
+
+_bufferInfo = BufferInfoRecord(7, 1, 2, 0, u'#channel')
+
+
+
+def _message(messageId):
+    return MessageRecord(
+        messageId, 1000 + messageId, u'plain', 0, _bufferInfo,
+        u'nick!user@host', u'message %d' % (messageId,))
+
+
+
+class _Web(object):
+    """
+    Web client recording the events sent to it.
+    """
+    def __init__(self):
+        self.events = []
+
+
+    def sendJSON(self, messageType, data):
+        self.events.append((messageType, data))
+
+
+
+class SessionTests(unittest.TestCase):
+    """
+    Tests for L{waffle.session.Session}.
+    """
+    def setUp(self):
+        clock = task.Clock()
+        self.quassel = QuasselClient('user', 'password')
+        self.quassel.store.initializeBuffer(_bufferInfo)
+        self.quassel._backlog = self.quassel.backlogSchedulerFactory(
+            self.quassel._fetchBacklog, clock)
+        self.registry = SessionRegistry(
+            lambda *a: defer.succeed(self.quassel), clock)
+        self.session = self.successResultOf(
+            self.registry.open('core', 4242, u'user', u'password'))
+
+
+    def _backlog(self, web):
+        return [
+            [record.id for record in data]
+            for messageType, data in web.events if messageType == u'backlog']
+
+
+    def test_attachLate(self):
+        """
+        A web client attaching after backlog and messages have arrived is sent
+        each buffer's newest messages, including those that arrived live.
+        """
+        first = _Web()
+        self.session.attach(first)
+        self.quassel.backlogReceived(
+            _bufferInfo.id, MessageBatch.fromRecords([_message(1)]), -1, 50)
+        self.quassel.privmsgReceived(_message(2))
+
+        second = _Web()
+        self.session.attach(second)
+        self.assertEqual(second.events[0][0], u'snapshot')
+        self.assertEqual(self._backlog(second), [[1, 2]])
+
+
+    def test_attachLateLimit(self):
+        """
+        Only L{Session.replayLimit} messages of each buffer are sent to web
+        clients attaching late.
+        """
+        self.session.replayLimit = 2
+        self.session.attach(_Web())
+        self.quassel.backlogReceived(
+            _bufferInfo.id,
+            MessageBatch.fromRecords([_message(i) for i in xrange(5)]), -1,
+            50)
+
+        web = _Web()
+        self.session.attach(web)
+        self.assertEqual(self._backlog(web), [[3, 4]])
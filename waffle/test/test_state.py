@@ -0,0 +1,104 @@
+"""
+Tests for L{waffle.quassel.state}.
+"""
+from twisted.trial import unittest
+
+from waffle.quassel.state import StateStore
+
+
+
+class _RecordingMap(dict):
+    """
+    C{dict} recording the keys whose values are accessed, like a lazily
+    decoded map decoding them.
+    """
+    def __init__(self, *a, **kw):
+        dict.__init__(self, *a, **kw)
+        self.accessed = set()
+
+
+    def __getitem__(self, key):
+        self.accessed.add(key)
+        return dict.__getitem__(self, key)
+
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+
+
+def _networkInfo(users):
+    return {
+        u'networkName': u'ExampleNet',
+        u'IrcUsersAndChannels': {
+            u'users': _RecordingMap(
+                (u'nick%d!user@host' % (i,),
+                 {u'nick': u'nick%d' % (i,), u'user': u'user',
+                  u'host': u'host', u'channels': [u'#channel']})
+                for i in xrange(users)),
+            u'channels': _RecordingMap({
+                u'#channel': {
+                    u'topic': u'topic',
+                    u'UserModes': dict(
+                        (u'nick%d' % (i,), u'') for i in xrange(users))}})}}
+
+
+
+class StateStoreTests(unittest.TestCase):
+    """
+    Tests for L{StateStore}.
+    """
+    def setUp(self):
+        self.store = StateStore()
+        self.info = _networkInfo(100)
+        self.users = self.info[u'IrcUsersAndChannels'][u'users']
+        self.channels = self.info[u'IrcUsersAndChannels'][u'channels']
+        self.store.initializeNetwork(1, self.info)
+        self.network = self.store.networks[1]
+
+
+    def test_initializeNetworkLazy(self):
+        """
+        Initialising a network does not decode any of its users or channels.
+        """
+        self.assertEqual(self.users.accessed, set())
+        self.assertEqual(self.channels.accessed, set())
+        self.assertEqual(self.network.users, {})
+        self.assertEqual(self.network.userCount(), 100)
+
+
+    def test_materialiseOnAccess(self):
+        """
+        Users and channels are materialised when they are first looked up,
+        and only those.
+        """
+        user = self.network.findUser(u'nick5')
+        self.assertEqual(user.hostmask, u'nick5!user@host')
+        self.assertEqual(user.channels, set([u'#channel']))
+        self.assertEqual(self.users.accessed, set([u'nick5!user@host']))
+        self.assertIdentical(self.network.findUser(u'unknown'), None)
+        self.assertEqual(
+            self.network.findChannel(u'#channel').members[u'nick5'], u'')
+        self.assertEqual(self.network.userCount(), 100)
+
+
+    def test_syncMaterialises(self):
+        """
+        Sync messages about users not materialised yet apply to the users
+        from the network's InitData.
+        """
+        self.store.userQuit(1, u'nick1')
+        self.store.userSetMetadata(1, u'nick2', 'nick', u'renamed')
+        self.store.userSetMetadata(1, u'nick3', u'away', True)
+        self.assertEqual(sorted(self.network.users), [u'nick3', u'renamed'])
+        users = dict(self.network.iterUsers())
+        self.assertNotIn(u'nick1!user@host', users)
+        self.assertEqual(users[u'renamed!user@host'][u'nick'], u'renamed')
+        self.assertNotIn(u'nick2!user@host', users)
+        self.assertEqual(users[u'nick3!user@host'][u'away'], True)
+        self.assertEqual(len(users), 99)
+        members = self.network.findChannel(u'#channel').members
+        self.assertNotIn(u'nick1', members)
+        self.assertIn(u'renamed', members)
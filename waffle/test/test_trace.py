@@ -0,0 +1,163 @@
+"""
+Tests for L{waffle.trace}.
+"""
+from twisted.trial import unittest
+
+from waffle import trace
+
+
+
+class _Unformattable(object):
+    """
+    Value that must not be formatted.
+    """
+    def __repr__(self):
+        raise AssertionError('Formatted past the bound')
+
+
+
+class TracerTests(unittest.TestCase):
+    """
+    Tests for L{trace.Tracer}.
+    """
+    def setUp(self):
+        self.tracer = trace.Tracer(size=3, clock=lambda: 1000.0)
+
+
+    def texts(self):
+        return [text for timestamp, category, text in self.tracer.entries()]
+
+
+    def test_disabled(self):
+        """
+        Events in disabled categories are not recorded, or formatted.
+        """
+        self.tracer.record(trace.CORE_IN, _Unformattable(), '%s', 'x')
+        self.assertEqual(self.tracer.entries(), [])
+        self.assertFalse(self.tracer.enabled(trace.CORE_IN))
+
+
+    def test_summary(self):
+        """
+        At summary level only the formatted summary is recorded.
+        """
+        self.tracer.setLevel(trace.CORE_IN, trace.SUMMARY)
+        self.tracer.record(
+            trace.CORE_IN, _Unformattable(), '<= %s', 'Sync')
+        self.assertEqual(
+            self.tracer.entries(), [(1000.0, trace.CORE_IN, '<= Sync')])
+        self.assertTrue(self.tracer.enabled(trace.CORE_IN))
+        self.assertFalse(self.tracer.enabled(trace.CORE_IN, trace.DETAIL))
+
+
+    def test_detail(self):
+        """
+        At detail level the C{repr} of the detail is appended.
+        """
+        self.tracer.setLevel(trace.WEB_OUT, trace.DETAIL)
+        self.tracer.record(trace.WEB_OUT, {u'a': 1}, '=> %s', 'message')
+        self.tracer.record(trace.WEB_OUT, None, '=> %s', 'message')
+        self.assertEqual(self.texts(), ["=> message: {u'a': 1}", '=> message'])
+
+
+    def test_detailBounded(self):
+        """
+        Only the start of large details is formatted.
+        """
+        self.tracer.setLevel(trace.CORE_IN, trace.DETAIL)
+        users = dict((u'nick%d' % (i,), i) for i in xrange(100000))
+        detail = [
+            users, [0] * 20 + [_Unformattable()], u'x' * 10 ** 6,
+            {0: {1: {2: {3: {4: _Unformattable()}}}}}]
+        self.tracer.record(trace.CORE_IN, detail, 'InitData')
+        [text] = self.texts()
+        self.assertTrue(text.startswith('InitData: [{'))
+        self.assertTrue(len(text) < 2000, len(text))
+        self.assertIn('...', text)
+
+
+    def test_maxEntryLength(self):
+        """
+        Entries are truncated to C{maxEntryLength}.
+        """
+        self.tracer.maxEntryLength = 10
+        self.tracer.setLevel(trace.CORE_IN, trace.SUMMARY)
+        self.tracer.record(trace.CORE_IN, None, 'x' * 20)
+        self.assertEqual(self.texts(), ['x' * 10 + '...'])
+
+
+    def test_sampling(self):
+        """
+        A sampled category records one in every C{sample} events.
+        """
+        self.tracer.setLevel(trace.CORE_OUT, trace.SUMMARY, sample=2)
+        for i in xrange(5):
+            self.tracer.record(trace.CORE_OUT, None, '%d', i)
+        self.assertEqual(self.texts(), ['1', '3'])
+
+
+    def test_ringBuffer(self):
+        """
+        Only the newest C{size} entries are kept.
+        """
+        self.tracer.setLevel(trace.CORE_IN, trace.SUMMARY)
+        for i in xrange(5):
+            self.tracer.record(trace.CORE_IN, None, '%d', i)
+        self.assertEqual(self.texts(), ['2', '3', '4'])
+        self.tracer.clear()
+        self.assertEqual(self.tracer.entries(), [])
+
+
+    def test_off(self):
+        """
+        Setting a category's level to off disables it.
+        """
+        self.tracer.setLevel(trace.CORE_IN, trace.DETAIL)
+        self.tracer.setLevel(trace.CORE_IN, trace.OFF)
+        self.tracer.record(trace.CORE_IN, None, 'x')
+        self.assertEqual(self.tracer.entries(), [])
+
+
+    def test_configure(self):
+        """
+        L{trace.Tracer.configure} sets the level, and sampling rate, of
+        categories.
+        """
+        self.tracer.configure(' core.in=detail, web.out=summary/10 ,')
+        self.assertTrue(self.tracer.enabled(trace.CORE_IN, trace.DETAIL))
+        self.assertTrue(self.tracer.enabled(trace.WEB_OUT))
+        self.assertFalse(self.tracer.enabled(trace.WEB_OUT, trace.DETAIL))
+        self.assertFalse(self.tracer.enabled(trace.CORE_OUT))
+        self.assertEqual(self.tracer._sampleRates, {trace.WEB_OUT: 10})
+
+
+    def test_configureAll(self):
+        """
+        C{*} configures every category.
+        """
+        self.tracer.configure('*=summary')
+        for category in trace.categories:
+            self.assertTrue(self.tracer.enabled(category))
+        self.tracer.configure('*=off')
+        for category in trace.categories:
+            self.assertFalse(self.tracer.enabled(category))
+
+
+    def test_configureInvalid(self):
+        """
+        Unknown categories and levels, and malformed sampling rates, raise
+        C{ValueError}.
+        """
+        for spec in ['core=detail', 'core.in=loud', 'core.in', 'web.in=x/2',
+                     'web.in=summary/often']:
+            self.assertRaises(ValueError, self.tracer.configure, spec)
+
+
+    def test_formatEntries(self):
+        """
+        Entries are formatted with their time and category.
+        """
+        self.tracer.setLevel(trace.CORE_IN, trace.SUMMARY)
+        self.tracer.record(trace.CORE_IN, None, 'x')
+        [line] = list(self.tracer.formatEntries())
+        self.assertTrue(line.endswith('.000 core.in  x'), line)
@@ -0,0 +1,55 @@
+"""
+Tests for L{waffle.util}.
+"""
+from twisted.trial import unittest
+
+from waffle import util
+
+
+
+class _Dispatcher(util.CommandDispatcherMixin):
+    prefix = 'cmd'
+
+    def cmd_known(self, value):
+        return value
+
+
+    def cmd_unknown(self, name, value):
+        return name, value
+
+
+
+class CommandDispatcherMixinTests(unittest.TestCase):
+    """
+    Tests for L{util.CommandDispatcherMixin}.
+    """
+    def setUp(self):
+        self.addCleanup(util._dispatchTables.pop, _Dispatcher, None)
+        self.addCleanup(util._dispatchStats.pop, _Dispatcher, None)
+        self.dispatcher = _Dispatcher()
+
+
+    def test_dispatch(self):
+        """
+        Commands are dispatched to the handler of the same name, or the
+        C{unknown} handler if there is none.
+        """
+        self.assertEqual(self.dispatcher.dispatch('known', 1), 1)
+        self.assertEqual(
+            self.dispatcher.dispatch(('un', 'handled'), 2), ('un_handled', 2))
+
+
+    def test_unknownBounded(self):
+        """
+        Commands without a handler of their own are counted together and not
+        cached, however many distinct names arrive.
+        """
+        for i in xrange(100):
+            self.dispatcher.dispatch(('name%d' % (i,), 'slot'), i)
+        self.dispatcher.dispatch('known', 1)
+        stats = _Dispatcher.dispatchStats()
+        self.assertEqual(sorted(stats), ['cmd_known', 'cmd_unknown'])
+        self.assertEqual(
+            (stats['cmd_unknown']['calls'], stats['cmd_unknown']['unhandled']),
+            (100, 100))
+        self.assertEqual(util._dispatchTables[_Dispatcher].keys(), ['known'])
@@ -0,0 +1,40 @@
+"""
+Tests for L{waffle.web}.
+"""
+from twisted.trial import unittest
+from twisted.web.resource import NoResource
+from twisted.web.test.requesthelper import DummyRequest
+
+from waffle import web
+
+
+
+class RootResourceTests(unittest.TestCase):
+    """
+    Tests for L{web.RootResource}.
+    """
+    def test_noMetrics(self):
+        """
+        Metrics are not served alongside the web client.
+        """
+        root = web.RootResource()
+        request = DummyRequest(['metrics'])
+        self.assertIsInstance(
+            root.getChildWithDefault('metrics', request), NoResource)
+
+
+
+class MetricsResourceTests(unittest.TestCase):
+    """
+    Tests for L{web.MetricsResource}.
+    """
+    def test_render(self):
+        """
+        Metrics are rendered in the Prometheus text exposition format.
+        """
+        request = DummyRequest([''])
+        body = web.MetricsResource().render_GET(request)
+        self.assertEqual(
+            request.responseHeaders.getRawHeaders('content-type'),
+            ['text/plain; version=0.0.4'])
+        self.assertIn('# TYPE ', body)
@@ -0,0 +1,209 @@
+"""
+Tests for L{waffle.websocket}.
+"""
+import json
+
+from twisted.cred.error import UnauthorizedLogin
+from twisted.internet import defer, task
+from twisted.internet.error import ConnectionRefusedError
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+
+from waffle.metrics import metrics
+from waffle.quassel.protocol import QuasselClient
+from waffle.session import SessionRegistry
+from waffle.websocket import WaffleFactory
+
+
+
+class CoalesceTests(unittest.TestCase):
+    """
+    Tests for events coalesced while a web client is not keeping up.
+    """
+    def setUp(self):
+        self.registry = SessionRegistry(None, None)
+        self.addCleanup(
+            metrics.removeCollector, self.registry.collectMetrics)
+        self.web = WaffleFactory(self.registry).buildProtocol(None)
+        self.transport = StringTransport()
+        self.web.makeConnection(self.transport)
+        self.web._outbound.pauseProducing()
+
+
+    def _events(self):
+        self.web._outbound.resumeProducing()
+        decoder = json.JSONDecoder()
+        data = self.transport.value()
+        events = []
+        while data:
+            event, end = decoder.raw_decode(data)
+            events.append(event[u'data'])
+            data = data[end:]
+        return events
+
+
+    def _setMetadata(self, nickname, key, value):
+        self.web.sendJSON(u'userSetMetadata', {
+            u'networkId': 1, u'nickname': nickname, u'key': key,
+            u'value': value})
+
+
+    def test_metadata(self):
+        """
+        Only the latest value of a user's property is sent.
+        """
+        self._setMetadata(u'alice', u'away', True)
+        self._setMetadata(u'bob', u'away', True)
+        self._setMetadata(u'alice', u'away', False)
+        self.assertEqual(
+            [(event[u'nickname'], event[u'value'])
+             for event in self._events()],
+            [(u'bob', True), (u'alice', False)])
+
+
+    def test_renames(self):
+        """
+        Renames are never coalesced.
+        """
+        self._setMetadata(u'alice', u'nick', u'bob')
+        self._setMetadata(u'bob', u'nick', u'alice')
+        self._setMetadata(u'alice', u'nick', u'carol')
+        self.assertEqual(
+            [(event[u'nickname'], event[u'value'])
+             for event in self._events()],
+            [(u'alice', u'bob'), (u'bob', u'alice'), (u'alice', u'carol')])
+
+
+    def test_renameBarrier(self):
+        """
+        A user's property set before a rename is not superseded by the same
+        property of the user with that nickname after it.
+        """
+        self._setMetadata(u'alice', u'away', True)
+        self._setMetadata(u'alice', u'nick', u'bob')
+        self._setMetadata(u'carol', u'nick', u'alice')
+        self._setMetadata(u'alice', u'away', False)
+        self.assertEqual(
+            [(event[u'nickname'], event[u'key'], event[u'value'])
+             for event in self._events()],
+            [(u'alice', u'away', True), (u'alice', u'nick', u'bob'),
+             (u'carol', u'nick', u'alice'), (u'alice', u'away', False)])
+
+
+    def test_renamesBatched(self):
+        """
+        Renames are not coalesced within a batch either.
+        """
+        self.web.batchEvents = True
+        self.web.clock = task.Clock()
+        self._setMetadata(u'alice', u'nick', u'bob')
+        self._setMetadata(u'bob', u'nick', u'alice')
+        self._setMetadata(u'alice', u'nick', u'carol')
+        self.web._flushBatch()
+        [batch] = self._events()
+        self.assertEqual(
+            [(event[u'data'][u'nickname'], event[u'data'][u'value'])
+             for event in batch],
+            [(u'alice', u'bob'), (u'bob', u'alice'), (u'alice', u'carol')])
+
+
+
+class AuthTests(unittest.TestCase):
+    """
+    Tests for authenticating web clients.
+    """
+    def setUp(self):
+        self.clock = task.Clock()
+        self.connections = []
+        self.registry = SessionRegistry(self._connect, self.clock)
+        self.factory = WaffleFactory(self.registry)
+        self.addCleanup(
+            metrics.removeCollector, self.registry.collectMetrics)
+
+
+    def _connect(self, clock, host, port, username, password):
+        d = defer.Deferred()
+        self.connections.append(d)
+        return d
+
+
+    def _auth(self, password=u'password'):
+        web = self.factory.buildProtocol(None)
+        web.clock = self.clock
+        transport = StringTransport()
+        web.makeConnection(transport)
+        web.dataReceived(json.dumps({
+            u'type': u'auth',
+            u'data': {u'username': u'user', u'password': password,
+                      u'batch': True}}))
+        return web, transport
+
+
+    def _events(self, transport):
+        return json.loads(transport.value())
+
+
+    def test_coreConnectionFailed(self):
+        """
+        If the core connection cannot be established the web client is told
+        so, and disconnected.
+        """
+        web, transport = self._auth()
+        self.connections[0].errback(ConnectionRefusedError())
+        self.flushLoggedErrors(ConnectionRefusedError)
+        self.assertEqual(
+            self._events(transport),
+            {u'type': u'authFailed', u'data': {u'reason': u'unavailable'}})
+        self.assertTrue(transport.disconnecting)
+        self.assertIdentical(web.session, None)
+
+
+    def test_wrongPassword(self):
+        """
+        If an existing session was logged in with a different password the web
+        client is told so, and disconnected.
+        """
+        quassel = QuasselClient('user', 'password')
+        self._auth()
+        self.connections[0].callback(quassel)
+        web, transport = self._auth(u'wrong')
+        self.assertEqual(
+            self._events(transport),
+            {u'type': u'authFailed', u'data': {u'reason': u'unauthorized'}})
+        self.assertTrue(transport.disconnecting)
+        self.assertIdentical(web.session, None)
+
+
+    def test_loginRejected(self):
+        """
+        If the core rejects the login the web client is told so, and
+        disconnected, and the session is forgotten.
+        """
+        web, transport = self._auth(u'wrong')
+        self.connections[0].errback(UnauthorizedLogin())
+        self.assertEqual(
+            self._events(transport),
+            {u'type': u'authFailed', u'data': {u'reason': u'unauthorized'}})
+        self.assertTrue(transport.disconnecting)
+        self.assertEqual(len(self.registry), 0)
+
+
+    def test_loginPending(self):
+        """
+        A web client authenticating while another's login is pending is not
+        checked against its unaccepted password, but logs in itself if the
+        core rejects it.
+        """
+        wrongWeb, wrongTransport = self._auth(u'wrong')
+        web, transport = self._auth()
+        self.assertEqual(transport.value(), '')
+        self.connections[0].errback(UnauthorizedLogin())
+        self.assertEqual(
+            self._events(wrongTransport)[u'data'],
+            {u'reason': u'unauthorized'})
+        self.assertEqual(transport.value(), '')
+
+        self.connections[1].callback(QuasselClient('user', 'password'))
+        self.assertFalse(transport.disconnecting)
+        self.assertNotIdentical(web.session, None)
+        self.assertIdentical(self.registry.sessions()[0], web.session)
@@ -0,0 +1,236 @@
+"""
+Structured protocol tracing.
+
+Trace points name a category, such as L{CORE_IN}, and are recorded in a
+bounded ring buffer only when that category is enabled; disabled categories
+cost a dictionary lookup, no formatting is done. At L{SUMMARY} level only
+the message kinds and names are recorded, at L{DETAIL} level the start of
+the message is included too.
+
+The buffer can be dumped on demand, C{waffle.tac} dumps it to the log on
+C{SIGUSR1}, and categories can be enabled with the C{WAFFLE_TRACE}
+environment variable, see L{Tracer.configure}.
+"""
+import collections
+import itertools
+import time
+from repr import Repr
+
+from twisted.python import log
+
+
+
+CORE_IN = 'core.in'
+CORE_OUT = 'core.out'
+WEB_IN = 'web.in'
+WEB_OUT = 'web.out'
+
+categories = [CORE_IN, CORE_OUT, WEB_IN, WEB_OUT]
+
+OFF = 0
+SUMMARY = 1
+DETAIL = 2
+
+_levelNames = {'off': OFF, 'summary': SUMMARY, 'detail': DETAIL}
+
+
+
+class _DetailRepr(Repr):
+    """
+    C{repr} of trace event details, formatting only the first items of
+    containers, including subclasses of C{dict} and C{list}, and the start of
+    strings, so that the work done does not depend on the size of the
+    message.
+    """
+    def __init__(self):
+        Repr.__init__(self)
+        self.maxlevel = 4
+        self.maxdict = self.maxlist = self.maxtuple = 20
+        self.maxstring = self.maxother = 200
+
+
+    def repr1(self, x, level):
+        if isinstance(x, dict):
+            return self.repr_dict(x, level)
+        elif isinstance(x, list):
+            return self.repr_list(x, level)
+        return Repr.repr1(self, x, level)
+
+
+    def repr_dict(self, x, level):
+        # Unlike Repr.repr_dict, this does not sort every key.
+        if not x:
+            return '{}'
+        if level <= 0:
+            return '{...}'
+        items = [
+            '%s: %s' % (self.repr1(key, level - 1),
+                        self.repr1(value, level - 1))
+            for key, value in itertools.islice(x.iteritems(), self.maxdict)]
+        if len(x) > self.maxdict:
+            items.append('...')
+        return '{%s}' % (', '.join(items),)
+
+
+    repr_unicode = Repr.repr_str
+
+
+
+class Tracer(object):
+    """
+    Record trace events in a ring buffer.
+
+    @type maxEntryLength: C{int}
+    @ivar maxEntryLength: Entries longer than this are truncated.
+
+    @type clock: C{callable}
+    @ivar clock: Returns the current time, in seconds since the epoch.
+
+    @type detailRepr: L{repr.Repr}
+    @ivar detailRepr: Bounded C{repr} of the details included at L{DETAIL}
+        level.
+    """
+    maxEntryLength = 4096
+    detailRepr = _DetailRepr()
+
+    def __init__(self, size=2000, clock=time.time):
+        """
+        @type  size: C{int}
+        @param size: Number of entries kept, older entries are discarded.
+        """
+        self.clock = clock
+        self._entries = collections.deque(maxlen=size)
+        self._levels = {}
+        self._sampleRates = {}
+        self._seen = {}
+
+
+    def setLevel(self, category, level, sample=1):
+        """
+        Set the level a category is traced at.
+
+        @type  level: C{int}
+        @param level: L{OFF}, L{SUMMARY} or L{DETAIL}.
+
+        @type  sample: C{int}
+        @param sample: Only record one in every C{sample} events.
+        """
+        if level == OFF:
+            self._levels.pop(category, None)
+        else:
+            self._levels[category] = level
+        if sample > 1:
+            self._sampleRates[category] = sample
+        else:
+            self._sampleRates.pop(category, None)
+        self._seen.pop(category, None)
+
+
+    def configure(self, spec):
+        """
+        Set category levels from a specification such as
+        C{"core.in=detail,web.out=summary/10"}.
+
+        Each comma-separated item names a category, or C{*} for every
+        category, a level name and, optionally, a sampling rate.
+
+        @raise ValueError: If C{spec} is malformed.
+        """
+        for item in spec.split(','):
+            item = item.strip()
+            if not item:
+                continue
+            category, _, level = item.partition('=')
+            level, _, sample = level.partition('/')
+            if level not in _levelNames:
+                raise ValueError('Unknown trace level %r' % (level,))
+            if category == '*':
+                selected = categories
+            elif category in categories:
+                selected = [category]
+            else:
+                raise ValueError('Unknown trace category %r' % (category,))
+            for category in selected:
+                self.setLevel(
+                    category, _levelNames[level], int(sample or 1))
+
+
+    def enabled(self, category, level=SUMMARY):
+        """
+        Determine whether a category is traced at C{level}.
+        """
+        return self._levels.get(category, OFF) >= level
+
+
+    def record(self, category, detail, format, *args):
+        """
+        Record a trace event, if its category is enabled.
+
+        @param detail: Value whose C{repr}, bounded by L{detailRepr}, is
+            appended to the entry at L{DETAIL} level, or C{None}.
+
+        @type  format: C{str}
+        @param format: Format string for the summary, formatted with C{args}
+            only if the event is recorded.
+        """
+        level = self._levels.get(category)
+        if level is None:
+            return
+        sample = self._sampleRates.get(category)
+        if sample is not None:
+            seen = self._seen[category] = self._seen.get(category, 0) + 1
+            if seen % sample:
+                return
+        text = format % args
+        if detail is not None and level >= DETAIL:
+            text = '%s: %s' % (text, self.detailRepr.repr(detail))
+        if len(text) > self.maxEntryLength:
+            text = text[:self.maxEntryLength] + '...'
+        self._entries.append((self.clock(), category, text))
+
+
+    def entries(self):
+        """
+        Get the recorded entries, oldest first.
+
+        @rtype: C{list} of C{(timestamp, category, text)}
+        """
+        return list(self._entries)
+
+
+    def clear(self):
+        """
+        Discard the recorded entries.
+        """
+        self._entries.clear()
+
+
+    def formatEntries(self):
+        """
+        Format the recorded entries as lines of text.
+        """
+        for timestamp, category, text in self._entries:
+            yield '%s.%03d %-8s %s' % (
+                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)),
+                int(timestamp * 1000) % 1000,
+                category,
+                text)
+
+
+    def dumpToLog(self):
+        """
+        Write the recorded entries to the log.
+        """
+        log.msg('Dumping %d trace entries' % (len(self._entries),))
+        for line in self.formatEntries():
+            log.msg(line)
+
+
+
+tracer = Tracer()
+
+
+
+__all__ = [
+    'CORE_IN', 'CORE_OUT', 'WEB_IN', 'WEB_OUT', 'categories', 'OFF',
+    'SUMMARY', 'DETAIL', 'Tracer', 'tracer']
@@ -1,4 +1,5 @@
 import itertools
+import time
 
 
 
@@ -17,6 +18,12 @@ class CommandDispatcherMixin(object):
     where C{prefix} is the value specified by L{prefix}, and must
     accept the parameters as given to L{dispatch}.
 
+    Handlers are looked up on the class, once per command, and cached for the
+    lifetime of the process; handlers assigned to instances are not found.
+    Commands without a handler of their own are looked up every time, and
+    counted together under C{prefix_unknown}, so that arbitrary command names
+    cannot grow either table.
+
     Attempting to mix this in more than once for a single class will cause
     strange behaviour, due to L{prefix} being overwritten.
 
@@ -25,24 +32,98 @@ class CommandDispatcherMixin(object):
     """
     prefix = None
 
+    def _resolveCommand(self, commandName):
+        """
+        Locate the handler for a command.
+
+        @return: C{(stats, handler, unknownName)}, where C{handler} is
+            C{None} if the command is unhandled and C{unknownName} is the
+            command name to pass to the C{unknown} handler, or C{None} if the
+            command has a handler of its own.
+        """
+        cls = type(self)
+        if isinstance(commandName, tuple):
+            commandName = '_'.join(commandName)
+        name = '%s_%s' % (self.prefix, commandName)
+        stats = _dispatchStats.setdefault(cls, {})
+        handler = getattr(cls, name, None)
+        if handler is not None:
+            return stats.setdefault(name, [0, 0, 0.0]), handler, None
+        unknown = '%s_unknown' % (self.prefix,)
+        handler = getattr(cls, unknown, None)
+        return stats.setdefault(unknown, [0, 0, 0.0]), handler, commandName
+
+
     def dispatch(self, commandName, *args):
         """
         Perform actual command dispatch.
+
+        @type  commandName: C{str} or C{tuple} of C{str}
+        @param commandName: Command name, or the parts of one to be joined
+            with underscores; passing the parts avoids formatting a name for
+            every command.
+        """
+        cls = type(self)
+        table = _dispatchTables.get(cls)
+        if table is None:
+            table = _dispatchTables[cls] = {}
+        entry = table.get(commandName)
+        if entry is None:
+            entry = self._resolveCommand(commandName)
+            if entry[2] is None:
+                table[commandName] = entry
+        stats, handler, unknownName = entry
+        if unknownName is not None:
+            stats[1] += 1
+            if handler is None:
+                stats[0] += 1
+                raise UnhandledCommand("No handler for %r could be found" % (
+                    '%s_%s' % (self.prefix, unknownName),))
+            args = (unknownName,) + args
+        start = time.time()
+        try:
+            return handler(self, *args)
+        finally:
+            stats[0] += 1
+            stats[2] += time.time() - start
+
+
+    @classmethod
+    def dispatchStats(cls):
+        """
+        Summarise the commands dispatched by instances of this class.
+
+        Time is only that spent in the handler itself, not in waiting for any
+        L{Deferred} it returns.
+
+        @rtype: C{dict}
+        @return: Mapping of handler names, such as
+            C{'sync_Network_setLatency'}, to C{dict}s of C{'calls'}, the
+            number of commands dispatched, C{'unhandled'}, how many of those
+            had no handler of their own, and C{'time'}, the cumulative time,
+            in seconds, spent handling them. Commands without a handler of
+            their own are counted under C{prefix_unknown}.
+        """
+        return dict(
+            (name, dict(calls=calls, unhandled=unhandled, time=elapsed))
+            for name, (calls, unhandled, elapsed)
+            in _dispatchStats.get(cls, {}).iteritems())
+
+
+    @classmethod
+    def resetDispatchStats(cls):
+        """
+        Reset the counters reported by L{dispatchStats}.
         """
-        def _getMethodName(command):
-            return '%s_%s' % (self.prefix, command)
+        for stats in _dispatchStats.get(cls, {}).itervalues():
+            stats[:] = [0, 0, 0.0]
 
-        def _getMethod(name):
-            return getattr(self, _getMethodName(name), None)
 
-        method = _getMethod(commandName)
-        if method is not None:
-            return method(*args)
 
-        method = _getMethod('unknown')
-        if method is None:
-            raise UnhandledCommand("No handler for %r could be found" % (_getMethodName(commandName),))
-        return method(commandName, *args)
+# Handler lookups and counters, per dispatcher class, keyed by command name
+# and handler name respectively; both are bounded by the number of handlers.
+_dispatchTables = {}
+_dispatchStats = {}
 
 
 
@@ -2,6 +2,8 @@ from twisted.web.resource import Resource
 from twisted.web.static import File, Data
 from twisted.python.filepath import FilePath
 
+from waffle.metrics import metrics
+
 
 
 staticDir = FilePath(__file__).sibling('static')
@@ -22,3 +24,18 @@ class MainResource(Resource):
     def render_GET(self, request):
         data = staticDir.child('templates').child('main.html').getContent()
         return Data(data, 'text/html; charset=UTF-8').render_GET(request)
+
+
+
+class MetricsResource(Resource):
+    """
+    Gateway metrics, in the Prometheus text exposition format.
+
+    Samples are labelled with core accounts, so this is served on its own
+    listener, rather than under L{RootResource}, at every path.
+    """
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader('content-type', 'text/plain; version=0.0.4')
+        return metrics.render()
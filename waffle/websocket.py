@@ -1,31 +1,244 @@
+import collections
+import itertools
 import json
 
+from twisted.cred.error import UnauthorizedLogin
 from twisted.internet import reactor
 from twisted.internet.defer import maybeDeferred
-from twisted.internet.protocol import Factory, Protocol, ClientCreator
+from twisted.internet.protocol import Factory, Protocol
+from twisted.python import log
 
-from waffle.quassel.protocol import QuasselClient
+from waffle.encoding import CompactEncoding, JSONEncoding, encodings
+from waffle.metrics import metrics
+from waffle.outbound import OutboundQueue
+from waffle.quassel.protocol import connectToCore
+from waffle.session import SessionRegistry
+from waffle.trace import tracer, WEB_IN, WEB_OUT
+
+
+
+_messagesSent = metrics.counter(
+    'waffle_web_messages_sent_total', 'Messages sent to web clients.')
+_bytesSent = metrics.counter(
+    'waffle_web_bytes_sent_total', 'Bytes sent to web clients.')
+_overflows = metrics.counter(
+    'waffle_web_overflows_total',
+    'Web clients disconnected for falling too far behind.')
+
+
+
+def _userMetadataKey(data):
+    if data[u'key'] == u'nick':
+        # Renames are chained, each one applies to the result of the last.
+        return None
+    return data[u'networkId'], data[u'nickname'], data[u'key']
+
+
+
+# Events where only the latest value matters, mapped to a function of their
+# data that identifies the value they update, or C{None} if this one does not
+# just update a value.
+_coalescedEvents = {
+    u'latencyUpdated': lambda data: data[u'networkId'],
+    u'markerUpdated': lambda data: data[u'bufferId'],
+    u'topicChanged': lambda data: (data[u'networkId'], data[u'bufferName']),
+    u'userSetMetadata': _userMetadataKey}
+
+
+
+# Events that are never batched, so that the browser handles each one as it
+# arrives instead of parsing a stream in one go.
+_unbatchedEvents = frozenset([u'streamChunk'])
 
 
 
 class WaffleProtocol(Protocol):
+    """
+    Web client connection.
+
+    @type session: L{waffle.session.Session}
+    @ivar session: Core session the web client is attached to, or C{None}
+        before it authenticates.
+
+    @type maxQueuedBytes: C{int}
+    @ivar maxQueuedBytes: Maximum number of bytes queued for a web client that
+        is not keeping up, before it is disconnected.
+
+    @type batchEvents: C{bool}
+    @ivar batchEvents: Collect the events sent within L{batchDelay} into a
+        single C{batch} message, as requested by the web client when it
+        authenticates, rather than sending each one on its own.
+
+    @type batchDelay: C{float}
+    @ivar batchDelay: Seconds to collect events for before sending a batch,
+        C{0} collects the events sent in a single reactor turn.
+
+    @type maxBatchBytes: C{int}
+    @ivar maxBatchBytes: Send a batch early once it grows beyond this many
+        bytes.
+
+    @type clock: L{twisted.internet.interfaces.IReactorTime}
+
+    @ivar encoding: Encoding of the events sent to the web client, such as
+        L{JSONEncoding}, or L{CompactEncoding} if the web client asks for it
+        when it authenticates.
+    """
+    session = None
+    quassel = None
+    maxQueuedBytes = OutboundQueue.maxBytes
+    batchEvents = False
+    batchDelay = 0
+    maxBatchBytes = 64 * 1024
+    clock = reactor
+    _batchCall = None
+
+    def connectionMade(self):
+        self._outbound = OutboundQueue(self.transport, self._overflowed)
+        self._outbound.maxBytes = self.maxQueuedBytes
+        self._batch = collections.OrderedDict()
+        self._batchBytes = 0
+        self._batchSerial = itertools.count()
+        self._membersSent = set()
+        self._renames = 0
+        self.encoding = JSONEncoding()
+
+
+    def _overflowed(self):
+        log.msg('Disconnecting web client %r, more than %d bytes behind' % (
+            self, self.maxQueuedBytes))
+        _overflows.inc()
+        self.transport.loseConnection()
+
+
     def sendJSON(self, messageType, data):
-        print '=json=>', repr(messageType), repr(data)
-        self.transport.write(json.dumps({u'type': messageType, u'data': data}))
+        tracer.record(WEB_OUT, data, '=> %s', messageType)
+        coalesceKey = _coalescedEvents.get(messageType)
+        if coalesceKey is not None:
+            coalesceKey = coalesceKey(data)
+        if messageType == u'userSetMetadata':
+            if coalesceKey is None:
+                # Nicknames refer to other users after a rename, so events
+                # queued before it are never superseded by those after it.
+                self._renames += 1
+            else:
+                coalesceKey += (self._renames,)
+        if coalesceKey is not None:
+            coalesceKey = messageType, coalesceKey
+        data = self.encoding.encode(messageType, data)
+        _messagesSent.inc()
+        if not self.batchEvents:
+            self._write(data, coalesceKey)
+            return
+        if messageType in _unbatchedEvents:
+            self._flushBatch()
+            self._write(data, coalesceKey)
+            return
+        if coalesceKey is None:
+            coalesceKey = next(self._batchSerial)
+        else:
+            superseded = self._batch.pop(coalesceKey, None)
+            if superseded is not None:
+                self._batchBytes -= len(superseded)
+        self._batch[coalesceKey] = data
+        self._batchBytes += len(data)
+        if self._batchBytes >= self.maxBatchBytes:
+            self._flushBatch()
+        elif self._batchCall is None:
+            self._batchCall = self.clock.callLater(
+                self.batchDelay, self._flushBatch)
+
+
+    def _write(self, data, coalesceKey=None):
+        _bytesSent.inc(len(data))
+        self._outbound.put(data, coalesceKey)
+
+
+    def _flushBatch(self):
+        """
+        Send the events collected so far, as a batch if there is more than
+        one.
+        """
+        if self._batchCall is not None:
+            if self._batchCall.active():
+                self._batchCall.cancel()
+            self._batchCall = None
+        events = self._batch.values()
+        self._batch.clear()
+        self._batchBytes = 0
+        if len(events) == 1:
+            self._write(events[0])
+        elif events:
+            self._write(self.encoding.encodeBatch(events))
+
+
+    def _setEncoding(self, encoding):
+        """
+        Encode the events sent from now on with C{encoding}.
+        """
+        self._flushBatch()
+        if encoding.binary:
+            self.transport.setBinaryMode(True)
+        self.encoding = encoding
+
+
+    def pendingBytes(self):
+        """
+        Get the number of bytes queued or written but not yet sent to the web
+        client.
+        """
+        transport = self.transport
+        pending = self._outbound.bytes
+        while transport is not None:
+            dataBuffer = getattr(transport, 'dataBuffer', None)
+            if dataBuffer is not None:
+                return pending + len(dataBuffer) + getattr(
+                    transport, '_tempDataLen', 0)
+            transport = getattr(transport, 'transport', None)
+        return pending
 
 
     def event_auth(self, data):
-        def _connectedToCore(protocol):
-            protocol.web = self
-            self.quassel = protocol
-            return u'auth', {
-                u'authToken': u'AUTH'}
+        def _opened(session):
+            if not self.connected:
+                self.factory.sessions.detach(self, session)
+                return
+            self.session = session
+            self.quassel = session.quassel
+            encoding = encodings.get(data.get(u'encoding'), JSONEncoding)
+            if (encoding.binary and
+                getattr(self.transport, 'setBinaryMode', None) is None):
+                # txWS before 0.9 can only send text frames.
+                encoding = JSONEncoding
+            encoding = encoding()
+            reply = {u'authToken': u'AUTH', u'encoding': encoding.name}
+            if isinstance(encoding, CompactEncoding):
+                # The reply carries the table of well-known strings, so it
+                # cannot refer to it.
+                reply[u'strings'] = encoding.strings
+                self._setEncoding(CompactEncoding([]))
+            self.sendJSON(u'auth', reply)
+            self._setEncoding(encoding)
+            # Bring this client up to date with the session's state.
+            session.attach(self)
+
+        def _failed(f):
+            if not self.connected:
+                return
+            if f.check(UnauthorizedLogin) is not None:
+                reason = u'unauthorized'
+            else:
+                # The session registry has already logged why.
+                reason = u'unavailable'
+            self.sendJSON(u'authFailed', {u'reason': reason})
+            self._flushBatch()
+            self.transport.loseConnection()
 
         username = data.get(u'username')
         password = data.get(u'password')
-        cc = ClientCreator(reactor, QuasselClient, username, password)
-        d = cc.connectTCP('bombard.jsphere.com', 4242)
-        d.addCallback(_connectedToCore)
+        self.batchEvents = bool(data.get(u'batch', False))
+        d = self.factory.sessions.open(
+            'bombard.jsphere.com', 4242, username, password)
+        d.addCallbacks(_opened, _failed)
         return d
 
 
@@ -35,6 +248,14 @@ class WaffleProtocol(Protocol):
         return self.quassel.sendInput(bufferInfo, message)
 
 
+    def event_focusBuffer(self, data):
+        bufferId = data.get(u'bufferId')
+        if bufferId not in self._membersSent:
+            self._membersSent.add(bufferId)
+            self.quassel.sendChannelMembers(self, bufferId)
+        return self.quassel.focusBuffer(bufferId)
+
+
     def event_hideBuffer(self, data):
         bufferId = data.get(u'bufferId')
         return self.quassel.hideBuffer(bufferId)
@@ -55,12 +276,39 @@ class WaffleProtocol(Protocol):
         data = json.loads(data)
         event = data.get(u'type').encode('ascii')
 
-        print '@@@', self, repr(data)
+        # Never trace credentials.
+        tracer.record(
+            WEB_IN, None if event == 'auth' else data.get(u'data'),
+            '<= %s', event)
         meth = getattr(self, 'event_%s' % (event,))
         d = maybeDeferred(meth, data.get(u'data'))
         d.addCallback(_sendReply)
 
 
+    def connectionLost(self, reason):
+        if self._batchCall is not None and self._batchCall.active():
+            self._batchCall.cancel()
+        if self.session is not None:
+            self.factory.sessions.detach(self, self.session)
+            self.session = None
+
+
+
+class WaffleFactory(Factory):
+    """
+    Web client connection factory.
+
+    @type sessions: L{SessionRegistry}
+    @ivar sessions: Core sessions shared by this factory's web clients.
+    """
+    protocol = WaffleProtocol
+
+    def __init__(self, sessions=None):
+        if sessions is None:
+            sessions = SessionRegistry(connectToCore, reactor)
+        self.sessions = sessions
+        metrics.addCollector(sessions.collectMetrics)
+
+
 
-WaffleFactory = Factory
-WaffleFactory.protocol = WaffleProtocol
+__all__ = ['WaffleProtocol', 'WaffleFactory']